@@ -0,0 +1,221 @@
+#####################################################################################
+#   End to end benchmark of the image and command protocol. Runs the real Pi and    #
+#   ground station functions against RFD_2020_LinkEmulator and writes the results   #
+#   to a JSON file, so every protocol change can be compared against the last one.  #
+#   Constructed for MSGC Borealis program.                                          #
+#                                                                                   #
+#   Python Version: 3.7.6                                                           #
+#                                                                                   #
+#   Example: python RFD_2020_Benchmark.py --sizes 20000 100000 --bers 0 1e-5        #
+#            --chunks 0 4000 --modes b64 binary --out baseline.json                 #
+#   A chunk of 0 leaves the chunk controller free to pick its own sizes             #
+#                                                                                   #
+#####################################################################################
+
+import os
+import sys
+import time
+import json
+import queue
+import random
+import argparse
+import tempfile
+import threading
+import contextlib
+import datetime
+import RFD_2020_LinkEmulator as emulator
+import RFD_2020_Protocol as protocol
+import RFD_2020_PayloadPi as payload
+import RFD_2020_GPS as gpsdata
+import RFD_2020_GroundStation as ground
+
+
+class BenchPayload(payload.main):
+    # The Pi's command functions without its camera, GPS or servo
+
+    def __init__(self, ser, folder):
+        self.ser = ser
+        self.folder = folder
+        self.initTransfer()
+        self.gpsFixes = gpsdata.FixHistory()
+        self.gpsExceptionsQ = queue.Queue()
+        self.cameraEnabled = False
+        self.gpsEnabled = False
+        self.gpsLog = None
+        self.gpsTrack = None
+        self.starttime = time.time()
+        self.recentimg = ""
+        self.rfdEnabled = True
+        self.portLock = threading.Lock()
+        self.pendingAlerts = queue.Queue()
+        self.initCommands()
+
+    def serve(self, stop):
+        # Stands in for main.run (which also looks after the hardware) until stop is set
+        while (not stop.is_set()):
+            command = self.readCommand()
+            if (command is not None):
+                self.runCommand(command)
+
+
+def write_flight_files(folder, images):
+    # An imagedata.txt and gpslog.txt like the ones after an hour of flight
+    stamp = datetime.datetime(2021, 3, 6, 12, 0, 0)
+    file = open(folder + "imagedata.txt", "w")
+    for x in range(images):
+        taken = (stamp + datetime.timedelta(minutes=x)).strftime("%m/%d/%Y %H:%M:%S")
+        file.write("image%04d_b.jpg, @ time(%s) settings(w=650,h=450,sh=0,b=50,c=0,sa=0,i=400)\n" % (x, taken))
+        file.write("image%04d_a.png @ time(%s) settings(w=2592,h=1944,sh=0,b=50,c=0,sa=0,i=400)\n" % (x, taken))
+    file.close()
+    file = open(folder + "gpslog.txt", "w")
+    for x in range(images * 60):
+        file.write("%d,%d,%d,%.6f,%.6f,%.1f,%d\n" % (12 + x // 3600, x // 60 % 60, x % 60, 44.0 + x * 1e-5,
+                                                    -103.0 - x * 1e-5, 1000.0 + x * 5, 10))
+    file.close()
+
+
+class Run:
+    # Times one phase of a benchmark and collects what it cost on the link
+
+    def __init__(self, link, pi):
+        self.link = link
+        self.pi = pi
+
+    def snapshot(self):
+        stats = self.link.stats
+        return (time.time(), dict(self.pi.linkStats), ground.linkstats['syncs'], sum(stats['bytes']),
+                sum(stats['dropped']), sum(stats['flipped']))
+
+    def measure(self, phase, useful, ok, before):
+        after = self.snapshot()
+        seconds = (after[0] - before[0]) * self.link.model.speed  # Link time, not wall clock time
+        return {
+            'phase': phase,
+            'ok': ok,
+            'bytes': useful,
+            'seconds': round(seconds, 3),
+            'goodput': round(useful / seconds, 1) if seconds > 0 else 0,
+            'frames': after[1]['frames'] - before[1]['frames'],
+            'retransmits': after[1]['resent'] - before[1]['resent'],
+            'syncs': (after[1]['syncs'] - before[1]['syncs']) + (after[2] - before[2]),
+            'airbytes': after[3] - before[3],
+            'dropped': after[4] - before[4],
+            'flipped': after[5] - before[5],
+        }
+
+
+def run_case(mode, size, ber, drop, chunk, args, workdir):
+    # One point of the sweep: negotiate, fetch gpslog.txt and imagedata.txt, then send an image
+    model = emulator.LinkModel(ber=ber, drop=drop, speed=args.speed, seed=args.seed)
+    pilink, groundlink = emulator.make_pair(model, timeout=ground.rfdtimeout)
+    folder = workdir + "pi/"
+    pi = BenchPayload(pilink, folder)
+    if (mode == protocol.MODE_BINARY):
+        if (chunk > 0):
+            pi.chunkControl = protocol.ChunkController(chunk, minimum=chunk, maximum=chunk)
+    elif (chunk > 0):
+        pi.b64WordSize = chunk
+    ground.ser = groundlink
+    ground.wordlength = pi.b64WordSize
+    ground.compression = args.compress
+    ground.fecgroup = args.fec
+    ground.integrity = args.check
+    ground.progressive = 0
+    run = Run(pilink.link, pi)
+    results = []
+
+    stop = threading.Event()
+    server = threading.Thread(target=pi.serve, args=(stop,))
+    server.daemon = True
+    server.start()
+    before = run.snapshot()
+    ground.negotiate_transfer_mode(mode)
+    results.append(run.measure('negotiate', 0, ground.transfermode == mode, before))
+
+    before = run.snapshot()
+    got = ground.getGPSfile()
+    sent = "".join(open(folder + "gpslog.txt").readlines()[-10:])
+    received = open("gpslog.txt").read() if got else None  # A gpslog.txt from an earlier run doesn't count
+    results.append(run.measure('gpslog', len(sent), received == sent, before))
+
+    before = run.snapshot()
+    got = ground.receive_image_data("imagedata")
+    sent = open(folder + "imagedata.txt").read()
+    received = open("imagedata.txt").read() if got else None
+    results.append(run.measure('imagedata', len(sent), received == sent, before))
+    stop.set()
+    server.join()
+
+    image = folder + "bench.jpg"
+    data = random.Random(size).getrandbits(8 * size).to_bytes(size, 'big')  # Noise, like a jpg it won't compress
+    file = open(image, "wb")
+    file.write(data)
+    file.close()
+    savepath = "bench_received.jpg"
+    for leftover in (savepath, savepath + ".part", savepath + ".manifest"):
+        if (os.path.exists(leftover)):
+            os.remove(leftover)
+    before = run.snapshot()
+    sender = threading.Thread(target=pi.send_image, args=(image,))
+    sender.start()
+    ground.receive_image(savepath, ground.wordlength)
+    sender.join()
+    received = open(savepath, "rb").read() if os.path.exists(savepath) else b''
+    results.append(run.measure('image', size, received == data, before))
+
+    for result in results:
+        result.update({'mode': mode, 'size': size, 'ber': ber, 'drop': drop, 'chunk': chunk})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the RFD900 protocol over an emulated link")
+    parser.add_argument("--modes", nargs="+", default=[protocol.MODE_B64, protocol.MODE_BINARY])
+    parser.add_argument("--sizes", nargs="+", type=int, default=[20000, 60000], help="image sizes in bytes")
+    parser.add_argument("--bers", nargs="+", type=float, default=[0.0, 1e-5], help="bit error rates")
+    parser.add_argument("--drops", nargs="+", type=float, default=[0.0], help="byte drop rates")
+    parser.add_argument("--chunks", nargs="+", type=int, default=[0, 2000, 8000],
+                        help="binary frame or base64 word sizes, 0 = adaptive/default")
+    parser.add_argument("--compress", default=protocol.COMPRESS_ZDICT, choices=protocol.COMPRESSIONS)
+    parser.add_argument("--check", default=protocol.CHECK_CRC32, choices=protocol.CHECKS)
+    parser.add_argument("--fec", type=int, default=0)
+    parser.add_argument("--images", type=int, default=60, help="images listed in imagedata.txt")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="run the link this many times faster, the sleeps in the code are not scaled so "
+                             "only use 1 for numbers to compare")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", default="benchmark_results.json")
+    args = parser.parse_args()
+
+    out = os.path.abspath(args.out)
+    workdir = tempfile.mkdtemp(prefix="rfdbench") + "/"
+    os.mkdir(workdir + "pi/")
+    write_flight_files(workdir + "pi/", args.images)
+    os.chdir(workdir)  # The ground station saves everything in the working directory
+    results = []
+    log = open(workdir + "benchmark.log", "w")
+    print("%-7s %-9s %8s %8s %6s %3s %9s %10s %6s %5s" % (
+        "mode", "phase", "bytes", "ber", "chunk", "ok", "seconds", "goodput", "resent", "syncs"))
+    for mode in args.modes:
+        for size in args.sizes:
+            for ber in args.bers:
+                for drop in args.drops:
+                    for chunk in args.chunks:
+                        with contextlib.redirect_stdout(log):
+                            case = run_case(mode, size, ber, drop, chunk, args, workdir)
+                        for r in case:
+                            print("%-7s %-9s %8d %8g %6d %3s %9.1f %10.1f %6d %5d" % (
+                                r['mode'], r['phase'], r['bytes'], r['ber'], r['chunk'], "yes" if r['ok'] else "NO",
+                                r['seconds'], r['goodput'], r['retransmits'], r['syncs']))
+                        sys.stdout.flush()
+                        results.extend(case)
+    log.close()
+    file = open(out, "w")
+    json.dump({'created': datetime.datetime.now().isoformat(), 'settings': vars(args), 'results': results},
+              file, indent=1)
+    file.close()
+    print("Results written to", out, "// Protocol log:", workdir + "benchmark.log")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,535 @@
+#####################################################################################
+#   GPS side of RFD_2020_PayloadPi: turns the NMEA stream of the GPS receiver into  #
+#   fixes for the main loop, telemetry and gpslog.txt.                              #
+#   Constructed for MSGC Borealis program.                                          #
+#                                                                                   #
+#   Python Version: 3.7.6                                                           #
+#                                                                                   #
+#####################################################################################
+
+import os
+import re
+import time
+import math
+import struct
+import calendar
+import datetime
+import threading
+from collections import namedtuple
+try:
+    import numpy
+except ImportError:
+    numpy = None  # The track store can still be written, just not queried
+
+# Fixes
+# One fix is made for every GGA sentence, with the speed, course, date and dilution of precision from the latest
+# RMC, VTG and GSA sentences added in. Receivers send those around their GGA every epoch, so they are at most one
+# epoch old. A field the receiver left empty (or that arrived unreadable) is None, the rest of the fix still counts
+# time: seconds since midnight UTC, date: datetime.date from RMC, lat/lon: degrees (south and west negative),
+# alt: meters above mean sea level, sats: satellites used, quality: GGA fix quality (0 = no fix),
+# hdop/pdop/vdop: dilution of precision, speed: ground speed in m/s, course: degrees from true north,
+# mode: GSA fix type (1 = none, 2 = 2D, 3 = 3D), received: time.time() when the GGA came in
+Fix = namedtuple('Fix', ['time', 'date', 'lat', 'lon', 'alt', 'sats', 'quality', 'hdop', 'speed', 'course',
+                         'pdop', 'vdop', 'mode', 'received'])
+
+# gpslog.txt
+# GPSLog keeps the log open and writes fixes out in batches. When the log goes to the SD card is set by these
+FSYNC_NEVER = "never"  # Left to the OS, a power cut can lose whatever it hadn't written back yet
+FSYNC_FLUSH = "flush"  # Every batch is on the card before flush() returns
+FSYNC_ROTATE = "rotate"  # Only when a full log is closed
+FSYNCS = (FSYNC_NEVER, FSYNC_FLUSH, FSYNC_ROTATE)
+
+# gpstrack.bin
+# Every fix as one fixed size record after a TRACK_HEADER, so the file can be memory mapped as an array of
+# TRACK_DTYPE and the fix at any index found without reading the ones before it. Records are in time order
+# time: seconds since 1970 UTC, a missing number is NaN and missing sats/quality/mode are 0
+TRACK_MAGIC = b'RFDTRACK'
+TRACK_HEADER = struct.Struct("<8sII")  # magic, version, record size
+TRACK_VERSION = 1
+TRACK_RECORD = struct.Struct("<dddffffBBBx")
+TRACK_FIELDS = [('time', '<f8'), ('lat', '<f8'), ('lon', '<f8'), ('alt', '<f4'), ('speed', '<f4'),
+                ('course', '<f4'), ('hdop', '<f4'), ('sats', 'u1'), ('quality', 'u1'), ('mode', 'u1'),
+                ('spare', 'u1')]
+TRACK_DTYPE = numpy.dtype(TRACK_FIELDS) if numpy is not None else None
+SECONDS_PER_DAY = 86400
+
+KNOTS = 0.514444  # m/s
+MAX_SENTENCE = 128  # NMEA allows 82 characters, anything without a line end by here is noise
+CHECKSUM_DIGITS = re.compile(rb'[0-9A-Fa-f]{2}')
+
+
+def parse_float(field):
+    # A number field, None if it is empty or broken
+    try:
+        return float(field)
+    except ValueError:
+        return None
+
+
+def parse_int(field):
+    try:
+        return int(field)
+    except ValueError:
+        return None
+
+
+def parse_time(field):
+    # hhmmss.ss to seconds since midnight
+    try:
+        return int(field[0:2]) * 3600 + int(field[2:4]) * 60 + float(field[4:])
+    except ValueError:
+        return None
+
+
+def parse_date(field):
+    # ddmmyy to a date
+    try:
+        return datetime.date(2000 + int(field[4:6]), int(field[2:4]), int(field[0:2]))
+    except ValueError:
+        return None
+
+
+def parse_degrees(field, hemisphere):
+    # (d)ddmm.mmmm and N/S/E/W to signed degrees
+    value = parse_float(field)
+    if (value is None):
+        return None
+    degrees = int(value // 100)
+    degrees += (value - degrees * 100) / 60
+    if (hemisphere in (b'S', b'W')):
+        return -degrees
+    return degrees
+
+
+def checksum(body):
+    # XOR of every byte between the $ and the *
+    total = 0
+    for byte in body:
+        total ^= byte
+    return total
+
+
+class NMEAParser:
+    # Incremental NMEA 0183 parser. feed() takes whatever the serial port had waiting, in any size of piece, and
+    # returns the fixes completed by it. Sentences are checked against their checksum, sentences without one or
+    # with a wrong one are dropped and counted in stats. Nothing in here raises on bad input
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.speed = None
+        self.course = None
+        self.date = None
+        self.pdop = None
+        self.vdop = None
+        self.mode = None
+        self.stats = {'sentences': 0, 'badChecksum': 0, 'ignored': 0, 'fixes': 0, 'noise': 0}
+        self.handlers = {
+            b'GGA': self.parseGGA,
+            b'RMC': self.parseRMC,
+            b'VTG': self.parseVTG,
+            b'GSA': self.parseGSA,
+        }
+
+    def feed(self, data):
+        # Adds data from the port, returns a list of the Fixes it completed
+        self.buffer += data
+        fixes = []
+        start = 0
+        while True:
+            end = self.buffer.find(b'\n', start)
+            if (end < 0):
+                break
+            fix = self.parseSentence(self.buffer[start:end])
+            if (fix is not None):
+                fixes.append(fix)
+            start = end + 1
+        del self.buffer[:start]  # Once per feed, not once per sentence
+        if (len(self.buffer) > MAX_SENTENCE):
+            self.stats['noise'] += 1
+            dollar = self.buffer.rfind(b'$')
+            del self.buffer[:dollar if dollar >= 0 else len(self.buffer)]
+            if (len(self.buffer) > MAX_SENTENCE):
+                self.buffer.clear()  # No line end this far after its $, it isn't a sentence
+        return fixes
+
+    def parseSentence(self, line):
+        # Checks one line and hands its fields to the handler for its sentence type
+        dollar = line.rfind(b'$')  # Anything before the last $ is the tail of a sentence we lost
+        star = line.rfind(b'*')
+        if ((dollar < 0) or (star < dollar)):
+            self.stats['noise'] += 1
+            return None
+        body = line[dollar + 1:star]
+        digits = bytes(line[star + 1:star + 3])
+        # Exactly two hex digits, int() alone would also take one digit and the \r after it
+        good = (CHECKSUM_DIGITS.fullmatch(digits) is not None) and (int(digits, 16) == checksum(body))
+        if (not good):
+            self.stats['badChecksum'] += 1
+            return None
+        self.stats['sentences'] += 1
+        fields = body.split(b',')
+        handler = self.handlers.get(bytes(fields[0][-3:]))  # The talker (GP, GN, GL, ...) doesn't matter
+        if (handler is None):
+            self.stats['ignored'] += 1
+            return None
+        return handler(fields)
+
+    def parseGGA(self, fields):
+        # $--GGA,time,lat,N,lon,W,quality,sats,hdop,alt,M,...
+        if (len(fields) < 10):
+            self.stats['noise'] += 1
+            return None
+        self.stats['fixes'] += 1
+        return Fix(parse_time(fields[1]), self.date, parse_degrees(fields[2], fields[3]),
+                   parse_degrees(fields[4], fields[5]), parse_float(fields[9]), parse_int(fields[7]),
+                   parse_int(fields[6]), parse_float(fields[8]), self.speed, self.course, self.pdop, self.vdop,
+                   self.mode, time.time())
+
+    def parseRMC(self, fields):
+        # $--RMC,time,status,lat,N,lon,W,knots,course,date,...
+        if (len(fields) < 10):
+            return None
+        knots = parse_float(fields[7])
+        if (knots is not None):
+            self.speed = knots * KNOTS
+        self.course = parse_float(fields[8])
+        self.date = parse_date(fields[9])
+        return None
+
+    def parseVTG(self, fields):
+        # $--VTG,course,T,course,M,knots,N,km/h,K,...
+        if (len(fields) < 8):
+            return None
+        self.course = parse_float(fields[1])
+        kmh = parse_float(fields[7])
+        if (kmh is not None):
+            self.speed = kmh / 3.6
+        return None
+
+    def parseGSA(self, fields):
+        # $--GSA,A,mode,12 satellite ids,pdop,hdop,vdop,...
+        if (len(fields) < 18):
+            return None
+        self.mode = parse_int(fields[2])
+        self.pdop = parse_float(fields[15])
+        self.vdop = parse_float(fields[17])
+        return None
+
+
+class FixHistory:
+    # Where the rest of the payload gets its GPS data. The GPS thread put()s every fix, anything else can read:
+    #   latest()       the newest Fix, None before the first one
+    #   recent(count)  up to the newest count fixes still held, oldest first
+    #   since(number)  the fixes after the number-th one ever put, and the number to ask with next time, so a
+    #                  reader that falls more than capacity behind just misses the oldest ones
+    #   total          how many fixes have been put since startup
+    # Holds at most capacity fixes (600, a minute at 10 Hz), older ones are overwritten, so memory stays the
+    # same for the whole flight. Only one thread may put(). Readers never wait on it or each other: they copy
+    # what they need, then check how far the writer got meanwhile and drop any fix it overwrote in between
+
+    def __init__(self, capacity=600):
+        self.capacity = capacity
+        self.ring = [None] * capacity
+        self.total = 0
+        self.newest = None
+
+    def put(self, fix):
+        # The GPS thread only
+        self.ring[self.total % self.capacity] = fix
+        self.total += 1  # After the slot, so readers never see a count whose fix isn't there yet
+        self.newest = fix
+
+    def latest(self):
+        return self.newest
+
+    def recent(self, count):
+        return self.since(self.total - count)[0]
+
+    def since(self, number):
+        total = self.total
+        first = max(number, total - self.capacity, 0)
+        fixes = [self.ring[x % self.capacity] for x in range(first, total)]
+        # Slots the writer reused while they were being copied, plus the one a put() may be writing right now
+        # (its slot is written before total counts it)
+        overwritten = self.total + 1 - self.capacity - first
+        if (overwritten > 0):
+            fixes = fixes[overwritten:]
+        return fixes, total
+
+
+def format_fix(fix):
+    # The gpslog.txt line of a fix, "hours,minutes,seconds,lat,lon,alt,sats" the way it has always been logged
+    # Fields the receiver didn't have are logged as 0
+    seconds = int(fix.time) if fix.time is not None else 0
+    return "%d,%d,%d,%.6f,%.6f,%s,%d\n" % (seconds // 3600, seconds // 60 % 60, seconds % 60,
+                                          fix.lat if fix.lat is not None else 0,
+                                          fix.lon if fix.lon is not None else 0,
+                                          str(fix.alt if fix.alt is not None else 0),
+                                          fix.sats if fix.sats is not None else 0)
+
+
+class GPSLog:
+    # gpslog.txt, kept open for the whole flight. Lines are held in memory and written in one go once flushInterval
+    # seconds or flushBytes bytes of them have piled up, so a crash loses at most the last flushInterval of fixes
+    # instead of the card seeing an open, write and close for every fix. tick() flushes a batch that is due even
+    # when no new fixes come in. Once the log reaches maxBytes it becomes gpslog.txt.1 (older logs move up to .2,
+    # and so on up to keep) and a new one is started. Safe to use from more than one thread
+
+    def __init__(self, path, flushInterval=1.0, flushBytes=4096, maxBytes=8 * 1024 * 1024, keep=5,
+                 fsync=FSYNC_FLUSH):
+        if (fsync not in FSYNCS):
+            raise ValueError("Unknown fsync policy: " + str(fsync))
+        self.path = path
+        self.flushInterval = flushInterval
+        self.flushBytes = flushBytes
+        self.maxBytes = maxBytes
+        self.keep = keep
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.pending = []  # Lines not written yet
+        self.pendingBytes = 0
+        self.lastFlush = time.monotonic()
+        self.file = open(path, "ab")
+        self.size = self.file.tell()
+        self.stats = {'lines': 0, 'flushes': 0, 'rotations': 0}
+
+    def write(self, line):
+        # Adds a line (ending in a newline) to the log, it reaches the file with the next batch
+        data = line.encode('utf-8')
+        with self.lock:
+            self.pending.append(data)
+            self.pendingBytes += len(data)
+            self.stats['lines'] += 1
+            if (self.due()):
+                self.writePending()
+
+    def due(self):
+        return (self.pendingBytes >= self.flushBytes) or \
+               (self.pending and (time.monotonic() - self.lastFlush >= self.flushInterval))
+
+    def tick(self):
+        # Writes out the batch if it is due, call this now and then when there may be no fixes coming
+        with self.lock:
+            if (self.due()):
+                self.writePending()
+
+    def flush(self):
+        # Writes out everything logged so far, ex. before the log is read or the Pi shuts down
+        with self.lock:
+            self.writePending()
+
+    def writePending(self):
+        # Only with self.lock held
+        self.lastFlush = time.monotonic()
+        if (not self.pending):
+            return
+        data = b''.join(self.pending)
+        self.pending = []
+        self.pendingBytes = 0
+        self.file.write(data)
+        self.file.flush()
+        if (self.fsync == FSYNC_FLUSH):
+            os.fsync(self.file.fileno())
+        self.size += len(data)
+        self.stats['flushes'] += 1
+        if (self.size >= self.maxBytes):
+            self.rotate()
+
+    def rotate(self):
+        # Only with self.lock held. Closes the full log, moves the older ones up and starts a new one
+        if (self.fsync != FSYNC_NEVER):
+            os.fsync(self.file.fileno())
+        self.file.close()
+        for x in range(self.keep - 1, 0, -1):
+            older = "%s.%d" % (self.path, x)
+            if (os.path.exists(older)):
+                os.replace(older, "%s.%d" % (self.path, x + 1))
+        if (self.keep > 0):
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+        self.file = open(self.path, "ab")
+        self.size = 0
+        self.stats['rotations'] += 1
+
+    def files(self):
+        # The paths of the logs there are, oldest first
+        older = ["%s.%d" % (self.path, x) for x in range(self.keep, 0, -1)]
+        return [path for path in older + [self.path] if os.path.exists(path)]
+
+    def close(self):
+        with self.lock:
+            self.writePending()
+            if (self.fsync != FSYNC_NEVER):
+                os.fsync(self.file.fileno())
+            self.file.close()
+
+
+def fix_epoch(fix):
+    # The UTC time of a fix in seconds since 1970, None if the receiver didn't send one
+    # Without a date from RMC the day is taken from when the fix came in, allowing for midnight in between
+    if (fix.time is None):
+        return None
+    if (fix.date is not None):
+        return calendar.timegm(fix.date.timetuple()) + fix.time
+    midnight = fix.received - fix.received % SECONDS_PER_DAY
+    if (fix.time - fix.received % SECONDS_PER_DAY > SECONDS_PER_DAY / 2):
+        midnight -= SECONDS_PER_DAY  # Fix from just before midnight, received just after
+    elif (fix.received % SECONDS_PER_DAY - fix.time > SECONDS_PER_DAY / 2):
+        midnight += SECONDS_PER_DAY
+    return midnight + fix.time
+
+
+def pack_fix(fix, epoch):
+    # The gpstrack.bin record of a fix
+    def number(value):
+        return value if value is not None else math.nan
+    return TRACK_RECORD.pack(epoch, number(fix.lat), number(fix.lon), number(fix.alt), number(fix.speed),
+                             number(fix.course), number(fix.hdop), fix.sats or 0, fix.quality or 0, fix.mode or 0)
+
+
+class TrackStore:
+    # gpstrack.bin, the whole flight track for queries. Fixes are batched the same way GPSLog does it and synced
+    # with every batch. Queries only look at the records they return plus a binary search over the times, so
+    # they cost the same at the end of a long flight as at the start. A record cut short by a crash is dropped
+    # when the file is opened again. Fixes older than the newest stored one (ex. a receiver reset) are skipped
+    # so the times stay sorted. Safe to use from more than one thread, the queries need numpy
+
+    def __init__(self, path, flushInterval=1.0, flushBytes=4096):
+        self.path = path
+        self.flushInterval = flushInterval
+        self.flushBytes = flushBytes
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pendingBytes = 0
+        self.lastFlush = time.monotonic()
+        self.lastTime = -math.inf
+        self.stats = {'fixes': 0, 'skipped': 0, 'flushes': 0}
+        self.file = open(path, "a+b")
+        size = self.file.seek(0, os.SEEK_END)
+        if (size < TRACK_HEADER.size):
+            self.file.truncate(0)
+            self.file.write(TRACK_HEADER.pack(TRACK_MAGIC, TRACK_VERSION, TRACK_RECORD.size))
+            self.file.flush()
+            size = TRACK_HEADER.size
+        else:
+            self.file.seek(0)
+            magic, version, recordsize = TRACK_HEADER.unpack(self.file.read(TRACK_HEADER.size))
+            if ((magic != TRACK_MAGIC) or (version != TRACK_VERSION) or (recordsize != TRACK_RECORD.size)):
+                self.file.close()
+                raise ValueError(path + " is not a version " + str(TRACK_VERSION) + " track")
+        self.count = (size - TRACK_HEADER.size) // TRACK_RECORD.size
+        if (TRACK_HEADER.size + self.count * TRACK_RECORD.size != size):
+            self.file.truncate(TRACK_HEADER.size + self.count * TRACK_RECORD.size)
+        if (self.count > 0):
+            self.file.seek(TRACK_HEADER.size + (self.count - 1) * TRACK_RECORD.size)
+            self.lastTime = TRACK_RECORD.unpack(self.file.read(TRACK_RECORD.size))[0]
+        self.file.seek(0, os.SEEK_END)
+        self.mapped = None  # Memory map of the first mappedCount records, remade once there are more
+        self.mappedCount = 0
+
+    def append(self, fix):
+        # Adds a fix, it reaches the file with the next batch
+        epoch = fix_epoch(fix)
+        with self.lock:
+            if ((epoch is None) or (epoch < self.lastTime)):
+                self.stats['skipped'] += 1
+                return
+            self.lastTime = epoch
+            self.pending.append(pack_fix(fix, epoch))
+            self.pendingBytes += TRACK_RECORD.size
+            self.stats['fixes'] += 1
+            if (self.due()):
+                self.writePending()
+
+    def due(self):
+        return (self.pendingBytes >= self.flushBytes) or \
+               (self.pending and (time.monotonic() - self.lastFlush >= self.flushInterval))
+
+    def tick(self):
+        # Writes out the batch if it is due
+        with self.lock:
+            if (self.due()):
+                self.writePending()
+
+    def flush(self):
+        with self.lock:
+            self.writePending()
+
+    def writePending(self):
+        # Only with self.lock held
+        self.lastFlush = time.monotonic()
+        if (not self.pending):
+            return
+        self.file.write(b''.join(self.pending))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.count += len(self.pending)
+        self.pending = []
+        self.pendingBytes = 0
+        self.stats['flushes'] += 1
+
+    def view(self):
+        # Every stored fix as a read only TRACK_DTYPE array over the file, including the batch not written yet
+        with self.lock:
+            self.writePending()
+            if (self.count == 0):
+                return numpy.zeros(0, TRACK_DTYPE)
+            if (self.mappedCount != self.count):
+                self.mapped = numpy.memmap(self.path, TRACK_DTYPE, "r", TRACK_HEADER.size, (self.count,))
+                self.mappedCount = self.count
+            return self.mapped
+
+    def last(self, count):
+        # The newest count fixes, oldest first
+        if (count <= 0):
+            return numpy.zeros(0, TRACK_DTYPE)
+        return self.view()[-count:]
+
+    def between(self, start, end, points=0):
+        # The fixes from time start to end (seconds since 1970 UTC), thinned out to at most points of them
+        # spread evenly through the range, the first and last always included. 0 points for all of them
+        track = self.view()
+        times = track['time']
+        first = numpy.searchsorted(times, start, 'left')
+        stop = numpy.searchsorted(times, end, 'right')
+        if ((points <= 0) or (stop - first <= points)):
+            return track[first:stop]
+        if (points == 1):
+            return track[first:first + 1]
+        return track[numpy.unique(numpy.linspace(first, stop - 1, points).round().astype(numpy.int64))]
+
+    def close(self):
+        with self.lock:
+            self.writePending()
+            self.mapped = None
+            self.file.close()
+
+
+def file_tail(name, count, block=4096):
+    # The last count lines of one file, read back from its end a block at a time so a long log costs no more
+    # than a short one
+    file = open(name, "rb")
+    pos = file.seek(0, os.SEEK_END)
+    data = b''
+    while ((pos > 0) and (data.count(b'\n', 0, -1) < count)):  # The newline ending the last line doesn't count
+        step = min(block, pos)
+        pos -= step
+        file.seek(pos)
+        data = file.read(step) + data
+    file.close()
+    lines = data.decode('utf-8', 'replace').splitlines(True)
+    if (pos > 0):
+        lines = lines[1:]  # Cut off at the start of the block
+    return lines[-count:] if count > 0 else []
+
+
+def log_tail(path, count, keep=5):
+    # The last count lines of the log at path, reaching back into the rotated logs (path.1, path.2, ...) if needed
+    lines = []
+    for x in range(keep + 1):
+        name = path if x == 0 else "%s.%d" % (path, x)
+        if ((len(lines) >= count) or not os.path.exists(name)):
+            break
+        lines = file_tail(name, count - len(lines)) + lines
+    return lines
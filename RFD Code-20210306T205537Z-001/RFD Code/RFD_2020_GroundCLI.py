@@ -0,0 +1,279 @@
+#####################################################################################
+#   Headless ground station. Runs the commands of RFD_2020_GroundStation from the   #
+#   command line or from another script, no display or Tk needed, so downloads     #
+#   can be scripted (ex. overnight recovery) and benchmarked.                       #
+#   Constructed for MSGC Borealis program.                                          #
+#                                                                                   #
+#   Python Version: 3.7.6                                                           #
+#                                                                                   #
+#   Example: python RFD_2020_GroundCLI.py --port /dev/ttyUSB0 recent                #
+#            python RFD_2020_GroundCLI.py --dir recovered image image0042_a.png     #
+#            python RFD_2020_GroundCLI.py --dir recovered fetch --full              #
+#   From Python: connect("/dev/ttyUSB0"), then call the functions below, or the    #
+#   command functions of RFD_2020_GroundStation itself                              #
+#                                                                                   #
+#####################################################################################
+
+import os
+import sys
+import argparse
+import serial
+import RFD_2020_Protocol as protocol
+import RFD_2020_GroundStation as ground
+
+CAMERA_SETTINGS = ('width', 'height', 'sharpness', 'brightness', 'contrast', 'saturation', 'iso')
+
+
+def connect(port=None, baud=None, timeout=None, ser=None):
+    # Points the ground station commands at a port, or at an open ser (ex. one end of RFD_2020_LinkEmulator)
+    if (ser is None):
+        ser = serial.Serial(port=port if port is not None else ground.rfdport,
+                            baudrate=baud if baud is not None else ground.rfdbaud,
+                            timeout=timeout if timeout is not None else ground.rfdtimeout)
+    ground.ser = ser
+    return ser
+
+
+def negotiate(mode=protocol.MODE_BINARY, check=None, compress=None, fec=None, progressive=None, telemetry=None):
+    # Command M: Agrees on the transfer mode, options left as None keep the ground station's defaults
+    # Returns the mode the Pi picked
+    if (check is not None):
+        ground.integrity = check
+    if (compress is not None):
+        ground.compression = compress
+    if (fec is not None):
+        ground.fecgroup = fec
+    if (progressive is not None):
+        ground.progressive = progressive
+    if (telemetry is not None):
+        ground.telemetry = telemetry
+    ground.negotiate_transfer_mode(mode)
+    return ground.transfermode
+
+
+def recent_image(name=""):
+    # Command 1: Returns the path of the newest image, saved under the Pi's name unless name is given
+    return ground.mostRecentImage(name)
+
+
+def image_list(name="imagedata"):
+    # Command 2: Returns the names of the images the Pi has, newest last, and saves the list as name.txt
+    # None if nothing came back
+    lines = ground.receive_image_data(name)
+    if (not lines):
+        return None
+    return ground.image_names(lines)
+
+
+def fetch_new(fullres=False):
+    # Commands 2 and B: Downloads every image not on disk yet, returns the paths received
+    return ground.fetch_new_images(fullres)
+
+
+def get_image(name):
+    # Command 3: Returns the path of image name, picking up where an earlier download stopped
+    return ground.receive_requested_image(name)
+
+
+def get_crop(name, box, scale=1):
+    # Command C: Returns the path of a region of image name, box is (left, top, right, bottom) in fractions
+    stem = os.path.splitext(name)[0]
+    return ground.receive_crop(name, box, scale, "%s_crop_%s.jpg" % (stem, "_".join([str(b) for b in box])))
+
+
+def gps_log():
+    # Command G: Returns the lines of the Pi's GPS log that were sent, also saved as gpslog.txt
+    if (not ground.getGPSfile()):
+        return None
+    return open("gpslog.txt").read().splitlines()
+
+
+def gps_track(last=None, start=None, end=None, points=0):
+    # Commands L and W: Returns the "time,lat,lon,alt,sats" lines of the last fixes of the track, of the fixes
+    # between start and end (seconds since 1970 UTC) thinned out to points, or of the whole flight if neither is
+    # given, also saved as gpstrack.txt
+    if (last is not None):
+        return ground.gps_track_last(last)
+    if (start is None):
+        return ground.gps_track_all()
+    return ground.gps_track_between(start, end, points)
+
+
+def get_camera_settings():
+    # Command 4: Returns the Pi's camera settings as a dict
+    if (not ground.retrieveCameraSettings()):
+        return None
+    return camera_settings()
+
+
+def set_camera_settings(**settings):
+    # Command 5: Changes any of width, height, sharpness, brightness, contrast, saturation and iso on the Pi,
+    # the rest keep the values last read or set. Returns True once the Pi has them
+    for key, value in settings.items():
+        if (key not in CAMERA_SETTINGS):
+            raise ValueError("Unknown camera setting: " + key)
+        setattr(ground, key, int(value))
+    ground.save_camera_settings()
+    return ground.send_camera_settings()
+
+
+def camera_settings():
+    # The camera settings last read from or sent to the Pi
+    return dict([(key, getattr(ground, key)) for key in CAMERA_SETTINGS])
+
+
+def time_sync():
+    # Command T: Sets the Pi's clock to this computer's, returns the ping time measured after
+    return ground.time_sync()
+
+
+def ping(count=10):
+    # Command P: Returns the average ping time in seconds, None if the Pi stopped answering
+    return ground.connectiontest(count)
+
+
+def status():
+    # Command D: Returns the Pi's camera and GPS status line
+    return ground.device_status()
+
+
+def camera_angle(degrees):
+    # Command H: Points the camera, 90 is level
+    return ground.set_camera_angle(degrees)
+
+
+def reboot():
+    # Command R
+    return ground.reboot_pi()
+
+
+def shutdown():
+    # Command Q
+    return ground.shutdown_pi()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless RFD900 ground station")
+    parser.add_argument("--port", default=ground.rfdport, help="serial port of the RFD900, default RFD_PORT or COM5")
+    parser.add_argument("--baud", type=int, default=ground.rfdbaud)
+    parser.add_argument("--timeout", type=float, default=ground.rfdtimeout, help="serial read timeout in seconds")
+    parser.add_argument("--dir", default=".", help="where received files are saved")
+    parser.add_argument("--mode", default=protocol.MODE_BINARY, choices=protocol.MODES)
+    parser.add_argument("--check", default=ground.integrity, choices=protocol.CHECKS)
+    parser.add_argument("--compress", default=ground.compression, choices=protocol.COMPRESSIONS)
+    parser.add_argument("--fec", type=int, default=ground.fecgroup)
+    parser.add_argument("--progressive", type=int, default=0, choices=(0, 1))
+    parser.add_argument("--telemetry", type=int, default=ground.telemetry, choices=(0, 1))
+    parser.add_argument("--log", default=None, help="send the protocol chatter here instead of stderr")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    recent = commands.add_parser("recent", help="download the most recent image")
+    recent.add_argument("--name", default="", help="save name without extension, default the Pi's name")
+    listing = commands.add_parser("list", help="download imagedata.txt and print the image names")
+    listing.add_argument("--name", default="imagedata", help="save name without .txt")
+    image = commands.add_parser("image", help="download (or resume) specific images")
+    image.add_argument("names", nargs="+")
+    fetch = commands.add_parser("fetch", help="download every image that isn't in --dir yet, in one batch")
+    fetch.add_argument("--full", action="store_true", help="the full resolution _a.png images too")
+    crop = commands.add_parser("crop", help="download a region of an image")
+    crop.add_argument("name")
+    crop.add_argument("box", nargs=4, type=float, metavar=("LEFT", "TOP", "RIGHT", "BOTTOM"),
+                      help="fractions of the image width and height")
+    crop.add_argument("--scale", type=int, default=1)
+    commands.add_parser("gpslog", help="download the end of the Pi's GPS log")
+    track = commands.add_parser("track", help="download part of the Pi's GPS track")
+    trackquery = track.add_mutually_exclusive_group(required=True)
+    trackquery.add_argument("--all", action="store_true", help="every fix of the flight")
+    trackquery.add_argument("--last", type=int, help="the newest LAST fixes")
+    trackquery.add_argument("--between", nargs=2, type=float, metavar=("START", "END"),
+                            help="the fixes between two times, in seconds since 1970 UTC")
+    track.add_argument("--points", type=int, default=0, help="thin --between out to this many fixes, 0 for all")
+    camera = commands.add_parser("camera", help="print the camera settings, or change them")
+    for key in CAMERA_SETTINGS:
+        camera.add_argument("--" + key, type=int)
+    commands.add_parser("time", help="set the Pi's clock to this computer's, then ping")
+    pinging = commands.add_parser("ping", help="measure the ping time")
+    pinging.add_argument("--count", type=int, default=10)
+    commands.add_parser("status", help="print the camera and GPS status")
+    angle = commands.add_parser("angle", help="point the camera, 45 to 135 degrees")
+    angle.add_argument("degrees", type=int)
+    commands.add_parser("reboot", help="reboot the Pi")
+    commands.add_parser("shutdown", help="shut the Pi down")
+    args = parser.parse_args()
+
+    # The command functions print as they go, keep stdout for the results
+    out = sys.stdout
+    sys.stdout = open(args.log, "a") if args.log is not None else sys.stderr
+    if (not os.path.exists(args.dir)):
+        os.makedirs(args.dir)
+    os.chdir(args.dir)
+    connect(args.port, args.baud, args.timeout)
+    try:
+        if (args.command not in ("reboot", "shutdown", "angle")):
+            negotiate(args.mode, args.check, args.compress, args.fec, args.progressive, args.telemetry)
+        if (args.command == "recent"):
+            result = recent_image(args.name)
+        elif (args.command == "list"):
+            result = image_list(args.name)
+            if (result is not None):
+                result = "\n".join(result)
+        elif (args.command == "image"):
+            paths = [get_image(name) for name in args.names]
+            result = "\n".join(paths) if None not in paths else None
+        elif (args.command == "fetch"):
+            result = fetch_new(args.full)
+            if (result is not None):
+                result = "\n".join(result)
+        elif (args.command == "crop"):
+            result = get_crop(args.name, tuple(args.box), args.scale)
+        elif (args.command == "gpslog"):
+            result = gps_log()
+            if (result is not None):
+                result = "\n".join(result)
+        elif (args.command == "track"):
+            if (args.all):
+                result = gps_track()
+            elif (args.last is not None):
+                result = gps_track(last=args.last)
+            else:
+                result = gps_track(start=args.between[0], end=args.between[1], points=args.points)
+            if (result is not None):
+                result = "\n".join(result)
+        elif (args.command == "camera"):
+            changes = dict([(key, getattr(args, key)) for key in CAMERA_SETTINGS if getattr(args, key) is not None])
+            if (changes):
+                result = get_camera_settings()  # Settings not on the command line stay as they are
+                if (result is not None):
+                    result = camera_settings() if set_camera_settings(**changes) else None
+            else:
+                result = get_camera_settings()
+            if (result is not None):
+                result = "\n".join(["%s=%d" % (key, result[key]) for key in CAMERA_SETTINGS])
+        elif (args.command == "time"):
+            result = time_sync()
+        elif (args.command == "ping"):
+            result = ping(args.count)
+        elif (args.command == "status"):
+            result = status()
+        elif (args.command == "angle"):
+            result = camera_angle(args.degrees)
+        elif (args.command == "reboot"):
+            result = reboot()
+        else:
+            result = shutdown()
+    finally:
+        ground.ser.close()
+        if (sys.stdout is not sys.stderr):
+            sys.stdout.close()
+        sys.stdout = out
+    if (result is None):
+        print("Failed, see the log for details", file=sys.stderr)
+        return 1
+    if (result is not True):
+        print(result)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
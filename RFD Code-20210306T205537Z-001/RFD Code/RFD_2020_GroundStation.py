@@ -20,33 +20,57 @@ import hashlib  # = generates hashes
 import subprocess
 import sys
 import PIL.Image  # = for image processing
-from PIL import ImageTk
-from tkinter import *
-import tkinter as tk
-from tkinter import messagebox
+from PIL import ImageDraw  # = draws the crop box while dragging
+import re  # = matching image names
+try:
+    from tkinter import *
+    import tkinter as tk
+    from tkinter import messagebox
+    from PIL import ImageTk
+except ImportError:
+    tk = None  # No Tk on this machine, only RFD_2020_GroundCLI can be used
 from array import array  # = for generating a byte array
 import os  # = ?? was required for io module to convert Image to bytes
 import io  # = creating a String or Byte Array of data (streaming images)
+import json  # = chunk manifests for resuming image downloads
+import threading  # = the I/O worker that owns the serial port while the Gui runs
+import queue
+from collections import OrderedDict  # = least recently shown images in the image cache
+import RFD_2020_Protocol as protocol  # = binary framing shared with the Pi
 
 #folder = "/Desktop/RFD Ground Station"
 folder ="/Desktop/RFD Ground Station/%s/" % time.strftime("%m%d%Y_%H%M%S")
-dir = os.path.dirname(folder)
-if (not os.path.exists(dir)):
-    os.makedirs(dir)
 
 # Serial Variables
-rfdport = "COM5"  # This is a computer dependent setting.
+rfdport = os.environ.get("RFD_PORT", "COM5")  # This is a computer dependent setting.
 # Open Device Manager to determine which port the RFD900 Modem is plugged into
+# Setting RFD_PORT runs against another port, ex. a pty from RFD_2020_LinkEmulator
 rfdbaud = 57600
 rfdtimeout = 5  # Sets the ser.read() timeout period, or when to continue in the
 # code when no data is received after the timeout period (in seconds)
 
 # Initializations
-ser = serial.Serial(port=rfdport, baudrate=rfdbaud, timeout=rfdtimeout)
+# The port and the Gui are only opened when this file is run as the ground station program, so the
+# command functions can be imported (ex. by RFD_2020_Benchmark) and pointed at another ser
+ser = None
+mGui = None
+worker = None  # IOWorker running the commands while the Gui is up, None runs them in the caller
+imagecache = None  # ImageCache of the images shown in the Gui
+strippaths = []  # Images on the thumbnail strip, in the order they were received
 wordlength = 10000  # Variable to determine spacing of checksum.
+transfermode = protocol.MODE_B64  # Image transfer mode agreed on with the Pi (command M)
+fecgroup = 0  # Binary frames per parity frame to ask the Pi for, 0 = no forward error correction
+progressive = 0  # 1 = ask the Pi for small previews of an image before the image itself
+compression = protocol.COMPRESS_ZDICT  # How the Pi should pack imagedata.txt, gpslog.txt and camera settings
+integrity = protocol.CHECK_CRC32  # Check at the end of every binary frame and blob, the whole image is checked by digest
+telemetry = 1  # 1 = ask the Pi to keep sending GPS, alerts and status while an image downloads
 imagedatasize = 10000
 extension = ".jpg"
 timeupdateflag = 0  # determines whether to update timevar on the camera settings
+displayedpath = ""  # Image currently shown in the main window
+cropstart = None  # Where the mouse was pressed to start dragging a crop box
+linkstats = {'syncs': 0}  # Totals since startup, see RFD_2020_Benchmark
+commandseq = 0  # Sequence number of the last framed command sent to the Pi
 
 # Camera Variables
 width = 650
@@ -58,12 +82,11 @@ saturation = 0  # Default = 0; range = (-100 to 100)
 iso = 400  # Default; range = (100 to 800)
 angle = 90 # Default; range = (45 to 135)
 
-file = open('camerasettings.txt', 'w')
-file.close()
-
 
 def updateslider():
     # Updates the slider values in the Gui
+    if (mGui is None):
+        return
     try:
         global width
         global height
@@ -173,70 +196,403 @@ def sendword(data, pos):
     # Sends the appropriately sized piece of the total picture encoding
     if (pos + wordlength < len(data)):  # Take a piece of size self.wordlength from the whole, and send it
         ser.write(data[pos:pos + wordlength])
-        print(data[pos:pos + wordlength])
         return
     else:  # If the self.wordlength is greater than the amount remaining, send everything left
         ser.write(data[pos:pos + len(data)])
-        print(data[pos:pos + len(data)])
         return
 
 
 def sync():
-    # Synchronizes the data stream between the ground station and the Pi
-    print("Attempting to Sync - This should take approx. 2 sec")
-    middleman = b''
-    sync = ''
-    addsync0 = ''
-    addsync1 = ''
-    addsync2 = ''
-    addsync3 = ''
-    while (sync != "sync"):
-        # Program is held until no data is being sent (timeout) or until the pattern 's' 'y' 'n' 'c' is found
-        middleman = ser.read()
-        addsync0 = middleman.decode('utf-8')
-        addsync0 = str(addsync0)
-        if (addsync0 == ''):
+    # Synchronizes the data stream between the ground station and the Pi, see the marks in RFD_2020_Protocol
+    # Returns True once the next byte read is the first one the Pi sent after the sync
+    print("Attempting to Sync")
+    linkstats['syncs'] += 1
+    timecheck = time.time()
+    # Program is held until no data is being sent (timeout) or until the Pi's sync mark is found
+    if (not protocol.find_mark(ser, protocol.SYNC_MARK)):
+        print("No sync mark from the Pi")
+        sys.stdout.flush()
+        return False
+    ser.write(protocol.SYNC_REPLY)  # Notifies sender that the receiving end is now synced
+    # Everything up to the Pi's end mark is left over from before the sync
+    if (not protocol.find_mark(ser, protocol.SYNC_END, exact=True)):
+        print("No sync end from the Pi")
+        sys.stdout.flush()
+        return False
+    print("System Match // Sync Time =", (time.time() - timecheck))
+    sys.stdout.flush()
+    return True
+
+
+def send_command(opcode, payload=b'', tries=3):
+    # Sends a framed command and waits for the Pi's reply to it, see RFD_2020_Protocol
+    # Only a reply with this command's seq counts, the command is sent again if the Pi says it arrived broken
+    # or nothing came back. Returns True once the Pi has taken the command
+    global commandseq
+    commandseq = (commandseq + 1) % protocol.SEQ_MODULO
+    frame = protocol.build_command(opcode, commandseq, payload)
+    for attempt in range(tries):
+        ser.write(frame)
+        reply = protocol.find_command(ser)
+        while ((reply is not None) and (reply.seq != commandseq)):
+            reply = protocol.find_command(ser)  # Left over from an earlier command, skip it
+        if (reply is None):
+            print("Waiting for Acknowledge")
+        elif (reply.opcode == protocol.REPLY_ACK):
+            return True  # Even with a bad check, an ack for this seq means the Pi is already running the command
+        elif ((reply.opcode == protocol.REPLY_UNKNOWN) and reply.checkOK):
+            print("The Pi doesn't know command", opcode.decode('utf-8'))
+            return False
+        else:
+            print("Command", opcode.decode('utf-8'), "was damaged on the way, sending it again")
+        sys.stdout.flush()
+    return False
+
+
+def negotiate_transfer_mode(mode, tries=3):
+    # Command M: Asks the Pi to send images in the given mode, stays with base64 if the Pi doesn't answer
+    # The Pi has switched by the time its answer comes back, so an answer that arrived broken means asking again
+    global transfermode
+    global fecgroup
+    global progressive
+    global compression
+    global integrity
+    global telemetry
+    if (integrity not in protocol.CHECKS):
+        integrity = protocol.CHECK_MD5  # Asked for xxh64 without the xxhash package
+    request = protocol.format_mode(mode, {'fec': fecgroup, 'progressive': progressive, 'compress': compression,
+                                          'check': integrity, 'telemetry': telemetry})
+    reply = None
+    for attempt in range(tries):
+        if (not send_command(b'M')):
+            print("No Acknowledge Received, using " + protocol.MODE_B64 + " image transfers")
+            transfermode = protocol.MODE_B64
+            integrity = protocol.CHECK_MD5
+            telemetry = 0
+            return
+        ser.write((request + '\n').encode('utf-8'))
+        line = ser.readline().decode('utf-8', 'replace').strip()
+        reply = protocol.parse_mode_reply(line)
+        if (reply is not None):
             break
-        sync = addsync3 + addsync2 + addsync1 + addsync0
-        addsync3 = addsync2
-        addsync2 = addsync1
-        addsync1 = addsync0
-    sync = ""
-    ser.write(b'S')
-    # Notifies sender that the receiving end is now synced
-    print("System Match")
-    time.sleep(0.5)
-
-    # Flush buffers to be ready
-    ser.flushInput()
-    ser.flushOutput()
+        print("Unreadable transfer mode answer:", line)
+        sys.stdout.flush()
+    if (reply is not None):
+        transfermode, options = reply
+        fecgroup = options['fec']
+        progressive = options['progressive']
+        compression = options['compress']
+        integrity = options['check']
+        telemetry = options['telemetry']
+    else:
+        transfermode = protocol.MODE_B64
+        fecgroup = 0
+        progressive = 0
+        compression = protocol.COMPRESS_NONE
+        integrity = protocol.CHECK_MD5
+        telemetry = 0
+    print("Image transfer mode:", transfermode, "// FEC group:", fecgroup, "// Progressive:", progressive,
+          "// Text compression:", compression, "// Frame check:", integrity, "// Telemetry:", telemetry)
+    sys.stdout.flush()
     return
 
 
+def load_manifest(savepath, size=None):
+    # Reads the manifest of verified chunks left behind by an interrupted download of savepath
+    # Returns (size, {offset: length}), or (size, {}) if there is none or it was for a different image size
+    try:
+        with open(savepath + ".manifest", "r") as fl:
+            manifest = json.load(fl)
+        if ((size is None) or (manifest["size"] == size)):
+            return manifest["size"], dict([(offset, length) for (offset, length) in manifest["received"]])
+    except:
+        pass
+    return size, {}
+
+
+def save_manifest(savepath, size, received):
+    # Writes the manifest of verified chunks so an interrupted download can be resumed
+    fl = open(savepath + ".manifest", "w")
+    json.dump({"size": size, "received": sorted(received.items())}, fl)
+    fl.close()
+
+
+def resume_request(imagepath):
+    # Builds the command 3 request for imagepath, asking only for the bytes a previous download missed
+    if (transfermode != protocol.MODE_BINARY):
+        return imagepath
+    size, received = load_manifest(imagepath)
+    if (not received):
+        return imagepath + '\n'
+    ranges = protocol.missing_ranges(received, size)
+    print("Resuming", imagepath, "at", protocol.format_ranges(ranges))
+    sys.stdout.flush()
+    return imagepath + protocol.REQUEST_SEPARATOR + protocol.format_ranges(ranges) + '\n'
+
+
+def receive_image_binary(savepath):
+    # Receives an image sent as raw bytes in windows of binary frames, see RFD_2020_Protocol for the layout
+    # Every window ends with a poll from the Pi, which gets answered with the frames that need resending
+    # Returns True if all of it arrived and passed the digest check
+    print("confirmed photo request")
+    sys.stdout.flush()
+    trycnt = 0
+    size = protocol.read_size(ser)
+    if (size is None):
+        print("No image size received")
+        sys.stdout.flush()
+        return
+    if (size == 0):
+        print("Nothing to receive")
+        sys.stdout.flush()
+        return
+    # Pick up the chunks an interrupted download of this image already verified
+    size, received = load_manifest(savepath, size)  # offset: length of every frame that passed its checksum
+    receivedbytes = sum(received.values())
+    finalstring = bytearray(size)
+    partpath = savepath + ".part"
+    if (received and os.path.exists(partpath)):
+        print("Resuming with", str(receivedbytes), "bytes already received")
+        partfile = open(partpath, "r+b")
+        previous = partfile.read(size)
+        finalstring[:len(previous)] = previous
+    else:
+        received = {}
+        receivedbytes = 0
+        partfile = open(partpath, "wb")
+    windowgood = set()  # seqs received intact since the last poll
+    windowparity = []  # parity groups received since the last poll
+    recovered = 0
+    while True:
+        frame = protocol.read_frame(ser, integrity)
+        if (frame is None):
+            # The poll was lost, the Pi sends the window again once it gives up on our ack
+            # No sync needed, read_frame finds the start of the next frame by its preamble
+            if (trycnt < 10):
+                trycnt += 1
+                print("try number:", str(trycnt))
+                print("\tpos @", str(receivedbytes))
+                sys.stdout.flush()
+                windowgood = set()
+                windowparity = []
+                continue
+            print("Out of tries, saving what we have")  # A partial image will render if enough data
+            break
+        if (not frame.checkOK):
+            print("\tbad frame", frame.seq)
+            continue
+        if (frame.frametype == protocol.FRAME_TELEMETRY):
+            receive_telemetry(frame.data)
+        elif (frame.frametype == protocol.FRAME_DATA):
+            length = len(frame.data)
+            if ((length > 0) and (frame.offset + length <= size)):
+                windowgood.add(frame.seq)
+                if (frame.offset not in received):
+                    finalstring[frame.offset:frame.offset + length] = frame.data
+                    partfile.seek(frame.offset)
+                    partfile.write(frame.data)
+                    received[frame.offset] = length
+                    receivedbytes += length
+        elif (frame.frametype == protocol.FRAME_PARITY):
+            windowparity.append(protocol.parse_parity(frame.data))
+        elif ((frame.frametype == protocol.FRAME_POLL) and cancelled()):
+            # Answering the poll with a stop frees the Pi straight away, what we have is kept for a resume
+            ser.write(protocol.build_stop(integrity))
+            partfile.flush()
+            print("Download cancelled, request it again to resume")
+            sys.stdout.flush()
+            break
+        elif (frame.frametype == protocol.FRAME_POLL):
+            # Rebuild any frame that is the only one missing from its parity group
+            for members, parity in windowparity:
+                missing = [member for member in members if member[0] not in windowgood]
+                if ((len(missing) == 1) and (missing[0][1] + missing[0][2] <= size)):
+                    seq, offset, length = missing[0]
+                    known = [finalstring[o:o + l] for (s, o, l) in members if s != seq]
+                    windowgood.add(seq)
+                    recovered += 1
+                    if (offset not in received):
+                        finalstring[offset:offset + length] = protocol.recover_from_parity(parity, known, length)
+                        partfile.seek(offset)
+                        partfile.write(finalstring[offset:offset + length])
+                        received[offset] = length
+                        receivedbytes += length
+            nacks = [seq for seq in protocol.unpack_seqs(frame.data) if seq not in windowgood]
+            windowgood = set()
+            windowparity = []
+            ser.write(protocol.build_ack(nacks, integrity))
+            # Everything acknowledged so far is on disk, so a dropped link or closed window can resume from here
+            partfile.flush()
+            save_manifest(savepath, size, received)
+            trycnt = 0
+            print("Current Receive Position: ", str(receivedbytes), " // Resend Requests: ", str(len(nacks)),
+                  " // FEC Recovered: ", str(recovered))
+            sys.stdout.flush()
+            status("%s: %d of %d kB" % (savepath, receivedbytes // 1024, size // 1024))
+            if ((receivedbytes >= size) and (not nacks)):
+                break
+    partfile.close()
+    # Only keep the image up to the first missing frame
+    end = 0
+    while (end in received):
+        end += received[end]
+    complete = False
+    if (end >= size) and (not cancelled()):
+        # Done, the resume files aren't needed anymore
+        complete = receive_file_digest(finalstring)
+        if (not complete):
+            print("Image failed its digest check, request it again for a fresh copy")
+        for leftover in (partpath, savepath + ".manifest"):
+            try:
+                os.remove(leftover)
+            except:
+                pass
+    else:
+        save_manifest(savepath, size, received)
+        print("Image incomplete, request it again to resume")
+    try:
+        fl = open(savepath, "wb")
+        fl.write(finalstring[:end])
+        fl.close()
+        show_image_name(savepath)
+    except:
+        print("Error with filename, saved as newimage" + extension)
+        sys.stdout.flush()
+        fl = open("newimage" + extension, "wb")
+        fl.write(finalstring[:end])
+        fl.close()
+
+    print("Image Saved")
+    sys.stdout.flush()
+    return complete
+
+
+def show_image_name(savepath):
+    # Puts the name of the image being saved above the image, when there is a window
+    if (mGui is not None):
+        gui(imagedisplay.set, savepath)
+
+
+def receive_telemetry(data):
+    # Shows and logs a telemetry frame that came in between the frames of an image
+    channel, text = protocol.parse_telemetry(data)
+    line = "%s: %s" % (protocol.CHANNEL_NAMES.get(channel, str(channel)), text.decode('utf-8', 'replace'))
+    print(line)
+    sys.stdout.flush()
+    try:
+        file = open("telemetry.txt", "a")
+        file.write(datetime.datetime.now().strftime("%m/%d/%Y %H:%M:%S") + " " + line + "\n")
+        file.close()
+        if (mGui is None):
+            return
+        if (channel == protocol.CHANNEL_GPS):
+            gui(gpsvar.set, "Last GPS: " + text.decode('utf-8', 'replace'))
+        elif (channel == protocol.CHANNEL_ALERT):
+            gui(alertvar.set, line)
+    except Exception as e:
+        print("Error logging telemetry:", str(e))
+
+
+def receive_file_digest(data):
+    # Waits for the digest frame that ends a binary transfer and checks the whole image against it
+    # If our last ack was lost the Pi sends its last window again first, so answer those polls with an empty ack
+    # A digest that arrives broken is not acked, so the Pi sends it again
+    trycnt = 0
+    while (trycnt < 10):
+        frame = protocol.read_frame(ser, integrity)
+        if (frame is None):
+            trycnt += 1
+            continue
+        if (not frame.checkOK):
+            continue
+        if (frame.frametype == protocol.FRAME_TELEMETRY):
+            receive_telemetry(frame.data)
+        elif (frame.frametype == protocol.FRAME_POLL):
+            ser.write(protocol.build_ack([], integrity))
+        elif (frame.frametype == protocol.FRAME_DIGEST):
+            ser.write(protocol.build_ack([], integrity))
+            if (frame.data == protocol.gen_file_digest(data)):
+                print("Image digest OK")
+                sys.stdout.flush()
+                return True
+            return False
+    print("No image digest received")
+    sys.stdout.flush()
+    return False
+
+
+def progressive_continue(stagepath):
+    # Asks the operator whether a progressive image is worth the rest of the download, always yes when headless
+    if (mGui is None):
+        return True
+    return messagebox.askyesno("Preview Received", message="A preview of the image has been received.\n"
+                                                          "Keep downloading the larger versions?")
+
+
+def receive_image_progressive(savepath):
+    # Receives the stages of a progressive image, showing each one as it lands
+    # Returns the path of the best version received and True if that is the whole image, complete
+    shownpath = savepath
+    while True:
+        header = ser.read(protocol.STAGE_HEADER.size)
+        if (len(header) < protocol.STAGE_HEADER.size):
+            print("No stage header received")
+            sys.stdout.flush()
+            return shownpath, False
+        stage, stages = protocol.STAGE_HEADER.unpack(header)
+        if (stage >= stages - 1):
+            return savepath, receive_image_binary(savepath)
+        print("Receiving preview", stage + 1, "of", stages - 1)
+        shownpath = "%s_stage%d.jpg" % (os.path.splitext(savepath)[0], stage + 1)
+        receive_image_binary(shownpath)
+        show_image(shownpath)
+        if ((not cancelled()) and ask_gui(progressive_continue, shownpath)):
+            ser.write(protocol.STAGE_CONTINUE)
+        else:
+            ser.write(protocol.STAGE_STOP)
+            print("Image stopped after preview", stage + 1)
+            sys.stdout.flush()
+            return shownpath, False
+
+
 def receive_image(savepath, wordlength):
+    # Receives an image in the transfer mode agreed on with the Pi, returns the path of the image to display
+    # and True if all of the image arrived (a partial one is still saved, and shown)
+    if (transfermode == protocol.MODE_BINARY):
+        if (progressive):
+            return receive_image_progressive(savepath)
+        return savepath, receive_image_binary(savepath)
     print("confirmed photo request")  # Notifies User we have entered the receiveimage() module
     sys.stdout.flush()
     # Module Specific Variables
     trycnt = 0  # Initializes the checksum timeout (timeout value is not set here)
     finalstring = b''  # Initializes the data string so that the += function can be used
+    # The Pi runs an identical controller off the same Y/N answers, so word sizes always match
+    wordcontrol = protocol.ChunkController(wordlength, maximum=wordlength)
     done = False  # Initializes the end condition
+    complete = False  # Only once the Pi has run out of image to send, not when we gave up or were cancelled
     # Retrieve Data Loop (Will end when on timeout)
     while (not done):
         print("Current Receive Position: ", str(len(finalstring)))
+        status("%s: %d kB" % (savepath, len(finalstring) // 1024))
+        if (cancelled()):
+            print("Download cancelled")
+            break
         checktheirs = ""
         checktheirs = ser.read(32)  # Asks first for checksum.
         checktheirs = checktheirs.decode('utf-8')
         # Checksum is asked for first so that if data is less than wordlength, it won't error out the checksum data
-        word = ser.read(wordlength)  # Retrieves characters,
-        # wholes total string length is predetermined by variable wordlength
+        word = ser.read(wordcontrol.getSize())  # Retrieves characters,
+        # wholes total string length is set by the chunk controller both ends share
         checkours = gen_checksum(word)  # Retrieves a checksum based on the received data string
         # CHECKSUM gen_checksum(word, checktheirs
         if (checkours != checktheirs):
             if (trycnt < 10):  # This line sets the maximum number of checksum resend attempts.
                 # Ex. trycnt = 5 will attempt to receive data 5 times before failing
-                # #I've found that the main cause of checksum errors is a bit drop or add desync, this adds a 2
-                # second delay and resyncs both systems
+                # #I've found that the main cause of checksum errors is a bit drop or add desync, this resyncs
+                # both systems
                 ser.write(b'N')
+                wordcontrol.restart()
                 trycnt += 1
                 print("try number:", str(trycnt))
                 print("\tresend last")  # This line is mostly used for troubleshooting,
@@ -254,18 +610,21 @@ def receive_image(savepath, wordlength):
         else:
             trycnt = 0
             ser.write(b'Y')
+            wordcontrol.update(1, 0)
             finalstring += word
         if (word == ""):
             done = True
             break
         if (checktheirs == ""):
             done = True
+            complete = (len(finalstring) > 0)  # Nothing at all means the Pi had no such image
             break
     try:  # This will attempt to save the image as the given filename,
         # if it for some reason errors out, the image will go to the except line
         b64_to_image(finalstring, savepath)
-        imagedisplay.set(savepath)
+        show_image_name(savepath)
     except:
+        complete = False
         print("Error with filename, saved as newimage" + extension)
         sys.stdout.flush()
         b64_to_image(finalstring, "newimage" + extension)
@@ -273,31 +632,86 @@ def receive_image(savepath, wordlength):
 
     print("Image Saved")
     sys.stdout.flush()
+    return savepath, complete
+
 
+def show_image(path):
+    # Shows an image from a command function. The decoding and shrinking is done here, on the I/O worker,
+    # so the Tk thread only has to hand the cached copy to the label
+    if (mGui is None):
+        return  # Headless, the image is only saved
+    imagecache.display(path)
+    imagecache.thumbnail(path)
+    gui(displayImage, path)
 
-def mostRecentImage():
-    # Command 1: Download most recent image
-    global im
+
+def displayImage(path):
+    # Shows an image in the main window and adds it to the thumbnail strip
     global photo
     global tmplabel
     global reim
-    ser.write(b'1')
-    killtime = 0
-    while (ser.read() != b'A'):  # Waiting for Pi to acknowledge
-        print("Waiting for Acknowledge")
-        sys.stdout.flush()
-        ser.write(b'1')
-        killtime += 1
-        if(killtime == 10):
-            print("No Acknowledge Received. Please try again")
-            return
+    global displayedpath
+    if (mGui is None):
+        return  # Headless, the image is only saved
+    display = imagecache.display(path)
+    if (display is None):
+        return
+    displayedpath = path
+    reim = display
+    photo = imagecache.photo(path)
+    tmplabel.configure(image=photo)
+    tmplabel.pack(fill=BOTH, expand=1)
+    updateStrip(path)
+    mGui.update_idletasks()
+
+
+def updateStrip(path=None):
+    # Adds path to the end of the thumbnail strip if it isn't on it yet and redraws the strip,
+    # with a box around the image being shown. Clicking a thumbnail shows that image
+    added = (path is not None) and (path not in strippaths)
+    if (added):
+        strippaths.append(path)
+    stripcanvas.delete(ALL)
+    thumbwidth, thumbheight = imagecache.thumbsize
+    x = 2
+    for shown in list(strippaths):
+        thumb = imagecache.thumbphoto(shown)
+        if (thumb is None):
+            strippaths.remove(shown)  # Deleted since it was received
+            continue
+        item = stripcanvas.create_image(x, 2, image=thumb, anchor=NW)
+        stripcanvas.tag_bind(item, "<Button-1>", lambda event, shown=shown: displayImage(shown))
+        if (shown == displayedpath):
+            stripcanvas.create_rectangle(x - 1, 1, x + thumbwidth, thumbheight + 2, outline="red", width=2)
+        x += thumbwidth + 4
+    stripcanvas.config(scrollregion=(0, 0, x, thumbheight + 4))
+    if (added):
+        stripcanvas.xview_moveto(1.0)
+
+
+def flipImage(event, step):
+    # Left and Right arrow keys: shows the image before or after the one shown on the thumbnail strip
+    if (isinstance(event.widget, Entry) or (not strippaths)):
+        return  # Moving the cursor in a text box
+    if (displayedpath in strippaths):
+        index = min(max(strippaths.index(displayedpath) + step, 0), len(strippaths) - 1)
+    else:
+        index = len(strippaths) - 1
+    displayImage(strippaths[index])
+
+
+def mostRecentImage(imagepath=""):
+    # Command 1: Download most recent image, saved as imagepath + extension or under the Pi's name if imagepath is ""
+    # Returns the path of the image received, None if the Pi didn't answer or the image didn't arrive whole
+    if (not send_command(b'1')):  # Waiting for Pi to acknowledge
+        print("No Acknowledge Received. Please try again")
+        return
     sendfilename = b''
     temp = 0
     while (temp <= 14):
         sendfilename += ser.read()
         temp += 1
     sendfilename = sendfilename.decode('utf-8')
-    imagepath = imagename.get()
     if (imagepath == ""):
         try:
             if (sendfilename[0] == "i"):
@@ -311,67 +725,196 @@ def mostRecentImage():
         imagepath = (imagepath + extension)
     
     print("Image will be saved as:", imagepath)
-    messagebox.showinfo("In Progress..", message="Image request received.\nImage will be saved as " + imagepath)
+    status("Image request received, saving as " + imagepath)
     timecheck = time.time()
     sys.stdout.flush()
-    receive_image(str(imagepath), wordlength)
-    im = PIL.Image.open(str(imagepath))
-    reim = im.resize((650, 450), PIL.Image.ANTIALIAS)
-    photo = ImageTk.PhotoImage(reim)
-    tmplabel.configure(image=photo)
-    tmplabel.pack(fill=BOTH, expand=1)
+    imagepath, complete = receive_image(str(imagepath), wordlength)
+    show_image(imagepath)
     print("Receive Time =", (time.time() - timecheck))
     sys.stdout.flush()
-    return
+    if (not complete):
+        print("Image incomplete")
+        return
+    return imagepath
 
 
-def imageData():
-    # Command 2: Requests the imagedata.txt file that shows all images taken during current flight
+def requestCrop(box):
+    # Command C: Requests a region of the full resolution version of the displayed image
+    # box is (left, top, right, bottom) in fractions of the displayed image
+    match = re.match(r"(image\d{4})_b(_stage\d+)?\.jpg$", os.path.basename(displayedpath))
+    if (match is None):
+        messagebox.showinfo("Crop", message="Crops can only be requested from a received _b" + extension + " image")
+        return
+    name = match.group(1) + "_a.png"
     try:
-        listbox.delete(0, END)
+        scale = max(int(cropscale.get()), 1)
     except:
-        print("Failed to delete Listbox, window may have been destroyed")
+        scale = 1
+    imagepath = "%s_crop_%s.jpg" % (match.group(1), str(datetime.datetime.now().strftime("%H%M%S")))
+    queue_job("Crop of " + name, receive_crop, name, box, scale, imagepath)
+
+
+def receive_crop(name, box, scale, imagepath):
+    # Command C: Sends the crop request and saves the region the Pi sends back as imagepath
+    # Returns imagepath, None if no crop was received
+    if (not send_command(b'C')):
+        print("No Acknowledge Received. Please try again")
+        return
+    request = protocol.format_crop(name, box, scale)
+    ser.write((request + '\n').encode('utf-8'))
+    print("Crop requested:", request)
+    print("Crop will be saved as:", imagepath)
+    sys.stdout.flush()
+    timecheck = time.time()
+    # Crops never come in progressive stages
+    if (transfermode == protocol.MODE_BINARY):
+        complete = receive_image_binary(imagepath)
+    else:
+        complete = receive_image(imagepath, wordlength)[1]
+    print("Receive Time =", (time.time() - timecheck))
+    sys.stdout.flush()
+    if (not complete):
+        print("No crop received")
+        return
+    show_image(imagepath)
+    return imagepath
+
+
+def cropbox(start, end):
+    # Turns two mouse positions on the image label into a box in pixels of the displayed image
+    offsetx = (tmplabel.winfo_width() - reim.size[0]) // 2
+    offsety = (tmplabel.winfo_height() - reim.size[1]) // 2
+    xs = sorted([min(max(x - offsetx, 0), reim.size[0]) for x in (start[0], end[0])])
+    ys = sorted([min(max(y - offsety, 0), reim.size[1]) for y in (start[1], end[1])])
+    return xs[0], ys[0], xs[1], ys[1]
+
+
+def cropPress(event):
+    # Starts dragging a crop box on the displayed image
+    global cropstart
+    cropstart = (event.x, event.y)
+
+
+def cropDrag(event):
+    # Draws the crop box while it is being dragged
+    global photo
+    if (cropstart is None):
+        return
+    boxed = reim.copy()
+    ImageDraw.Draw(boxed).rectangle(cropbox(cropstart, (event.x, event.y)), outline="red")
+    photo = ImageTk.PhotoImage(boxed)
+    tmplabel.configure(image=photo)
+
+
+def cropRelease(event):
+    # Finishes a crop box and offers to request that region of the full resolution image
+    global cropstart
+    global photo
+    if (cropstart is None):
+        return
+    left, top, right, bottom = cropbox(cropstart, (event.x, event.y))
+    cropstart = None
+    photo = imagecache.photo(displayedpath) if displayedpath else ImageTk.PhotoImage(reim)
+    tmplabel.configure(image=photo)
+    if ((right - left < 5) or (bottom - top < 5)):
+        return  # Just a click
+    box = (left / reim.size[0], top / reim.size[1], right / reim.size[0], bottom / reim.size[1])
+    if (messagebox.askyesno("Crop Request", message="Request this region of the full resolution image?")):
+        requestCrop(box)
+
+
+def request_blob(opcode, request=None, tries=3):
+    # Sends a command (and its request line, if it takes one) until the blob it answers with arrives whole,
+    # returns the blob's bytes, None if it never did. A broken blob can't be patched, so the whole thing is asked
+    # for again
+    for attempt in range(tries):
+        if (not send_command(opcode)):
+            print("No Acknowledge Received. Please try again")
+            sys.stdout.flush()
+            return None
+        if (request is not None):
+            ser.write((request + '\n').encode('utf-8'))
+        data = protocol.read_blob(ser, integrity)
+        if (data is not None):
+            return data
+        print("Error receiving compressed text, asking for it again")
         sys.stdout.flush()
-    ser.write(b'2')
-    while (ser.read() != b'A'):
-        print("Waiting for Acknowledge")
+        ser.reset_input_buffer()  # Whatever is left of the broken blob
+    return None
+
+
+def request_blob_lines(opcode, tries=3):
+    # Commands 2, 4 and G with compression on: Asks for a text file, returns its lines as bytes, None if it
+    # never arrived whole
+    data = request_blob(opcode, tries=tries)
+    if (data is None):
+        return None
+    return data.splitlines(True)
+
+
+def receive_image_data(datafilepath):
+    # Command 2: Requests the imagedata.txt file, saves it as datafilepath.txt and returns its lines as bytes
+    # An empty list if it didn't arrive, datafilepath.txt is only replaced once it has
+    lines = None
+    if (compression != protocol.COMPRESS_NONE):
+        lines = request_blob_lines(b'2')
+        if (lines is None):
+            return []
+    elif (not send_command(b'2')):
+        print("No Acknowledge Received. Please try again")
         sys.stdout.flush()
-        ser.write(b'2')
+        return []
     try:
-        datafilepath = datafilename.get()
-        if (datafilepath == ""):
-            datafilepath = "imagedata"
         file = open(datafilepath + ".txt", "w")
     except:
         print("Error with opening file")
         sys.stdout.flush()
-        return
+        return []
     sys.stdin.flush()
-    timecheck = time.time()
-    temp = ser.readline()
-    while (temp != b''):
-        file.write(temp.decode('utf-8'))
+    if (lines is not None):
+        for temp in lines:
+            file.write(temp.decode('utf-8'))
+    else:
+        lines = []
+        temp = ser.readline()
+        while (temp != b''):
+            file.write(temp.decode('utf-8'))
+            lines.append(temp)
+            temp = ser.readline()
+    file.close()
+    return lines
+
+
+def imageData():
+    # Command 2: Shows the imagedata.txt file that lists all images taken during current flight
+    try:
+        listbox.delete(0, END)
+    except:
+        print("Failed to delete Listbox, window may have been destroyed")
+        sys.stdout.flush()
+    datafilepath = datafilename.get()
+    if (datafilepath == ""):
+        datafilepath = "imagedata"
+    queue_job("imagedata.txt", receive_image_data, datafilepath, done=showImageData)
+    return
+
+
+def showImageData(lines):
+    # Puts the lines of a received imagedata.txt in the image selection window
+    for temp in lines:
         try:
             listbox.insert(0, temp)
         except:
             print("error adding items")
             break
-        temp = ser.readline()
-    file.close()
     print("File Received, Attempting Listbox Update")
     sys.stdin.flush()
     subGui.lift()
-    subGui.mainloop()
     return
 
 
 def requestedImage():
     # Command 3: request specific image
-    global im
-    global photo
-    global tmplabel
-    global reim
-    random = 0
     item = map(int, listbox.curselection())
     try:
         data = listbox.get(ACTIVE)
@@ -386,58 +929,135 @@ def requestedImage():
                                                                  "\n Are you sure you want to continue?\n"
                                                                  "This download could take 15+ min.",
                                         icon="warning")
-        if (result == 'yes'):
-            ser.write(b'3')
-            while (ser.read() != b'A'):
-                print("Waiting for Acknowledge")
-                sys.stdout.flush()
-                random += 1
-                if (random > 5):
-                    return
-            imagepath = data
-            ser.write(data.encode('utf-8'))
-            timecheck = time.time()
-            messagebox.showinfo("In Progress...",
-                                message="Image request received.\nImage will be saved as " + imagepath)
-            print("Image will be saved as:", imagepath)
-            sys.stdout.flush()
-            receive_image(str(imagepath), wordlength)
-            im = PIL.Image.open(imagepath)
-            reim = im.resize((650, 450), PIL.Image.ANTIALIAS)
-            photo = ImageTk.PhotoImage(reim)
-            tmplabel.configure(image=photo)
-            tmplabel.pack(fill=BOTH, expand=1)
-            print("Receive Time =", (time.time() - timecheck))
+        if (result != 'yes'):
             return
-        else:
-            return
-    else:
-        ser.write(b'3')
-        while (ser.read() != b'A' and random < 5):
-            print("Waiting for Acknowledge")
-            sys.stdout.flush()
-            random += 1
-            if (random == 5):
-                return
-        imagepath = data
-        ser.write(data.encode('utf-8'))
-        timecheck = time.time()
-        messagebox.showinfo("In Progress...",
-                            message="Image request received.\nImage will be saved as " + imagepath)
-        print("Image will be saved as:", imagepath)
-        sys.stdout.flush()
-        receive_image(str(imagepath), wordlength)
-        im = PIL.Image.open(imagepath)
-        reim = im.resize((650, 450), PIL.Image.ANTIALIAS)
-        photo = ImageTk.PhotoImage(reim)
-        tmplabel.configure(image=photo)
-        tmplabel.pack(fill=BOTH, expand=1)
-        print("Receive Time =", (time.time() - timecheck))
+    queue_job(data, receive_requested_image, data)
+    return
+
+
+def receive_requested_image(imagepath):
+    # Command 3: Downloads imagepath from the Pi, or the part of it an earlier download missed
+    # Returns the path of the image received, None if the Pi didn't answer or the image didn't arrive whole
+    if (not send_command(b'3')):
+        print("No Acknowledge Received. Please try again")
+        return
+    ser.write(resume_request(imagepath).encode('utf-8'))
+    timecheck = time.time()
+    status("Image request received, saving as " + imagepath)
+    print("Image will be saved as:", imagepath)
+    sys.stdout.flush()
+    imagepath, complete = receive_image(str(imagepath), wordlength)
+    show_image(imagepath)
+    print("Receive Time =", (time.time() - timecheck))
+    if (not complete):
+        print("Image incomplete, request it again to resume")
         return
+    return imagepath
+
+
+def image_names(lines):
+    # The image names in the lines of an imagedata.txt, in the order they were taken
+    names = []
+    for line in lines:
+        if (isinstance(line, bytes)):
+            line = line.decode('utf-8', 'replace')
+        fields = line.split(',')[0].split()
+        if (fields):
+            names.append(fields[0])
+    return names
+
+
+def missing_images(names, fullres=False):
+    # The names that aren't completely on disk yet, every _b image first and then the _a.png ones if fullres
+    wanted = [name for name in names if name.endswith("_b" + extension)]
+    if (fullres):
+        wanted += [name for name in names if name.endswith("_a.png")]
+    return [name for name in wanted if (not os.path.exists(name)) or os.path.exists(name + ".manifest")]
+
+
+def fetch_new_images(fullres=False):
+    # Downloads every image in the Pi's imagedata.txt that isn't on disk yet, _a.png ones too if fullres
+    # Returns the paths received, None if the image list couldn't be read
+    lines = receive_image_data("imagedata")
+    if (not lines):
+        return None
+    names = missing_images(image_names(lines), fullres)
+    print(len(names), "new images:", " ".join(names))
+    sys.stdout.flush()
+    if (not names):
+        return []
+    if (transfermode != protocol.MODE_BINARY):
+        # Base64 has no batches, so ask for them one at a time
+        received = []
+        for name in names:
+            if (cancelled()):
+                break
+            if (receive_requested_image(name) is not None):
+                received.append(name)
+        return received
+    return receive_batch(names)
+
+
+def receive_batch(names):
+    # Command B: Asks for all of names at once and receives them as they stream in, see RFD_2020_Protocol
+    # Images already partly on disk are resumed. Returns the paths received whole, None if the Pi didn't answer
+    if (not send_command(b'B')):
+        print("No Acknowledge Received. Please try again")
+        return None
+    requests = "".join([resume_request(name) for name in names])
+    protocol.write_blob(ser, requests.encode('utf-8'), compression, integrity)
+    timecheck = time.time()
+    received = []
+    index = 0  # The image expected next
+    while (not cancelled()):
+        frame = protocol.read_frame(ser, integrity)
+        if (frame is None):
+            print("Batch timed out")
+            break
+        if (frame.frametype == protocol.FRAME_TELEMETRY):
+            if (frame.checkOK):
+                receive_telemetry(frame.data)
+            continue
+        if (frame.frametype in (protocol.FRAME_POLL, protocol.FRAME_DIGEST)):
+            # Our last ack of the image before went missing, answer it again
+            if (frame.checkOK):
+                ser.write(protocol.build_ack([], integrity))
+            continue
+        if ((frame.frametype != protocol.FRAME_NAME) and
+                (frame.checkOK or (frame.frametype in protocol.FRAME_TYPES))):
+            print("Lost our place in the batch, request it again to pick up from here")
+            break
+        if (frame.checkOK):
+            if (frame.data == b''):
+                break  # End of the batch
+            index = frame.seq
+        # A broken name frame (or a header too broken to tell) is still the next image in the list
+        if (index >= len(names)):
+            break
+        name = names[index]
+        status("Batch image %d of %d: %s" % (index + 1, len(names), name))
+        print("Batch image", index + 1, "of", len(names), ":", name)
+        sys.stdout.flush()
+        if (receive_image_binary(name)):
+            received.append(name)
+            if (name.endswith("_b" + extension)):
+                show_image(name)
+        index += 1
+    print("Received", len(received), "of", len(names), "images // Batch Time =", (time.time() - timecheck))
+    sys.stdout.flush()
+    return received
+
+
+def showFetched(paths):
+    # Tells the operator how a fetch of new images went
+    if (paths is None):
+        statusvar.set("Couldn't get the image list")
+    else:
+        statusvar.set("%d new images received" % len(paths))
 
 
 def retrieveCameraSettings():
-    # Command 4: Retrieve the current camera settings from the Pi
+    # Command 4: Retrieve the current camera settings from the Pi, returns True once they are saved and shown
     global width
     global height
     global sharpness
@@ -448,13 +1068,16 @@ def retrieveCameraSettings():
     global timeupdateflag
     print("Retrieving Camera Settings")
     try:
-        killtime = time.time() + 10
-        ser.write(b'4')
-        while ((ser.read() != b'A') & (time.time() < killtime)):
-            print("Waiting for Acknowledge")
-            ser.write(b'4')
         timecheck = time.time()
-        messagebox.showinfo("In Progress..", message="Downloading Settings")
+        lines = None
+        if (compression != protocol.COMPRESS_NONE):
+            lines = request_blob_lines(b'4')
+            if (lines is None):
+                return
+        elif (not send_command(b'4')):
+            print("No Acknowledge Received. Please try again")
+            return
+        status("Downloading Settings")
         try:
             file = open("camerasettings.txt", "w")
             print("File Successfully Created")
@@ -462,11 +1085,14 @@ def retrieveCameraSettings():
             print("Error with opening file")
             sys.stdout.flush()
             return
-        timecheck = time.time()
-        temp = b'Y'
-        while (temp != b""):
-            temp = ser.read()
-            file.write(temp.decode('utf-8'))
+        if (lines is not None):
+            for temp in lines:
+                file.write(temp.decode('utf-8'))
+        else:
+            temp = b'Y'
+            while (temp != b""):
+                temp = ser.read()
+                file.write(temp.decode('utf-8'))
         file.close()
         print("Receive Time =", (time.time() - timecheck))
         sys.stdout.flush()
@@ -494,7 +1120,8 @@ def retrieveCameraSettings():
         print("iso = ", iso)
         file.close()
         timeupdateflag = 1
-        updateslider()
+        gui(updateslider)
+        return True
     except:
         print("Camera Setting Retrieval Error")
     return
@@ -516,6 +1143,12 @@ def uploadCameraSettings():
     contrast = contrastslide.get()
     saturation = saturationslide.get()
     iso = isoslide.get()
+    save_camera_settings()
+    queue_job("Camera settings", send_camera_settings)
+
+
+def save_camera_settings():
+    # Writes the camera settings to camerasettings.txt, ready for send_camera_settings
     file = open("camerasettings.txt", "w")
     file.write(str(width) + "\n")
     file.write(str(height) + "\n")
@@ -525,16 +1158,15 @@ def uploadCameraSettings():
     file.write(str(saturation) + "\n")
     file.write(str(iso) + "\n")
     file.close()
-    ser.write(b'5')
-    killtime = 0
-    while (ser.read() != b'A'):
-        print("Waiting for Acknowledge")
-        killtime += 1
-        if (killtime > 10):
-            print("Acknowledge not received")
-            return
+
+
+def send_camera_settings():
+    # Command 5: Sends camerasettings.txt to the Pi, returns True once the Pi has taken them
+    if (not send_command(b'5')):
+        print("Acknowledge not received")
+        return
     timecheck = time.time()
-    messagebox.showinfo("In Progress..", message="Downloading Settings")
+    status("Uploading Settings")
     try:
         file = open("camerasettings.txt", "r")
     except:
@@ -556,23 +1188,18 @@ def uploadCameraSettings():
             return
     print("Send Time =", (time.time() - timecheck))
     sys.stdout.flush()
-    return
+    return True
 
 
 def time_sync():
-    # Command T: Syncs the time between the ground station and the pi
+    # Command T: Syncs the time between the ground station and the pi, then returns connectiontest(10)
 
     ser.flushInput()
-    ser.write(b'T')
-    termtime = time.time() + 10
     temp = b''
-    while (ser.read() != b'T'):
-        print("Waiting for Acknowledge")
-        ser.write(b'T')
-        if (termtime < time.time()):
-            print("No Acknowledge Received, Connection Error")
-            sys.stdout.flush()
-            return
+    if (not send_command(b'T')):
+        print("No Acknowledge Received, Connection Error")
+        sys.stdout.flush()
+        return
     localtime = str(datetime.datetime.now().strftime("%m/%d/%Y %H:%M:%S"))
     killtime = 0
     for x in localtime:
@@ -588,21 +1215,15 @@ def time_sync():
     print("##################################\nRaspb Time = %s\nLocal Time = %s\n##################################"
           % (rasptime, localtime))
     sys.stdin.flush()
-    connectiontest(10)
-    return
+    return connectiontest(10)
 
 
 def connectiontest(numping):
-    # Command P: Sends pings to Pi and returns the pingtime
-    ser.write(b'P')
-    termtime = time.time() + 20
-    while (ser.read() != b'P'):
-        print("Waiting for Acknowledge")
-        ser.write(b'P')
-        if (termtime < time.time()):
-            print("No Acknowledge Received, Connection Error")
-            sys.stdout.flush()
-            return
+    # Command P: Sends pings to Pi and returns the pingtime, None if the Pi stopped answering
+    if (not send_command(b'P')):
+        print("No Acknowledge Received, Connection Error")
+        sys.stdout.flush()
+        return
     avg = 0
     ser.write(b'P')
     temp = ""
@@ -626,32 +1247,35 @@ def connectiontest(numping):
     avg = avg / numping
     print("Ping Response Time = " + str(avg)[0:4] + " seconds")
     sys.stdout.flush()
-    return
+    return avg
 
 
 def getGPSfile():
-    # Command G: Asks for Pi GPS log
-    ser.write(b'G')
-    killtime = 0
-    while (ser.read() != b'A'):
-        print("Waiting for Acknowledge")
-        sys.stdout.flush()
-        ser.write(b'G')
-        killtime += 1
-        if (killtime > 10):
-            print("No Acknowledge Received")
-            return
+    # Command G: Asks for Pi GPS log, returns True once it is saved as gpslog.txt
+    # gpslog.txt is only replaced once the new one has arrived
     timecheck = time.time()
+    lines = None
+    if (compression != protocol.COMPRESS_NONE):
+        lines = request_blob_lines(b'G')
+        if (lines is None):
+            return
+    elif (not send_command(b'G')):
+        print("No Acknowledge Received")
+        return
     try:
         file = open("gpslog.txt", "w")
     except:
         print("Error with opening file")
         sys.stdout.flush()
         return
-    timecheck = time.time()
     sys.stdin.flush()
     termtime = time.time() + 90
-    temp = ser.readline()
+    if (lines is not None):
+        for temp in lines:
+            file.write(temp.decode('utf-8'))
+        temp = b""
+    else:
+        temp = ser.readline()
     while (temp != b""):
         file.write(temp.decode('utf-8'))
         temp = ser.readline()
@@ -663,29 +1287,92 @@ def getGPSfile():
     print("GPSfile.txt saved to local folder")
     print("Receive Time =", (time.time() - timecheck))
     sys.stdout.flush()
-    return
+    return True
+
+
+def remove_files(paths):
+    # Deletes the ones of paths that are there
+    for path in paths:
+        if (os.path.exists(path)):
+            os.remove(path)
+
+
+def receive_track(opcode, request, name):
+    # Commands L and W: Sends a track query, saves the fixes the Pi sends back as name.txt and returns its
+    # "time,lat,lon,alt,sats" lines, time in seconds since 1970 UTC. None if nothing came back
+    timecheck = time.time()
+    if (transfermode == protocol.MODE_BINARY):
+        # A whole flight takes minutes, so it comes in windows of frames like an image and a hit frame is all that
+        # has to be sent again
+        if (not send_command(opcode)):
+            print("No Acknowledge Received")
+            return
+        ser.write((request + '\n').encode('utf-8'))
+        savepath = name + ".trk"
+        leftovers = (savepath, savepath + ".part", savepath + ".manifest")
+        remove_files(leftovers)  # From another query, not something to resume
+        data = None
+        if (receive_image_binary(savepath)):
+            file = open(savepath, "rb")
+            data = protocol.unpack_text(file.read())
+            file.close()
+        remove_files(leftovers)  # Only gpstrack.txt is kept
+    else:
+        data = request_blob(opcode, request)
+    points = protocol.decode_track(data) if data is not None else None
+    if (points is None):
+        print("Error receiving the track")
+        sys.stdout.flush()
+        return
+    text = protocol.format_track(points)
+    lines = text.splitlines()
+    try:
+        file = open(name + ".txt", "w")
+        file.write(text)
+        file.close()
+    except:
+        print("Error saving", name + ".txt")
+    print(len(lines), "fixes in", len(data), "bytes saved to", name + ".txt")
+    print("Receive Time =", (time.time() - timecheck))
+    sys.stdout.flush()
+    return lines
+
+
+def gps_track_last(count, name="gpstrack"):
+    # Command L: The newest count fixes of the Pi's track
+    return receive_track(b'L', str(int(count)), name)
+
+
+def gps_track_between(start, end, points=0, name="gpstrack"):
+    # Command W: The Pi's fixes from time start to end (seconds since 1970 UTC), at most points of them spread
+    # evenly through that time. 0 points for every fix
+    return receive_track(b'W', "%.2f,%.2f,%d" % (start, end, points), name)
+
+
+def gps_track_all(name="gpstrack"):
+    # Command W: Every fix of the flight so far
+    return receive_track(b'W', "0,inf,0", name)
 
 
 def reboot_pi():
     # Command R: Reboots Pi
-    ser.write(b'R')
-    while (ser.read() != b'A'):
-        print("Waiting for Acknowledge")
-        ser.write(b'R')
+    if (not send_command(b'R', b'R')):  # The second R confirms it
+        print("No Acknowledge Received")
+        return
     print("Pi rebooting. See you soon!")
-    return
+    return True
 
 
 def device_status():
-    # Command D: Gets status of Camera and GPS if the RFD is working
-    ser.write(b'D')
-    while (ser.read() != b'A'):
-        print("Waiting for Acknowledge")
-        ser.write(b'D')
+    # Command D: Gets status of Camera and GPS if the RFD is working, returns the status line
+    if (not send_command(b'D')):
+        print("No Acknowledge Received")
+        return
     try:
-        status = ser.readline()
-        print(status.decode('utf-8'))
+        status = ser.readline().decode('utf-8')
+        print(status)
         time.sleep(2)
+        return status
     except:
         print("Error with device status")
         sys.stdout.flush()
@@ -694,29 +1381,22 @@ def device_status():
 
 def shutdown_pi():
     # Command Q: Shuts down the pi. Used once recovered to help ensure no sd card corruption
-    ser.write(b'Q')
-    while (ser.read() != b'A'):
-        print("Waiting for Acknowledge")
-        ser.write(b'Q')
+    if (not send_command(b'Q', b'Q')):  # The second Q confirms it
+        print("No Acknowledge Received")
+        return
     print("Pi is powering off. See you back at home base!")
-    return
+    return True
 
 
-def set_camera_angle():
-    # Command H: Lets you select camera angle based on slider
+def set_camera_angle(slider):
+    # Command H: Points the camera at the angle picked on the slider
     global angle
-    ser.write(b'H')
-    killtime = 0
     temp = ''
-    while (ser.read() != b'A'):
-        print("Waiting for Acknowledge")
-        #ser.write(b'H')
-        killtime += 1
-        if (killtime > 10):
-            print("No Acknowledge Received")
-            return
+    if (not send_command(b'H')):
+        print("No Acknowledge Received")
+        return
     try:
-        angle = angleslide.get()
+        angle = slider
         temp = angle
         angle = int(angle * 4.4444 + 1300)
         angle = str(angle)
@@ -735,8 +1415,8 @@ def set_camera_angle():
             print("No Acknowledge Received, Pi failed to adjust Angle")
             return
     print("Pi Has Successfully adjusted Camera Angle")
-    updateslider()
-    return
+    gui(updateslider)
+    return True
 
 
 class Unbuffered:
@@ -756,243 +1436,562 @@ class Unbuffered:
         self.stream.close()
 
 
+class ImageCache:
+    # Display sized copies of the images shown in the Gui, so showing one again doesn't decode and shrink it again.
+    # The newest capacity display sized images are kept in memory, thumbnails are also saved in thumbdir so they
+    # survive a restart. Everything is keyed by path and modification time, so an image that is resumed or
+    # received again is reloaded. display() and thumbnail() can be used from any thread, photo() and
+    # thumbphoto() make Tk images and only from the Tk thread
+    def __init__(self, capacity=24, size=(650, 450), thumbsize=(96, 66), thumbdir="thumbs", thumbcapacity=500):
+        self.capacity = capacity
+        self.size = size
+        self.thumbsize = thumbsize
+        self.thumbdir = thumbdir
+        self.thumbcapacity = thumbcapacity
+        self.images = OrderedDict()  # (path, mtime) -> {'display': PIL image, 'photo': PhotoImage}
+        self.thumbs = OrderedDict()  # (path, mtime) -> {'thumb': PIL image, 'photo': PhotoImage}
+        self.lock = threading.Lock()
+
+    def key(self, path):
+        # The cache key of path, None if there is no such file
+        try:
+            return (os.path.abspath(path), os.stat(path).st_mtime_ns)
+        except OSError:
+            return None
+
+    def cached(self, table, capacity, key, field, make):
+        # The field of the entry for key in table, made with make() if it isn't there yet
+        with self.lock:
+            entry = table.get(key)
+            if (entry is not None):
+                table.move_to_end(key)
+                if (field in entry):
+                    return entry[field]
+        value = make()  # Outside the lock, decoding takes a while
+        with self.lock:
+            for stale in [k for k in table if (k[0] == key[0]) and (k != key)]:
+                del table[stale]  # An older copy of the same file
+            table.setdefault(key, {})[field] = value
+            table.move_to_end(key)
+            while (len(table) > capacity):
+                table.popitem(last=False)
+        return value
+
+    def shrink(self, path, size):
+        # Decodes path straight to about size where the format allows it (JPEG decodes at 1/2, 1/4 or 1/8 scale)
+        # and resizes it the rest of the way, others are box reduced first then resized
+        image = PIL.Image.open(path)
+        image.draft('RGB', size)
+        return image.convert('RGB').resize(size, PIL.Image.LANCZOS, reducing_gap=2.0)
+
+    def display(self, path):
+        # path shrunk to the size of the image window, None if it can't be read
+        key = self.key(path)
+        if (key is None):
+            print("Can't show", path, ", no such file")
+            return None
+        try:
+            return self.cached(self.images, self.capacity, key, 'display', lambda: self.shrink(path, self.size))
+        except (OSError, ValueError) as e:
+            print("Can't show", path, ":", e)
+            sys.stdout.flush()
+            return None
+
+    def photo(self, path):
+        # The display sized image as a Tk image
+        key = self.key(path)
+        display = self.display(path)
+        if ((key is None) or (display is None)):
+            return None
+        return self.cached(self.images, self.capacity, key, 'photo', lambda: ImageTk.PhotoImage(display))
+
+    def thumbpath(self, key):
+        return os.path.join(self.thumbdir, "%s_%d.png" % (os.path.basename(key[0]), key[1]))
+
+    def makethumb(self, path, key):
+        # Loads the thumbnail of path from thumbdir, or makes and saves it
+        thumbpath = self.thumbpath(key)
+        if (os.path.exists(thumbpath)):
+            try:
+                return PIL.Image.open(thumbpath).convert('RGB')
+            except (OSError, ValueError):
+                pass  # Broken, make it again
+        with self.lock:
+            display = self.images.get(key, {}).get('display')
+        if (display is not None):
+            thumb = display.resize(self.thumbsize, PIL.Image.LANCZOS)
+        else:
+            thumb = self.shrink(path, self.thumbsize)
+        try:
+            if (not os.path.exists(self.thumbdir)):
+                os.makedirs(self.thumbdir)
+            for old in os.listdir(self.thumbdir):
+                if (old.startswith(os.path.basename(key[0]) + "_")):
+                    os.remove(os.path.join(self.thumbdir, old))  # Thumbnail of an older copy
+            thumb.save(thumbpath)
+        except OSError as e:
+            print("Couldn't save the thumbnail of", path, ":", e)
+            sys.stdout.flush()
+        return thumb
+
+    def thumbnail(self, path):
+        # The thumbnail of path, None if it can't be read
+        key = self.key(path)
+        if (key is None):
+            return None
+        try:
+            return self.cached(self.thumbs, self.thumbcapacity, key, 'thumb', lambda: self.makethumb(path, key))
+        except (OSError, ValueError) as e:
+            print("Can't make a thumbnail of", path, ":", e)
+            sys.stdout.flush()
+            return None
+
+    def thumbphoto(self, path):
+        # The thumbnail as a Tk image
+        key = self.key(path)
+        thumb = self.thumbnail(path)
+        if ((key is None) or (thumb is None)):
+            return None
+        return self.cached(self.thumbs, self.thumbcapacity, key, 'photo', lambda: ImageTk.PhotoImage(thumb))
+
+
+class IOWorker(threading.Thread):
+    # Owns ser while the Gui runs. The buttons queue jobs here instead of reading the port in the Tk callback,
+    # so the window keeps drawing during a download. A job hands anything it wants shown back with post(),
+    # the Tk thread runs those from pump() every 100 ms
+    def __init__(self, root):
+        threading.Thread.__init__(self)
+        self.name = "ioWorker"
+        self.daemon = True
+        self.root = root
+        self.jobs = queue.Queue()  # (name, function, args, done) waiting for the port
+        self.posted = queue.Queue()  # (callback, args) waiting for the Tk thread
+        self.cancelled = threading.Event()  # Set to stop the running job at its next chance
+        self.current = None  # Name of the job using the port
+
+    def submit(self, name, function, args=(), done=None):
+        # Queues a job, done(result) is run on the Tk thread once it finishes
+        self.jobs.put((name, function, args, done))
+        self.showQueue()
+
+    def waiting(self):
+        # Names of the queued jobs, without taking them off the queue
+        with self.jobs.mutex:
+            return [job[0] for job in self.jobs.queue]
+
+    def cancel(self):
+        # Drops everything queued and stops the running job
+        while (not self.jobs.empty()):
+            try:
+                self.jobs.get_nowait()
+            except queue.Empty:
+                break
+        if (self.current is not None):
+            self.cancelled.set()
+        self.showQueue()
+
+    def post(self, callback, *args):
+        self.posted.put((callback, args))
+
+    def ask(self, callback, *args):
+        # Runs callback on the Tk thread and waits for what it returns, for questions to the operator
+        answer = []
+        answered = threading.Event()
+
+        def askNow():
+            try:
+                answer.append(callback(*args))
+            finally:
+                answered.set()
+        self.post(askNow)
+        answered.wait()
+        return answer[0] if answer else None
+
+    def pump(self):
+        # Runs everything the jobs have posted, on the Tk thread
+        while True:
+            try:
+                callback, args = self.posted.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                callback(*args)
+            except Exception as e:
+                print("Gui update error:", str(e))
+        self.root.after(100, self.pump)
+
+    def showQueue(self):
+        # Shows the running and queued jobs under the command buttons
+        text = "Running: " + (self.current if self.current is not None else "nothing")
+        waiting = self.waiting()
+        if (waiting):
+            text += " // Queued: " + ", ".join(waiting)
+        queuevar.set(text)
+
+    def drain(self):
+        # The Pi doesn't know a job was cancelled, so wait out what it still sends before the next job
+        status("Cancelled, waiting for the Pi to stop sending")
+        end = time.time() + 120
+        while ((ser.read(4096) != b'') and (time.time() < end)):
+            pass
+        status("Cancelled")
+
+    def run(self):
+        while True:
+            name, function, args, done = self.jobs.get()
+            self.current = name
+            self.cancelled.clear()
+            self.post(self.showQueue)
+            result = None
+            try:
+                result = function(*args)
+            except Exception as e:
+                print("Error in " + name + ":", str(e))
+            sys.stdout.flush()
+            if (self.cancelled.is_set()):
+                print(name, "cancelled")
+                self.drain()
+            elif (done is not None):
+                self.post(done, result)
+            self.current = None
+            self.post(self.showQueue)
+
+
+def queue_job(name, function, *args, done=None):
+    # Runs a command function on the I/O worker when the Gui is up, straight away otherwise
+    if (worker is None):
+        result = function(*args)
+        if (done is not None):
+            done(result)
+        return
+    worker.submit(name, function, args, done)
+
+
+def gui(callback, *args):
+    # Runs a Gui update from a command function, on the Tk thread if the function is running on the I/O worker
+    if ((worker is None) or (threading.current_thread() is not worker)):
+        return callback(*args)
+    worker.post(callback, *args)
+
+
+def ask_gui(callback, *args):
+    # Like gui(), but waits for the answer
+    if ((worker is None) or (threading.current_thread() is not worker)):
+        return callback(*args)
+    return worker.ask(callback, *args)
+
+
+def status(text):
+    # Shows how the current job is going
+    if (mGui is not None):
+        gui(statusvar.set, text)
+
+
+def cancelled():
+    # True once the operator has cancelled the running job, transfers check this between frames
+    return (worker is not None) and worker.cancelled.is_set()
+
+
 # ##############################################Contructs the GUI ######################################################
 
-mGui = Tk()
-mGui.iconbitmap(default="bc.ico")
-imagename = StringVar()
-datafilename = StringVar()
-imagedisplay = StringVar()
-pingcount = StringVar()
-
-widthvar = StringVar()
-heightvar = StringVar()
-sharpnessvar = StringVar()
-brightnessvar = StringVar()
-contrastvar = StringVar()
-saturationvar = StringVar()
-isovar = StringVar()
-anglevar = StringVar()
-timevar = StringVar()
-logfile = open('runtimedata.txt','w')
-logfile.close()
-logfile = open('runtimedata.txt','a')
-sys.stdout = Unbuffered(sys.stdout)
-
-
-mGui.geometry("1300x550+30+30")
-mGui.title("Montana Space Grant Consortium BOREALIS Program")
-
-mlabel = Label(text="RFD900 Interface V8.0", fg='grey', font="Verdana 10 bold")
-mlabel.pack()
-
-cmdtitle = Label(text="Command Module", font="Verdana 12 bold")
-cmdtitle.place(x=30, y=20)
-
-imagetitle = Label(textvariable=imagedisplay, font="Verdana 12 bold")
-imagetitle.place(x=300, y=20)
-
-frame = Frame(master=mGui, width=665, height=465, borderwidth=5, bg="black", colormap="new")
-frame.place(x=295, y=45)
-im = PIL.Image.open('MSGC2.jpg')
-reim = im.resize((650, 450), PIL.Image.ANTIALIAS)
-photo = ImageTk.PhotoImage(reim)
-tmplabel = Label(master=frame, image=photo)
-tmplabel.pack(fill=BOTH, expand=1)
-
-# Cmd1 Gui - Request Most Recent Image
-cmd1button = Button(mGui, text="Most Recent Photo", command= mostRecentImage)
-cmd1button.place(x=150, y=65)
-
-cmd1label = Label(text="Image Save Name : Default = image_XXXX_b" + extension,
-                  font="Verdana 6 italic")
-cmd1label.place(x=10, y=50)
-
-imagename = Entry(mGui, textvariable=imagename)
-imagename.place(x=10, y=70)
-
-# Cmd2 Gui - Request text file on imagedata.txt
-cmd2button = Button(mGui, text="Request 'imagedata.txt'", command=imageData)
-cmd2button.place(x=150, y=115)
-
-datafilename = Entry(mGui, textvariable=datafilename)
-datafilename.place(x=10, y=120)
-
-cmd2label = Label(text="Data File Save Name: Default = imagedata.txt", font="Verdana 6 italic")
-cmd2label.place(x=10, y=100)
-
-# Cmd3 Gui - Request specific image
-subGui = Tk()
-subGui.iconbitmap(default="bc.ico")
-listbox = Listbox(subGui, selectmode=BROWSE, font="Vernada 10")
-subGuibutton = Button(subGui, text="Request Selected Image", command=requestedImage)
-direction = Label(master=subGui, text="Click on the image you would like to request",
-                  font="Vernada 12 bold")
-subGui.geometry("620x400+20+20")
-subGui.title("Image Data and Selection")
-direction.pack()
-scrollbar = Scrollbar(subGui)
-scrollbar.pack(side=RIGHT, fill=Y)
-listbox.pack(side=TOP, fill=BOTH, expand=1)
-subGuibutton.pack()
-listbox.config(yscrollcommand=scrollbar.set)
-scrollbar.config(command=listbox.yview)
-
-
-def subGuiconfirm():
-    if messagebox.askokcancel("W A R N I N G", message="You cannot reopen this window.\n Are you sure you "
-                                                       "want to close it?", icon="warning"):
-        subGui.destroy()
-subGui.protocol('WM_DELETE_WINDOW', subGuiconfirm)
-
-# Cmd4 and Cmd 5 Gui - Camera Settings
-camedge = Frame(mGui, height=330, width=250, background="black", borderwidth=3)
-camedge.place(x=1000, y=50)
-camframe = Frame(camedge, height=50, width=40)
-camframe.pack(fill=BOTH, expand=1)
-
-cambot = Frame(camframe, borderwidth=1)
-cambot.pack(side=BOTTOM, fill=X, expand=1)
-camleft = Frame(camframe)
-camleft.pack(side=LEFT, fill=BOTH, expand=2)
-camright = Frame(camframe)
-camright.pack(side=RIGHT, fill=BOTH, expand=2)
-
-widthslide = Scale(camleft, from_=1, to=2592, orient=HORIZONTAL)
-widthslide.set(width)
-widthslide.pack()
-
-widlabel = Label(master=camright, textvariable=widthvar, font="Verdana 8")
-widlabel.pack(pady=19)
-
-heightslide = Scale(camleft, from_=1, to=1944, orient=HORIZONTAL)
-heightslide.set(height)
-heightslide.pack()
-heilabel = Label(master=camright, textvariable=heightvar, font="Verdana 8")
-heilabel.pack(pady=5)
-
-sharpnessslide = Scale(camleft, from_=-100, to=100, orient=HORIZONTAL)
-sharpnessslide.set(sharpness)
-sharpnessslide.pack()
-shalabel = Label(master=camright, textvariable=sharpnessvar, font="Verdana 8")
-shalabel.pack(pady=18)
-
-brightnessslide = Scale(camleft, from_=0, to=100, orient=HORIZONTAL)
-brightnessslide.set(brightness)
-brightnessslide.pack()
-brilabel = Label(master=camright, textvariable=brightnessvar, font="Verdana 8")
-brilabel.pack(pady=5)
-
-contrastslide = Scale(camleft, from_=-100, to=100, orient=HORIZONTAL)
-contrastslide.set(contrast)
-contrastslide.pack()
-conlabel = Label(master=camright, textvariable=contrastvar, font="Verdana 8")
-conlabel.pack(pady=18)
-
-saturationslide = Scale(camleft, from_=-100, to=100, orient=HORIZONTAL)
-saturationslide.set(saturation)
-saturationslide.pack()
-satlabel = Label(master=camright, textvariable=saturationvar, font="Verdana 8")
-satlabel.pack(pady=5)
-
-isoslide = Scale(camleft, from_=100, to=800, orient=HORIZONTAL)
-isoslide.set(iso)
-isoslide.pack()
-isolabel = Label(master=camright, textvariable=isovar, font="Verdana 8")
-isolabel.pack(pady=18)
-
-angleslide = Scale(camleft, from_= 45, to=135, orient=HORIZONTAL)
-angleslide.set(angle)
-angleslide.pack()
-anglelabel = Label(master=camright, textvariable=anglevar, font="Verdana 8")
-anglelabel.pack(pady=5)
-
-cmd4button = Button(cambot, text="Get Current Settings", command=retrieveCameraSettings,
-                    borderwidth=2, background="white", font="Verdana 10")
-cmd4button.grid(row=1, column=1)
-
-cmd5button = Button(cambot, text="Send New Settings", command=uploadCameraSettings,
-                    borderwidth=2, background="white", font="Verdana 10")
-cmd5button.grid(row=1, column=0)
-
-defaultbutton = Button(cambot, text="Default Settings", command=reset_cam, borderwidth=2,
-                       background="white", font="Verdana 10", width=20)
-defaultbutton.grid(row=0, columnspan=2, pady=5)
-
-timelabel = Label(master=mGui, textvariable=timevar, font="Verdana 8")
-timelabel.place(x=1020, y=27)
-
-updateslider()
-
-# Cmd 6 - Gui setup for connection testing
-conbutton = Button(mGui, text="Connection Test", command=time_sync,
-                   borderwidth=2, font="Verdana 10", width=25)
-conbutton.place(x=25, y=490)
-
-# Cmd 7 - Gui setup for raspberry GPS file retrieval
-gpsbutton = Button(mGui, text="Download Pi GPS Data", command=getGPSfile,
-                     borderwidth=2, font="Verdana 10", width=25)
-gpsbutton.place(x=25, y=520)
-
-# Command selection gui config
-commands = Frame(mGui, height=80, width=290, background="light gray", borderwidth=3)
-commands.place(x=1002, y=465)
-select_label = Label(master=commands, font="Verdana 10 bold", text="Commands:")
-select_label.grid(row=0, columnspan=2, padx=30)
-
-# command buttons
-angle_button = Button(master=commands, text="      Angle       ", bg="light gray",
-                     command=set_camera_angle)
-angle_button.grid(row=1, padx=30)
-
-device_button = Button(master=commands, text="Device Status", bg="light gray",
-                       command=device_status)
-device_button.grid(row=2, padx=30)
-
-reset_button = Button(master=commands, text=" Shutdown Pi ", bg="light gray",
-                      command=shutdown_pi)
-reset_button.grid(row=1, column=1, padx=30)
-
-reboot_button = Button(master=commands, text="   Reboot Pi    ", bg="light gray",
-                       command=reboot_pi)
-reboot_button.grid(row=2, column=1, padx=30)
-
-# Final Setup. Here we go
-
-rframe = Frame(mGui, height=40, width=35)
-runlistbox = Listbox(rframe, selectmode=BROWSE, font="Vernada 8", width=35, height=20)
-runscrollbar = Scrollbar(rframe)
-runlistbox.config(yscrollcommand=runscrollbar.set)
-runscrollbar.config(command=runlistbox.yview)
-runscrollbar.pack(side=RIGHT, fill=Y)
-runlistbox.pack(side=LEFT, fill=Y)
-rframe.place(x=10, y=165)
-
-
-def callback():
-    global runlistbox
-    global mGui
-    try:
-        runlistbox.delete(0, END)
-    except:
-        print("Failed to delete Listbox")
-    print(str(datetime.datetime.now().strftime("%m/%d/%Y %H:%M:%S")))
-    sys.stdout.flush()
-    for line in reversed(list(open("runtimedata.txt"))):
-        runlistbox.insert(END, line.rstrip())
-    mGui.after(5000, callback)
-    return
+if __name__ == "__main__":
+    dir = os.path.dirname(folder)
+    if (not os.path.exists(dir)):
+        os.makedirs(dir)
+    ser = serial.Serial(port=rfdport, baudrate=rfdbaud, timeout=rfdtimeout)
+    file = open('camerasettings.txt', 'w')
+    file.close()
 
+    mGui = Tk()
+    mGui.iconbitmap(default="bc.ico")
+    imagename = StringVar()
+    datafilename = StringVar()
+    imagedisplay = StringVar()
+    pingcount = StringVar()
+
+    widthvar = StringVar()
+    heightvar = StringVar()
+    sharpnessvar = StringVar()
+    brightnessvar = StringVar()
+    contrastvar = StringVar()
+    saturationvar = StringVar()
+    isovar = StringVar()
+    anglevar = StringVar()
+    timevar = StringVar()
+    gpsvar = StringVar()
+    alertvar = StringVar()
+    statusvar = StringVar()
+    queuevar = StringVar()
+    logfile = open('runtimedata.txt','w')
+    logfile.close()
+    logfile = open('runtimedata.txt','a')
+    sys.stdout = Unbuffered(sys.stdout)
+
+
+    mGui.geometry("1300x680+30+30")
+    mGui.title("Montana Space Grant Consortium BOREALIS Program")
+
+    mlabel = Label(text="RFD900 Interface V8.0", fg='grey', font="Verdana 10 bold")
+    mlabel.pack()
+
+    cmdtitle = Label(text="Command Module", font="Verdana 12 bold")
+    cmdtitle.place(x=30, y=20)
+
+    imagetitle = Label(textvariable=imagedisplay, font="Verdana 12 bold")
+    imagetitle.place(x=300, y=20)
+
+    frame = Frame(master=mGui, width=665, height=465, borderwidth=5, bg="black", colormap="new")
+    frame.place(x=295, y=45)
+    imagecache = ImageCache()
+    reim = imagecache.display('MSGC2.jpg')
+    photo = imagecache.photo('MSGC2.jpg')
+    tmplabel = Label(master=frame, image=photo)
+    tmplabel.pack(fill=BOTH, expand=1)
+    tmplabel.bind("<ButtonPress-1>", cropPress)
+    tmplabel.bind("<B1-Motion>", cropDrag)
+    tmplabel.bind("<ButtonRelease-1>", cropRelease)
+
+    # Cmd C Gui - Drag a box on the image to request that region at full resolution
+    croplabel = Label(text="Drag a box on a _b" + extension + " image to request that region of the full resolution "
+                           "image. Crop Downscale:", font="Verdana 6 italic")
+    croplabel.place(x=300, y=517)
+    cropscale = Entry(mGui, width=4)
+    cropscale.insert(0, "1")
+    cropscale.place(x=790, y=515)
+
+    # Cmd1 Gui - Request Most Recent Image
+    cmd1button = Button(mGui, text="Most Recent Photo",
+                        command=lambda: queue_job("Most recent image", mostRecentImage, imagename.get()))
+    cmd1button.place(x=150, y=65)
+
+    cmd1label = Label(text="Image Save Name : Default = image_XXXX_b" + extension,
+                      font="Verdana 6 italic")
+    cmd1label.place(x=10, y=50)
+
+    imagename = Entry(mGui, textvariable=imagename)
+    imagename.place(x=10, y=70)
+
+    # Cmd2 Gui - Request text file on imagedata.txt
+    cmd2button = Button(mGui, text="Request 'imagedata.txt'", command=imageData)
+    cmd2button.place(x=150, y=115)
+
+    datafilename = Entry(mGui, textvariable=datafilename)
+    datafilename.place(x=10, y=120)
+
+    cmd2label = Label(text="Data File Save Name: Default = imagedata.txt", font="Verdana 6 italic")
+    cmd2label.place(x=10, y=100)
+
+    # Cmd3 Gui - Request specific image
+    subGui = Tk()
+    subGui.iconbitmap(default="bc.ico")
+    listbox = Listbox(subGui, selectmode=BROWSE, font="Vernada 10")
+    subGuibutton = Button(subGui, text="Request Selected Image", command=requestedImage)
+    direction = Label(master=subGui, text="Click on the image you would like to request",
+                      font="Vernada 12 bold")
+    subGui.geometry("620x400+20+20")
+    subGui.title("Image Data and Selection")
+    direction.pack()
+    scrollbar = Scrollbar(subGui)
+    scrollbar.pack(side=RIGHT, fill=Y)
+    listbox.pack(side=TOP, fill=BOTH, expand=1)
+    subGuibutton.pack()
+    listbox.config(yscrollcommand=scrollbar.set)
+    scrollbar.config(command=listbox.yview)
+
+
+    def subGuiconfirm():
+        if messagebox.askokcancel("W A R N I N G", message="You cannot reopen this window.\n Are you sure you "
+                                                           "want to close it?", icon="warning"):
+            subGui.destroy()
+    subGui.protocol('WM_DELETE_WINDOW', subGuiconfirm)
+
+    # Cmd4 and Cmd 5 Gui - Camera Settings
+    camedge = Frame(mGui, height=330, width=250, background="black", borderwidth=3)
+    camedge.place(x=1000, y=50)
+    camframe = Frame(camedge, height=50, width=40)
+    camframe.pack(fill=BOTH, expand=1)
+
+    cambot = Frame(camframe, borderwidth=1)
+    cambot.pack(side=BOTTOM, fill=X, expand=1)
+    camleft = Frame(camframe)
+    camleft.pack(side=LEFT, fill=BOTH, expand=2)
+    camright = Frame(camframe)
+    camright.pack(side=RIGHT, fill=BOTH, expand=2)
+
+    widthslide = Scale(camleft, from_=1, to=2592, orient=HORIZONTAL)
+    widthslide.set(width)
+    widthslide.pack()
+
+    widlabel = Label(master=camright, textvariable=widthvar, font="Verdana 8")
+    widlabel.pack(pady=19)
+
+    heightslide = Scale(camleft, from_=1, to=1944, orient=HORIZONTAL)
+    heightslide.set(height)
+    heightslide.pack()
+    heilabel = Label(master=camright, textvariable=heightvar, font="Verdana 8")
+    heilabel.pack(pady=5)
+
+    sharpnessslide = Scale(camleft, from_=-100, to=100, orient=HORIZONTAL)
+    sharpnessslide.set(sharpness)
+    sharpnessslide.pack()
+    shalabel = Label(master=camright, textvariable=sharpnessvar, font="Verdana 8")
+    shalabel.pack(pady=18)
+
+    brightnessslide = Scale(camleft, from_=0, to=100, orient=HORIZONTAL)
+    brightnessslide.set(brightness)
+    brightnessslide.pack()
+    brilabel = Label(master=camright, textvariable=brightnessvar, font="Verdana 8")
+    brilabel.pack(pady=5)
+
+    contrastslide = Scale(camleft, from_=-100, to=100, orient=HORIZONTAL)
+    contrastslide.set(contrast)
+    contrastslide.pack()
+    conlabel = Label(master=camright, textvariable=contrastvar, font="Verdana 8")
+    conlabel.pack(pady=18)
+
+    saturationslide = Scale(camleft, from_=-100, to=100, orient=HORIZONTAL)
+    saturationslide.set(saturation)
+    saturationslide.pack()
+    satlabel = Label(master=camright, textvariable=saturationvar, font="Verdana 8")
+    satlabel.pack(pady=5)
+
+    isoslide = Scale(camleft, from_=100, to=800, orient=HORIZONTAL)
+    isoslide.set(iso)
+    isoslide.pack()
+    isolabel = Label(master=camright, textvariable=isovar, font="Verdana 8")
+    isolabel.pack(pady=18)
+
+    angleslide = Scale(camleft, from_= 45, to=135, orient=HORIZONTAL)
+    angleslide.set(angle)
+    angleslide.pack()
+    anglelabel = Label(master=camright, textvariable=anglevar, font="Verdana 8")
+    anglelabel.pack(pady=5)
+
+    cmd4button = Button(cambot, text="Get Current Settings",
+                        command=lambda: queue_job("Camera settings", retrieveCameraSettings),
+                        borderwidth=2, background="white", font="Verdana 10")
+    cmd4button.grid(row=1, column=1)
+
+    cmd5button = Button(cambot, text="Send New Settings", command=uploadCameraSettings,
+                        borderwidth=2, background="white", font="Verdana 10")
+    cmd5button.grid(row=1, column=0)
+
+    defaultbutton = Button(cambot, text="Default Settings", command=reset_cam, borderwidth=2,
+                           background="white", font="Verdana 10", width=20)
+    defaultbutton.grid(row=0, columnspan=2, pady=5)
+
+    timelabel = Label(master=mGui, textvariable=timevar, font="Verdana 8")
+    timelabel.place(x=1020, y=27)
+
+    # Telemetry sent by the Pi in between image frames
+    gpslabel = Label(master=mGui, textvariable=gpsvar, font="Verdana 8")
+    gpslabel.place(x=1000, y=395)
+    alertlabel = Label(master=mGui, textvariable=alertvar, font="Verdana 8", fg="red")
+    alertlabel.place(x=1000, y=420)
 
-def mGuicloseall():
-    subGui.destroy()
-    mGui.destroy()
-    ser.close()
-    print("Program Terminated")
-    sys.stdout.close()
-    return
+    updateslider()
+
+    # Cmd 6 - Gui setup for connection testing
+    conbutton = Button(mGui, text="Connection Test", command=lambda: queue_job("Connection test", time_sync),
+                       borderwidth=2, font="Verdana 10", width=25)
+    conbutton.place(x=25, y=490)
+
+    # Cmd 7 - Gui setup for raspberry GPS file retrieval
+    gpsbutton = Button(mGui, text="Download Pi GPS Data", command=lambda: queue_job("gpslog.txt", getGPSfile),
+                         borderwidth=2, font="Verdana 10", width=25)
+    gpsbutton.place(x=25, y=520)
+
+    # Command selection gui config
+    commands = Frame(mGui, height=80, width=290, background="light gray", borderwidth=3)
+    commands.place(x=1002, y=465)
+    select_label = Label(master=commands, font="Verdana 10 bold", text="Commands:")
+    select_label.grid(row=0, columnspan=2, padx=30)
+
+    # command buttons
+    angle_button = Button(master=commands, text="      Angle       ", bg="light gray",
+                         command=lambda: queue_job("Camera angle", set_camera_angle, angleslide.get()))
+    angle_button.grid(row=1, padx=30)
+
+    device_button = Button(master=commands, text="Device Status", bg="light gray",
+                           command=lambda: queue_job("Device status", device_status))
+    device_button.grid(row=2, padx=30)
+
+    reset_button = Button(master=commands, text=" Shutdown Pi ", bg="light gray",
+                          command=lambda: queue_job("Shutdown", shutdown_pi))
+    reset_button.grid(row=1, column=1, padx=30)
+
+    reboot_button = Button(master=commands, text="   Reboot Pi    ", bg="light gray",
+                           command=lambda: queue_job("Reboot", reboot_pi))
+    reboot_button.grid(row=2, column=1, padx=30)
+
+    # Fetch every image the Pi has that isn't on disk yet, in one batch
+    fullresvar = IntVar()
+    fetchbutton = Button(mGui, text="Fetch New Images", borderwidth=2, font="Verdana 10", width=16,
+                         command=lambda: queue_job("New images", fetch_new_images, fullresvar.get() == 1,
+                                                   done=showFetched))
+    fetchbutton.place(x=25, y=460)
+    fullrescheck = Checkbutton(mGui, text="+ _a.png", variable=fullresvar, font="Verdana 8")
+    fullrescheck.place(x=185, y=462)
+
+    # Serial jobs - what the I/O worker is doing, how far along it is, and a way to stop it
+    queuelabel = Label(master=mGui, textvariable=queuevar, font="Verdana 8")
+    queuelabel.place(x=300, y=545)
+    statuslabel = Label(master=mGui, textvariable=statusvar, font="Verdana 8")
+    statuslabel.place(x=300, y=565)
+    cancelbutton = Button(mGui, text="Cancel", command=lambda: worker.cancel(), font="Verdana 8")
+    cancelbutton.place(x=900, y=545)
+
+    # Thumbnails of the images received, click one or use the arrow keys to flip through them
+    stripcanvas = Canvas(mGui, width=660, height=imagecache.thumbsize[1] + 4, background="black",
+                         highlightthickness=0)
+    stripcanvas.place(x=300, y=590)
+    stripscrollbar = Scrollbar(mGui, orient=HORIZONTAL, command=stripcanvas.xview)
+    stripscrollbar.place(x=300, y=662, width=660)
+    stripcanvas.config(xscrollcommand=stripscrollbar.set)
+    mGui.bind("<Left>", lambda event: flipImage(event, -1))
+    mGui.bind("<Right>", lambda event: flipImage(event, 1))
+
+    # Final Setup. Here we go
+
+    rframe = Frame(mGui, height=40, width=35)
+    runlistbox = Listbox(rframe, selectmode=BROWSE, font="Vernada 8", width=35, height=20)
+    runscrollbar = Scrollbar(rframe)
+    runlistbox.config(yscrollcommand=runscrollbar.set)
+    runscrollbar.config(command=runlistbox.yview)
+    runscrollbar.pack(side=RIGHT, fill=Y)
+    runlistbox.pack(side=LEFT, fill=Y)
+    rframe.place(x=10, y=165)
+
+
+    def callback():
+        global runlistbox
+        global mGui
+        try:
+            runlistbox.delete(0, END)
+        except:
+            print("Failed to delete Listbox")
+        print(str(datetime.datetime.now().strftime("%m/%d/%Y %H:%M:%S")))
+        sys.stdout.flush()
+        for line in reversed(list(open("runtimedata.txt"))):
+            runlistbox.insert(END, line.rstrip())
+        mGui.after(5000, callback)
+        return
+
+
+    def mGuicloseall():
+        worker.cancel()
+        subGui.destroy()
+        mGui.destroy()
+        ser.close()
+        print("Program Terminated")
+        sys.stdout.close()
+        return
 
-mGui.protocol('WM_DELETE_WINDOW', mGuicloseall)
-mGui.after(1000, time_sync())
-callback()
-mGui.mainloop()
+    mGui.protocol('WM_DELETE_WINDOW', mGuicloseall)
+    worker = IOWorker(mGui)
+    worker.start()
+    worker.pump()
+    queue_job("Connection test", time_sync)
+    queue_job("Transfer mode", negotiate_transfer_mode, protocol.MODE_BINARY)
+    callback()
+    mGui.mainloop()
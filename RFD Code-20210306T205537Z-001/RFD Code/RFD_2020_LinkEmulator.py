@@ -0,0 +1,316 @@
+#####################################################################################
+#   RFD900 link emulator for testing RFD_2020_PayloadPi and RFD_2020_GroundStation  #
+#   without radios. Models the 57600 baud air rate, half duplex turnaround,         #
+#   latency, dropped bytes and flipped bits. Constructed for MSGC Borealis program. #
+#                                                                                   #
+#   Python Version: 3.7.6                                                           #
+#                                                                                   #
+#   Two ways to use it:                                                             #
+#     In one program: pi, ground = make_pair(LinkModel(...)) gives two objects     #
+#       that read and write like serial.Serial                                      #
+#     Between the two programs (Linux/Mac): python RFD_2020_LinkEmulator.py         #
+#       prints two pty paths, start each program with RFD_PORT set to one of them  #
+#                                                                                   #
+#####################################################################################
+
+import time
+import threading
+import random
+import math
+import os
+import sys
+import select
+import argparse
+from collections import deque
+
+PI_TO_GROUND = 0
+GROUND_TO_PI = 1
+SEGMENT = 32  # Bytes delivered together, about 5 ms of air time at 57600 baud
+
+
+class LinkModel:
+    # The settings of the emulated link
+    # baud: air rate, each byte takes 10 bits (start, 8 data, stop)
+    # latency: seconds from the end of a byte on the air to it arriving on the other side
+    # turnaround: seconds lost every time the link changes direction (half duplex)
+    # drop: chance that any one byte never arrives
+    # ber: chance that any one bit arrives flipped
+    # txbuffer: bytes a write can get ahead of the air before it blocks, like a real port's transmit buffer
+    # speed: runs the whole link (and read timeouts) this many times faster than real time, for quick tests
+
+    def __init__(self, baud=57600, latency=0.05, turnaround=0.02, drop=0.0, ber=0.0, txbuffer=4096, speed=1.0,
+                 seed=None):
+        self.baud = baud
+        self.latency = latency
+        self.turnaround = turnaround
+        self.drop = drop
+        self.ber = ber
+        self.txbuffer = txbuffer
+        self.speed = speed
+        self.seed = seed
+
+
+class RadioLink:
+    # The shared air between the two ends. Only one end can transmit at a time, so a write waits for the
+    # other direction to finish and pays the turnaround before its bytes go out
+
+    def __init__(self, model=None):
+        self.model = model if model is not None else LinkModel()
+        self.random = random.Random(self.model.seed)
+        self.lock = threading.Lock()
+        self.airFree = 0.0  # When the air is clear of everything sent so far
+        self.direction = None
+        self.stats = {'bytes': [0, 0], 'dropped': [0, 0], 'flipped': [0, 0], 'turnarounds': 0}
+
+    def byteTime(self):
+        return 10.0 / self.model.baud / self.model.speed
+
+    def corrupt(self, data, direction):
+        # Drops and flips bytes, jumping straight from one error to the next so clean data costs nothing
+        data = bytearray(data)
+        if (self.model.ber > 0):
+            pbyte = 1 - (1 - self.model.ber) ** 8  # Chance a byte has at least one bad bit
+            pos = self.skip(pbyte)
+            while (pos < len(data)):
+                data[pos] ^= 1 << self.random.randrange(8)
+                self.stats['flipped'][direction] += 1
+                pos += 1 + self.skip(pbyte)
+        if (self.model.drop > 0):
+            keep = bytearray()
+            last = 0
+            pos = self.skip(self.model.drop)
+            while (pos < len(data)):
+                keep += data[last:pos]
+                last = pos + 1
+                self.stats['dropped'][direction] += 1
+                pos += 1 + self.skip(self.model.drop)
+            data = keep + data[last:]
+        return bytes(data)
+
+    def skip(self, p):
+        # Number of clean bytes before the next error, geometric with chance p per byte
+        if (p >= 1):
+            return 0
+        return int(math.log(1.0 - self.random.random()) / math.log(1.0 - p))
+
+    def transmit(self, data, direction):
+        # Puts data on the air, returns the (arrival time, bytes) segments for the other end
+        if (not data):
+            return []
+        now = time.time()
+        with self.lock:
+            start = max(now, self.airFree)
+            if ((self.direction is not None) and (self.direction != direction)):
+                start += self.model.turnaround / self.model.speed
+                self.stats['turnarounds'] += 1
+            self.direction = direction
+            self.stats['bytes'][direction] += len(data)
+            byteTime = self.byteTime()
+            self.airFree = start + len(data) * byteTime
+            latency = self.model.latency / self.model.speed
+            segments = []
+            for pos in range(0, len(data), SEGMENT):
+                piece = self.corrupt(data[pos:pos + SEGMENT], direction)
+                arrival = start + (pos + min(SEGMENT, len(data) - pos)) * byteTime + latency
+                if (piece):
+                    segments.append((arrival, piece))
+            return segments
+
+    def backlog(self):
+        # Seconds until no more than txbuffer bytes are waiting for the air
+        return self.airFree - self.model.txbuffer * self.byteTime() - time.time()
+
+    def drain(self):
+        # Blocks until no more than txbuffer bytes are waiting for the air
+        delay = self.backlog()
+        if (delay > 0):
+            time.sleep(delay)
+
+
+class EmulatedSerial:
+    # One end of an emulated link, with the parts of the serial.Serial interface the two programs use
+
+    def __init__(self, link, direction, port, timeout=None):
+        self.link = link
+        self.direction = direction  # Direction of the bytes this end writes
+        self.port = port
+        self.baudrate = link.model.baud
+        self.timeout = timeout
+        self.peer = None
+        self.pending = deque()  # (arrival time, bytes) still on their way to this end
+        self.buffer = bytearray()  # Bytes that have arrived and not been read
+        self.cv = threading.Condition()
+        self.is_open = True
+
+    def deliver(self, segments):
+        with self.cv:
+            self.pending.extend(segments)
+            self.cv.notify_all()
+
+    def arrive(self):
+        # Moves everything whose arrival time has passed into the buffer, returns when the next bytes land
+        now = time.time()
+        while (self.pending and (self.pending[0][0] <= now)):
+            self.buffer += self.pending.popleft()[1]
+        return self.pending[0][0] if self.pending else None
+
+    def wait(self, ready, timeout):
+        # Waits until ready() or the timeout, the timeout is scaled with the link speed
+        end = None if timeout is None else time.time() + timeout / self.link.model.speed
+        with self.cv:
+            while True:
+                nextArrival = self.arrive()
+                if (ready()):
+                    return
+                now = time.time()
+                if ((end is not None) and (now >= end)):
+                    return
+                limits = [t - now for t in (nextArrival, end) if t is not None]
+                self.cv.wait(max(min(limits), 0.0005) if limits else None)
+
+    def write(self, data):
+        data = bytes(data)
+        self.peer.deliver(self.link.transmit(data, self.direction))
+        self.link.drain()
+        return len(data)
+
+    def read(self, size=1):
+        self.wait(lambda: len(self.buffer) >= size, self.timeout)
+        with self.cv:
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+        return data
+
+    def read_until(self, expected=b'\n', size=None):
+        def ready():
+            return (expected in self.buffer) or ((size is not None) and (len(self.buffer) >= size))
+        self.wait(ready, self.timeout)
+        with self.cv:
+            end = self.buffer.find(expected)
+            end = len(self.buffer) if end < 0 else end + len(expected)
+            if (size is not None):
+                end = min(end, size)
+            data = bytes(self.buffer[:end])
+            del self.buffer[:end]
+        return data
+
+    def readline(self, size=-1):
+        return self.read_until(b'\n', None if size < 0 else size)
+
+    @property
+    def in_waiting(self):
+        with self.cv:
+            self.arrive()
+            return len(self.buffer)
+
+    def inWaiting(self):
+        return self.in_waiting
+
+    def reset_input_buffer(self):
+        # Like a real port, only what has already arrived is thrown away
+        with self.cv:
+            self.arrive()
+            self.buffer = bytearray()
+
+    def reset_output_buffer(self):
+        pass
+
+    def flushInput(self):
+        self.reset_input_buffer()
+
+    def flushOutput(self):
+        self.reset_output_buffer()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+
+def make_pair(model=None, timeout=5):
+    # Returns the Pi end and the ground station end of a new emulated link
+    link = RadioLink(model)
+    pi = EmulatedSerial(link, PI_TO_GROUND, "emulated-pi", timeout)
+    ground = EmulatedSerial(link, GROUND_TO_PI, "emulated-ground", timeout)
+    pi.peer = ground
+    ground.peer = pi
+    return pi, ground
+
+
+class PtyBridge:
+    # Runs an emulated link between two pseudo terminals, so the two programs can each open one as their port
+
+    def __init__(self, model=None):
+        import tty
+        self.link = RadioLink(model)
+        self.masters = []
+        self.names = []
+        for x in range(2):
+            master, slave = os.openpty()
+            tty.setraw(slave)
+            self.masters.append(master)
+            self.names.append(os.ttyname(slave))
+        # Bytes waiting to be written to each side's pty
+        self.outbound = [deque(), deque()]
+        self.cv = threading.Condition()
+
+    def deliverLoop(self, side):
+        # Writes the bytes on their way to a side once their arrival time comes
+        while True:
+            with self.cv:
+                while (not self.outbound[side]):
+                    self.cv.wait()
+                arrival, piece = self.outbound[side][0]
+                delay = arrival - time.time()
+                if (delay > 0):
+                    self.cv.wait(delay)
+                    continue
+                self.outbound[side].popleft()
+            os.write(self.masters[side], piece)
+
+    def run(self):
+        for side in range(2):
+            thread = threading.Thread(target=self.deliverLoop, args=(side,))
+            thread.daemon = True
+            thread.start()
+        while True:
+            # Leave the bytes in the pty while the air is backed up, so the program's writes block like on a real port
+            self.link.drain()
+            readable = select.select(self.masters, [], [], 0.5)[0]
+            for side in range(2):
+                if (self.masters[side] in readable):
+                    try:
+                        data = os.read(self.masters[side], 4096)
+                    except OSError:
+                        data = b''
+                    if (not data):
+                        time.sleep(0.05)  # Nothing has the pty open yet
+                        continue
+                    # Side 0 is the Pi
+                    segments = self.link.transmit(data, PI_TO_GROUND if side == 0 else GROUND_TO_PI)
+                    with self.cv:
+                        self.outbound[1 - side].extend(segments)
+                        self.cv.notify_all()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Emulated RFD900 link between two pseudo terminals")
+    parser.add_argument("--baud", type=int, default=57600)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds")
+    parser.add_argument("--turnaround", type=float, default=0.02, help="seconds per change of direction")
+    parser.add_argument("--drop", type=float, default=0.0, help="chance a byte is lost")
+    parser.add_argument("--ber", type=float, default=0.0, help="chance a bit is flipped")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    bridge = PtyBridge(LinkModel(args.baud, args.latency, args.turnaround, args.drop, args.ber, seed=args.seed))
+    print("Pi side:     RFD_PORT=" + bridge.names[0])
+    print("Ground side: RFD_PORT=" + bridge.names[1])
+    sys.stdout.flush()
+    try:
+        bridge.run()
+    except KeyboardInterrupt:
+        stats = bridge.link.stats
+        print("Bytes Pi->ground:", stats['bytes'][PI_TO_GROUND], "// ground->Pi:", stats['bytes'][GROUND_TO_PI],
+              "// dropped:", sum(stats['dropped']), "// flipped:", sum(stats['flipped']),
+              "// turnarounds:", stats['turnarounds'])
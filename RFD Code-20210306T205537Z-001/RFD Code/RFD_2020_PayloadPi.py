@@ -11,10 +11,14 @@
 import time
 import threading
 import queue
+import asyncio
 from time import strftime
 import datetime
 import io
-import picamera
+try:
+    import picamera
+except ImportError:
+    picamera = None  # Not on a Pi, the camera is reported as disabled
 import subprocess
 import serial
 import sys
@@ -22,26 +26,36 @@ import os
 import PIL.Image
 import base64
 import hashlib
-import pigpio
+import mmap
+try:
+    import pigpio
+except ImportError:
+    pigpio = None  # Not on a Pi, the camera servo can't be moved
 import serial.tools.list_ports
 from io import StringIO
 from array import array
+import RFD_2020_Protocol as protocol
+import RFD_2020_GPS as gpsdata
+
+# Port of the RFD900, set RFD_PORT to run against something else (ex. a pty from RFD_2020_LinkEmulator)
+rfdport = os.environ.get("RFD_PORT", "/dev/ttyAMA0")
 
 
 class GPSThread(threading.Thread):
     # A thread to read in raw GPS information, and organize it for the main thread
 
-    def __init__(self, threadID, gps, Q, exceptions, resetFlag, loggingGPS):  # Constructor
+    def __init__(self, threadID, gps, fixes, exceptions, resetFlag, gpsLog, gpsTrack):  # Constructor
         threading.Thread.__init__(self)
         self.threadID = threadID
         self.gpsSer = gps
-        self.gpsQ = Q
+        self.gpsFixes = fixes  # RFD_2020_GPS.FixHistory the rest of the payload reads
         self.exceptionsQ = exceptions
         self.resetFlagQ = resetFlag
-        self.loggingGPS = loggingGPS
+        self.gpsLog = gpsLog  # RFD_2020_GPS.GPSLog of gpslog.txt, None when it couldn't be created
+        self.gpsTrack = gpsTrack  # RFD_2020_GPS.TrackStore of gpstrack.bin, None when it couldn't be created
         os.system('sudo modprobe w1-gpio')
         os.system('sudo modprobe w1-therm')
-        self.rfdPort = serial.Serial(port="/dev/ttyAMA0", baudrate=57600, timeout=6)
+        self.rfdPort = serial.Serial(port=rfdport, baudrate=57600, timeout=6)
 
         try:
             self.gpsPort = serial.Serial(port='/dev/ttyUSB0', baudrate=9600, timeout=3)
@@ -52,56 +66,38 @@ class GPSThread(threading.Thread):
 
     def run(self):
         global folder
+        parser = gpsdata.NMEAParser()
         try:
             while True:  # Run forever
-                line = self.gpsSer.readline()
-                line = line.decode('utf-8')
-                if (line.find("$GNGGA") != -1):  # GPGGA indicates it's the GPS stuff we're looking for
-                    try:
-                        ### Parse the GPS Info ###
-                        line = line.split(',')
-                        if (line[1] == ''):
-                            hours = 0
-                            minutes = 0
-                            seconds = 0
-                        else:
-                            hours = int(line[1][0:2])
-                            minutes = int(line[1][2:4])
-                            seconds = int(line[1][4:].split('.')[0])
-                        if (line[2] == ''):
-                            lat = 0
-                        else:
-                            lat = float(line[2][0:2]) + \
-                                  (float(line[2][2:])) / 60
-                        if (line[4] == ''):
-                            lon = 0
-                        else:
-                            lon = -(float(line[4][0:3]) +
-                                    (float(line[4][3:])) / 60)
-                        if (line[9] == ''):
-                            alt = 0
-                        else:
-                            alt = float(line[9])
-                        sat = int(line[7])
-
-                        lat = ("%.6f" % lat) #Set 6 decimals of accuracy for constistency in the gpslog.txt file
-                        lon = ("%.6f" % lon) #Set 6 decimals of accuracy for constistency in the gps.log.txt file
-                        ### Organize the GPS info, and put it in the queue ###
-                        gpsStr = str(hours) + ',' + str(minutes) + ',' + str(seconds) + ',' + str(
-                            lat) + ',' + str(lon) + ',' + str(alt) + ',' + str(sat) + '\n'
-                        self.gpsQ.put(gpsStr)
-
-                        if self.loggingGPS:
-                            try:
-                                f = open(folder + "gpslog.txt", "a")
-                                f.write(gpsStr)
-                                f.close()
-                            except Exception as e:
-                                print("Error logging GPS")
-                                self.exceptionsQ.put(str(e))
-
-                    except Exception as e:
-                        self.exceptionsQ.put(str(e))
+                # Everything the receiver has sent so far in one read, so a 10 Hz receiver doesn't mean a read
+                # and a decode per line
+                data = self.gpsSer.read(max(self.gpsSer.in_waiting, 1))
+                for fix in parser.feed(data):
+                    ### Hand the fix to the rest of the payload, and log it ###
+                    self.gpsFixes.put(fix)
+                    gpsStr = gpsdata.format_fix(fix)
+
+                    if self.gpsLog is not None:
+                        try:
+                            self.gpsLog.write(gpsStr)
+                        except Exception as e:
+                            print("Error logging GPS")
+                            self.exceptionsQ.put(str(e))
+                    if self.gpsTrack is not None:
+                        try:
+                            self.gpsTrack.append(fix)
+                        except Exception as e:
+                            print("Error storing GPS track")
+                            self.exceptionsQ.put(str(e))
+                try:
+                    # The last fixes still go out on time if the receiver goes quiet
+                    if self.gpsLog is not None:
+                        self.gpsLog.tick()
+                    if self.gpsTrack is not None:
+                        self.gpsTrack.tick()
+                except Exception as e:
+                    print("Error logging GPS")
+                    self.exceptionsQ.put(str(e))
 
         ### Catches unexpected errors ###
         except Exception as e:
@@ -209,6 +205,34 @@ class Unbuffered:
         pass
 
 
+class MappedImage:
+    # Memory maps an image so it can be sent a piece at a time, without ever holding the whole file in memory
+    # Use as "with MappedImage(path) as view:", view is a memoryview, so slices of it are not copies
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.file = open(self.path, "rb")
+        if (os.fstat(self.file.fileno()).st_size > 0):
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.map)
+        else:  # An empty file can't be mapped
+            self.map = None
+            self.view = memoryview(b'')
+        return self.view
+
+    def __exit__(self, *args):
+        self.view.release()
+        if (self.map is not None):
+            try:
+                self.map.close()
+            except BufferError:
+                pass  # A slice is still held by an exception traceback, the map closes when that is cleaned up
+        self.file.close()
+        return False
+
+
 class CameraSettings:
     # A class to handle camera settings
 
@@ -271,8 +295,10 @@ class CameraSettings:
 class main:
     # The main program class
     def __init__(self):
-        global folder, loggingGPS
+        global folder, gpsLog, gpsTrack
         self.folder = folder
+        self.gpsLog = gpsLog
+        self.gpsTrack = gpsTrack
 
         # Get a list of the usb devices connected and assign them properly
         ports = serial.tools.list_ports.comports()
@@ -318,7 +344,7 @@ class main:
         logfile = open(self.folder + "piruntimedata.txt", "a")
 
         ### Picture Variables ###
-        self.wordlength = 10000
+        self.initTransfer()
         self.imagenumber = 0
         self.recentimg = ""
         self.pic_interval = 60
@@ -338,14 +364,16 @@ class main:
 
         # Make sure servo is set to neutral at 90 degrees upon startup.
         # 90 == 1700, 45 == 1500, and 135 == 1900
-        self.pi = pigpio.pi()
-        self.pi.set_mode(18,pigpio.OUTPUT)
-        self.pi.set_servo_pulsewidth(18,1700)
-        time.sleep(0.5)
-        self.pi.set_servo_pulsewidth(18,0)
+        self.pi = None
+        if (pigpio is not None):
+            self.pi = pigpio.pi()
+            self.pi.set_mode(18,pigpio.OUTPUT)
+            self.pi.set_servo_pulsewidth(18,1700)
+            time.sleep(0.5)
+            self.pi.set_servo_pulsewidth(18,0)
 
         # Create queues to share info with the threads
-        self.gpsQ = queue.LifoQueue()
+        self.gpsFixes = gpsdata.FixHistory()  # Latest fix and the last minute of them, see RFD_2020_GPS
         self.gpsExceptionsQ = queue.Queue()
         self.gpsResetQ = queue.Queue()
         self.picQ = queue.Queue()
@@ -354,7 +382,7 @@ class main:
         # RFD 900
         try:
             self.ser = rfdPort = serial.Serial(
-                port="/dev/ttyAMA0", baudrate=57600, timeout=5)
+                port=rfdport, baudrate=57600, timeout=5)
             self.rfdEnabled = True
         except:
             self.rfdEnabled = False
@@ -388,6 +416,10 @@ class main:
             self.startGPSThread()
 
         # Get Started
+        self.portLock = threading.Lock()  # Held by whichever command is using the RFD
+        self.pendingAlerts = queue.Queue()  # Alerts waiting for the RFD when there is no telemetry to carry them
+        self.initCommands()
+        self.healthInterval = 5  # Seconds between hardware checks
         self.starttime = time.time()
         print("Started at @ ", datetime.datetime.now())
         self.checkpoint = time.time()
@@ -398,80 +430,133 @@ class main:
     def getRFDCom(self):
         return [self.rfdPort, self.rfdBaud, self.rfdTimeout]
 
+    def initCommands(self):
+        # The registry of command handlers, runCommand looks every command's opcode up here
+        self.commands = {
+            b'1': self.mostRecentImage,
+            b'2': self.sendImageData,
+            b'3': self.requestedImage,
+            b'4': self.sendCameraSettings,
+            b'5': self.getCameraSettings,
+            b'P': self.pingTest,
+            b'G': self.sendgpslog,
+            b'L': self.sendTrackLast,
+            b'W': self.sendTrackRange,
+            b'T': self.timeSync,
+            #b'9': self.horizontalFlip,  # Not currently used by Ground Station
+            #b'0': self.verticalFlip,  # Not currently used by Ground Station
+            b'S': self.sync,
+            b'D': self.sendDeviceStatus,
+            b'H': self.set_camera_angle,
+            b'M': self.setTransferMode,
+            b'C': self.sendCrop,
+            b'B': self.sendBatch,
+            b'R': self.rebootPi,
+            b'Q': self.shut_down,
+        }
+        self.command = None  # The command being run, its handler answers it with acknowledge()
+        self.legacyCommands = True  # Bare letters are commands until the ground station sends a framed one
+
+    def initTransfer(self):
+        # The transfer settings the Pi starts with, until the ground station changes them with command M
+        self.wordlength = 10000
+        self.b64WordSize = 10000  # Base64 word size, has to match the ground station's wordlength
+        self.transferMode = protocol.MODE_B64  # Until the ground station asks for something else with command M
+        self.windowSize = 8  # Number of binary frames sent before waiting on the ground station
+        self.fecGroup = 0  # Data frames covered by each parity frame, 0 turns forward error correction off
+        # Binary frame sizes, kept between images to follow the link. Starts small, a lost frame costs its whole size
+        self.chunkControl = protocol.ChunkController(start=4000)
+        self.progressive = False  # Send smaller versions of an image first, set with command M
+        self.progressiveScales = [8, 3]  # Each stage is the image shrunk by this much, the full image comes last
+        self.compression = protocol.COMPRESS_NONE  # How commands 2, 4 and G pack their text, set with command M
+        self.integrity = protocol.CHECK_MD5  # Check on every binary frame and blob, set with command M
+        self.telemetryEnabled = False  # Slip telemetry frames in between image frames, set with command M
+        self.telemetry = protocol.TelemetryMux()
+        self.sendingFrames = False  # True while binary frames are going out, the only time telemetry is sent
+        self.linkStats = {'frames': 0, 'resent': 0, 'syncs': 0}  # Totals since startup, see RFD_2020_Benchmark
+
     def reset_cam(self):
         # Resets the camera to the default settings
         self.cameraSettings = CameraSettings(650, 450, 0, 50, 0, 0, 400)
 
-    def image_to_b64(self, path):
-        # Converts an image to 64 bit encoding
-        with open(path, "rb") as imageFile:
-            return base64.b64encode(imageFile.read())
-
     def b64_to_image(self, data, savepath):
         # Converts a 64 bit encoding to an image
         fl = open(savepath, "wb")
         fl.write(data.decode('base64'))
         fl.close()
 
-    def gen_checksum(self, data, pos):
-        # Creates a checksum based on data
-        return hashlib.md5(data[pos:pos + self.wordlength]).hexdigest()
-
-    def sendword(self, data, pos):
-        # Sends the appropriately sized piece of the total picture encoding
-        if (pos + self.wordlength < len(data)):  # Take a piece of size self.wordlength from the whole, and send it
-            self.ser.write(data[pos:pos + self.wordlength])
-            print(data[pos:pos + self.wordlength])
-            return
-        else:  # If the self.wordlength is greater than the amount remaining, send everything left
-            self.ser.write(data[pos:pos + len(data)])
-            print(data[pos:pos + len(data)])
-            return
+    def b64_word(self, view, pos):
+        # Base64 encodes just the word of size self.wordlength starting at pos of the encoded image
+        # Every 3 image bytes become 4 characters, so only the bytes under this word are read and encoded
+        first = pos // 4
+        last = (pos + self.wordlength + 3) // 4
+        encoded = base64.b64encode(view[first * 3:last * 3])
+        return encoded[pos - first * 4:pos - first * 4 + self.wordlength]
 
     def sync(self):
-        # Synchronizes the data stream between the Pi and the ground station
-        synccheck = b''
-        synctry = 5
+        # Synchronizes the data stream between the Pi and the ground station, see the marks in RFD_2020_Protocol
+        # The sync mark goes out until the ground station's reply comes back, then the end mark tells it
+        # where the stream picks up again. Returns False if the ground station never answered
+        self.linkStats['syncs'] += 1
         syncterm = time.time() + 10
-        while ((synccheck != b'S') & (syncterm > time.time())):
-            self.ser.write(b"sync")
-            synccheck = self.ser.read()
-            if (synctry == 0):
-                if (synccheck == b''):
-                    print("SyncError")
-                    break
-            synctry -= 1
-        time.sleep(0.5)
-
-        # Flush buffers to be ready
-        self.ser.flushInput()
-        self.ser.flushOutput()
-        return
-
-    def send_image(self, exportpath):
+        window = bytearray()
+        while (syncterm > time.time()):
+            self.ser.write(protocol.SYNC_MARK)
+            wait = time.time() + protocol.SYNC_INTERVAL
+            while ((self.ser.in_waiting == 0) and (time.time() < wait)):
+                time.sleep(0.01)
+            # The ground station sends nothing after its reply until it has our end mark, so reading all
+            # that is waiting never takes anything meant for after the sync
+            window += self.ser.read(self.ser.in_waiting)
+            if (window.find(protocol.SYNC_REPLY) >= 0):
+                self.ser.write(protocol.SYNC_END)
+                return True
+            del window[:-(len(protocol.SYNC_REPLY) - 1)]
+        print("SyncError")
+        return False
+
+    def send_image(self, exportpath, ranges=""):
         # Sends the image through the RFD in increments of size self.wordlength
+        # ranges (binary mode only) limits the send to the byte ranges the ground station is missing
+        if (self.transferMode == protocol.MODE_BINARY):
+            if (self.progressive):
+                self.send_image_progressive(exportpath, ranges)
+            else:
+                self.send_image_binary(exportpath, ranges)
+            return
         print("Send Image Function")
         timecheck = time.time()
-        done = False
+        # The ground station runs an identical controller off the same Y/N answers, so word sizes always match
+        wordControl = protocol.ChunkController(self.b64WordSize, maximum=self.b64WordSize)
+        self.wordlength = wordControl.getSize()
+        # The image is mapped and encoded a word at a time instead of all at once
+        with MappedImage(exportpath) as outbound:
+            self.send_b64_words(outbound, wordControl)
+        print("Image Send Complete")
+        print("Send Time =", (time.time() - timecheck))
+        return
+
+    def send_b64_words(self, outbound, wordControl):
+        # The base64 stop-and-wait exchange, outbound is the mapped raw image
         cur = 0
         trycnt = 0
-        # Determine where the encoded image is
-        outbound = self.image_to_b64(exportpath)
-        size = len(outbound)
+        size = 4 * ((len(outbound) + 2) // 3)  # Size of the base64 encoding
         print(size, ": Image Size")
         print("photo request received")
         # Send the total size so the ground station knows how big it will be
         self.ser.write(str(size).encode('utf-8'))
         print(str(size) + '\n')
         # successcount = 0
-        while (cur < len(outbound)):
+        while (cur < size):
             # Print out how much picture is remaining in kilobytes
             print("Send Position:", cur, " // Remaining:", int((size - cur) / 1024), "kB")
             # Create the checksum to send for the ground station to compare to
-            checkours = self.gen_checksum(outbound, cur)
+            word = self.b64_word(outbound, cur)
+            checkours = hashlib.md5(word).hexdigest()
             self.ser.write(checkours.encode('utf-8'))
             # Send a piece of size self.wordlength
-            self.sendword(outbound, cur)
+            self.ser.write(word)
+            self.linkStats['frames'] += 1
             time.sleep(0.1)
             checkOK = self.ser.read()
             # print('checkOK: ', checkOK)
@@ -479,27 +564,334 @@ class main:
             if (checkOK == b'Y'):
                 cur = cur + self.wordlength
                 trycnt = 0
-                self.wordlength = 10000
+                self.wordlength = wordControl.update(1, 0)
             else:
-                # There are 10 tries to get the word through, each time you fail, drop the self.wordlength by 1000
+                # There are 10 tries to get the word through, each failure restarts both controllers small
+                self.linkStats['resent'] += 1
                 if (trycnt < 10):
-                    if (self.wordlength >= 1000):
-                        self.wordlength -= 1000
-                        self.sync()
-                        trycnt += 1
-                        print("try number:", trycnt)
-                        print("resending last @", cur)
-                        print("self.wordlength", self.wordlength)
+                    self.wordlength = wordControl.restart()
+                    self.sync()
+                    trycnt += 1
+                    print("try number:", trycnt)
+                    print("resending last @", cur)
+                    print("self.wordlength", self.wordlength)
                 else:
                     print("error out")
-                    cur = len(outbound)
+                    cur = size
+        return
+
+    def send_image_binary(self, exportpath, ranges=""):
+        # Sends the raw image bytes in windows of up to self.windowSize sequence numbered frames
+        # Each window ends with a poll, and only the frames the ground station NACKs are sent again
+        # If ranges is given only those bytes are sent, so an interrupted download can be resumed
+        print("Send Image Binary Function")
+        timecheck = time.time()
+        with MappedImage(exportpath) as outbound:
+            self.send_binary_frames(outbound, ranges)
         print("Image Send Complete")
         print("Send Time =", (time.time() - timecheck))
         return
 
+    def send_binary_frames(self, outbound, ranges):
+        # The windowed binary exchange, outbound is the mapped image
+        # Returns False if the ground station stopped the transfer or stopped answering
+        # Alerts only wait for telemetry while this runs, since nothing else sends it
+        self.sendingFrames = True
+        try:
+            return self.send_frame_windows(outbound, ranges)
+        finally:
+            self.sendingFrames = False
+
+    def send_frame_windows(self, outbound, ranges):
+        # Does the work of send_binary_frames
+        size = len(outbound)
+        print(size, ": Image Size")
+        # Send the total size so the ground station knows when the image is done
+        self.ser.write(protocol.pack_size(size))
+        if (ranges != ""):
+            ranges = protocol.parse_ranges(ranges, size)
+            print("Resuming, sending ranges:", protocol.format_ranges(ranges))
+        elif (size > 0):
+            ranges = [(0, size)]
+        else:
+            ranges = []  # Nothing follows the size of an empty image
+        chunks = {}  # seq: (offset, length) of every frame that hasn't been acknowledged yet
+        resend = []  # seqs the ground station asked for again
+        keepSize = set()  # seqs sent in a window whose ack was lost, the ground station may have them as they are
+        r = 0  # The range new frames are being cut from
+        cur = ranges[0][0] if ranges else size
+        seq = 0
+        trycnt = 0
+        while ((r < len(ranges)) or resend):
+            # Fill the window, frames that need to be resent go first
+            window = resend[:self.windowSize]
+            resend = resend[self.windowSize:]
+            retries = len(window)
+            while ((len(window) < self.windowSize) and (r < len(ranges))):
+                length = min(self.chunkControl.getSize(), ranges[r][1] - cur)
+                chunks[seq] = (cur, length)
+                window.append(seq)
+                cur += length
+                seq = (seq + 1) % protocol.SEQ_MODULO
+                if (cur >= ranges[r][1]):
+                    r += 1
+                    if (r < len(ranges)):
+                        cur = ranges[r][0]
+            remaining = sum([end - start for (start, end) in ranges[r:]])
+            if (r < len(ranges)):
+                remaining -= cur - ranges[r][0]
+            print("Send Position:", cur, " // Remaining:", int(remaining / 1024), "kB // Resending:", retries)
+            status = "Sending image, %d kB left" % int(remaining / 1024)
+            self.linkStats['frames'] += len(window)
+            self.linkStats['resent'] += retries
+            for s in window:
+                offset, length = chunks[s]
+                protocol.write_frame(self.ser, outbound[offset:offset + length], offset, s, check=self.integrity)
+                self.send_telemetry(status)
+            # Parity frames let the ground station rebuild a lost frame without asking for it again
+            if (self.fecGroup > 0):
+                for x in range(0, len(window), self.fecGroup):
+                    group = window[x:x + self.fecGroup]
+                    members = [(s,) + chunks[s] for s in group]
+                    pieces = [outbound[offset:offset + length] for (s, offset, length) in members]
+                    self.ser.write(protocol.build_parity(members, pieces, self.integrity))
+            self.ser.write(protocol.build_poll(window, self.integrity))
+            ack = protocol.read_frame(self.ser, self.integrity)
+            if ((ack is not None) and ack.checkOK and (ack.frametype == protocol.FRAME_ACK)):
+                nacks = [s for s in protocol.unpack_seqs(ack.data) if s in window]
+                for s in window:
+                    if (s not in nacks):
+                        del chunks[s]
+                        keepSize.discard(s)
+                self.chunkControl.update(len(window), len(nacks))
+                # A NACKed frame is cut again at the current size, so a link that got worse isn't stuck resending
+                # the big frames it keeps losing
+                recut = []
+                for s in nacks:
+                    offset, length = chunks[s]
+                    if ((s in keepSize) or (length <= self.chunkControl.getSize())):
+                        recut.append(s)
+                        continue
+                    del chunks[s]
+                    for start in range(offset, offset + length, self.chunkControl.getSize()):
+                        chunks[seq] = (start, min(self.chunkControl.getSize(), offset + length - start))
+                        recut.append(seq)
+                        seq = (seq + 1) % protocol.SEQ_MODULO
+                resend = recut + resend
+                if (not nacks):
+                    trycnt = 0
+                else:
+                    # Some of the window got through, only the NACKed frames go again
+                    if (len(nacks) == len(window)):
+                        trycnt += 1
+                    else:
+                        trycnt = 0
+                    print("resending", len(nacks), "frames, chunk size", self.chunkControl.getSize())
+            elif ((ack is not None) and ack.checkOK and (ack.frametype == protocol.FRAME_STOP)):
+                print("Ground station stopped the transfer")
+                return False
+            else:
+                # The poll or the ack was lost, so the whole window goes again. The ground station finds the
+                # frames by their preambles, so there is no sync
+                resend = window + resend
+                keepSize.update(window)
+                trycnt += 1
+                self.chunkControl.update(len(window), len(window))
+                print("try number:", trycnt)
+                print("no ack, resending window @", chunks[window[0]][0])
+            if (trycnt >= 10):
+                print("error out")
+                return False
+        # Every frame got through, finish with a digest of the whole image to catch anything the frame checks missed
+        # The ground station acks the digest, so it goes again until that ack comes back
+        if (size > 0):
+            digest = protocol.build_digest(protocol.gen_file_digest(outbound), self.integrity)
+            for x in range(3):
+                self.ser.write(digest)
+                ack = protocol.read_frame(self.ser, self.integrity)
+                if ((ack is not None) and ack.checkOK and (ack.frametype == protocol.FRAME_ACK)):
+                    break
+        return True
+
+    def send_telemetry(self, status):
+        # Sends whatever telemetry is due between two image frames, so the ground station keeps tracking
+        # the balloon while an image is on its way
+        if (not self.telemetryEnabled):
+            return
+        fix = self.gpsFixes.latest()
+        if (fix is not None):
+            self.telemetry.put(protocol.CHANNEL_GPS, gpsdata.format_fix(fix).strip().encode('utf-8'))
+        while (not self.gpsExceptionsQ.empty()):
+            error = self.gpsExceptionsQ.get()
+            print(error)
+            self.telemetry.put(protocol.CHANNEL_ALERT, ("GPS error: " + error).encode('utf-8'))
+        self.telemetry.put(protocol.CHANNEL_STATUS, ("RT: %d Camera: %s, GPS: %s, %s" % (
+            int(time.time() - self.starttime), self.cameraEnabled, self.gpsEnabled, status)).encode('utf-8'))
+        for channel, data in self.telemetry.due(time.time()):
+            self.ser.write(protocol.build_telemetry(channel, data, self.integrity))
+
+    def make_stages(self, exportpath):
+        # Saves the smaller versions of an image for a progressive send, smallest first
+        # A stage that comes out bigger than the image itself is skipped
+        stages = []
+        try:
+            stagefolder = self.folder + "stages/"
+            if (not os.path.exists(stagefolder)):
+                os.mkdir(stagefolder)
+            name = os.path.splitext(os.path.basename(exportpath))[0]
+            fullsize = os.path.getsize(exportpath)
+            image = PIL.Image.open(exportpath)
+            for scale in self.progressiveScales:
+                stage = image.copy()
+                stage.thumbnail((max(image.size[0] // scale, 1), max(image.size[1] // scale, 1)))
+                stagepath = stagefolder + "%s_%d.jpg" % (name, scale)
+                stage.convert('RGB').save(stagepath, "JPEG", quality=50)
+                if (os.path.getsize(stagepath) < fullsize):
+                    stages.append(stagepath)
+            image.close()
+        except Exception as e:
+            print("Error making progressive stages")
+            print(str(e))
+        return stages
+
+    def send_image_progressive(self, exportpath, ranges=""):
+        # Sends the stages from make_stages before the image, so the ground station has something to show
+        # after a few kB and can stop the request if the image isn't worth the full download
+        # A resumed request (ranges given) only gets the rest of the full image
+        if (ranges == ""):
+            stages = self.make_stages(exportpath)
+        else:
+            stages = []
+        stages.append(exportpath)
+        for x in range(len(stages)):
+            self.ser.write(protocol.STAGE_HEADER.pack(x, len(stages)))
+            if (x < len(stages) - 1):
+                print("Sending stage", x + 1, "of", len(stages))
+                self.send_image_binary(stages[x])
+                # Give the operator time to look at the stage before deciding
+                reply = b''
+                termtime = time.time() + 60
+                while ((reply == b'') and (termtime > time.time())):
+                    reply = self.ser.read()
+                if (reply != protocol.STAGE_CONTINUE):
+                    print("Ground station stopped the image after stage", x + 1)
+                    return
+            else:
+                self.send_image_binary(exportpath, ranges)
+        return
+
+    def make_crop(self, exportpath, box, scale):
+        # Cuts box (fractions of the width and height) out of a stored image, shrinks it by scale and saves it
+        image = PIL.Image.open(exportpath)
+        width, height = image.size
+        left = int(box[0] * width)
+        top = int(box[1] * height)
+        right = max(int(box[2] * width), left + 1)
+        bottom = max(int(box[3] * height), top + 1)
+        crop = image.crop((left, top, right, bottom))
+        if (scale > 1):
+            crop = crop.resize((max(crop.size[0] // scale, 1), max(crop.size[1] // scale, 1)), PIL.Image.LANCZOS)
+        cropfolder = self.folder + "crops/"
+        if (not os.path.exists(cropfolder)):
+            os.mkdir(cropfolder)
+        croppath = cropfolder + "%s_%d_%d_%d_%d_%d.jpg" % (os.path.splitext(os.path.basename(exportpath))[0],
+                                                           left, top, right, bottom, scale)
+        crop.convert('RGB').save(croppath, "JPEG", quality=85)
+        image.close()
+        print("Crop saved:", croppath, crop.size)
+        return croppath
+
+    def sendCrop(self):
+        # Command C: Sends a region of a stored image, so a detail of a full resolution picture
+        # can be looked at without downloading the whole thing
+        self.acknowledge()
+        try:
+            print("Crop Request Received")
+            request = self.ser.readline().decode('utf-8').strip()
+            print("Crop request:", request)
+            name, box, scale = protocol.parse_crop(request)
+            croppath = self.make_crop(self.folder + name, box, scale)
+        except Exception as e:
+            print("Error making crop")
+            print(str(e))
+            if (self.transferMode == protocol.MODE_BINARY):
+                self.ser.write(protocol.pack_size(0))  # Tells the ground station there is nothing coming
+            return
+        try:
+            # Crops are small, so they never go through the progressive stages
+            if (self.transferMode == protocol.MODE_BINARY):
+                self.send_image_binary(croppath)
+            else:
+                self.send_image(croppath)
+        except Exception as e:
+            print("Error sending crop")
+            print(str(e))
+
+    def sendBatch(self):
+        # Command B: Sends a list of images back to back, without a command or acknowledge for each one
+        self.acknowledge()
+        try:
+            print("Batch Request Received")
+            requests = protocol.read_blob(self.ser, self.integrity)
+            if ((requests is None) or (self.transferMode != protocol.MODE_BINARY)):
+                print("No batch to send")
+                requests = b''
+            requests = requests.decode('utf-8').splitlines()
+        except Exception as e:
+            print("Error reading batch request")
+            print(str(e))
+            requests = []
+        timecheck = time.time()
+        for index in range(len(requests)):
+            name, ranges = protocol.parse_request(requests[index])
+            print("Batch image", index + 1, "of", len(requests), ":", name)
+            self.ser.write(protocol.build_name(name, index, self.integrity))
+            if (not os.path.isfile(self.folder + name)):
+                print("No such image")
+                self.ser.write(protocol.pack_size(0))  # Nothing coming for this one, on to the next
+                continue
+            with MappedImage(self.folder + name) as outbound:
+                sent = self.send_binary_frames(outbound, ranges)
+            if (not sent):
+                print("Batch stopped")
+                break
+        self.ser.write(protocol.build_name("", len(requests), self.integrity))
+        print("Batch Send Time =", (time.time() - timecheck))
+
+    def setTransferMode(self):
+        # Command M: The ground station asks for a transfer mode and its options,
+        # answer with the mode line that will actually be used
+        self.acknowledge()
+        try:
+            mode, options = protocol.parse_mode(self.ser.readline().decode('utf-8').strip())
+            if (mode not in protocol.MODES):
+                print("Unknown transfer mode:", mode)
+                mode = protocol.MODE_B64
+            self.transferMode = mode
+            try:
+                self.fecGroup = min(max(int(options.get('fec', 0)), 0), self.windowSize)
+            except ValueError:
+                self.fecGroup = 0
+            self.progressive = (mode == protocol.MODE_BINARY) and (options.get('progressive', '0') == '1')
+            self.compression = options.get('compress', protocol.COMPRESS_NONE)
+            if (self.compression not in protocol.COMPRESSIONS):
+                self.compression = protocol.COMPRESS_NONE
+            self.integrity = options.get('check', protocol.CHECK_MD5)
+            if (self.integrity not in protocol.CHECKS):
+                self.integrity = protocol.CHECK_MD5
+            self.telemetryEnabled = (mode == protocol.MODE_BINARY) and (options.get('telemetry', '0') == '1')
+            reply = protocol.format_mode(mode, {'fec': self.fecGroup, 'progressive': int(self.progressive),
+                                                'compress': self.compression, 'check': self.integrity,
+                                                'telemetry': int(self.telemetryEnabled)})
+            self.ser.write((reply + '\n').encode('utf-8'))
+            print("Transfer mode set to", reply)
+        except Exception as e:
+            print("Error setting transfer mode")
+            print(str(e))
+
     def mostRecentImage(self):
         # Command 1: Send most recent image
-        self.ser.write(b'A')  # Send the acknowledge
+        self.acknowledge()
         try:
             print("Send Image Command Received")
             print("Sending:", self.recentimg)
@@ -510,32 +902,46 @@ class main:
         except Exception as e:
             print("Send Recent Image Error:", str(e))
 
+    def send_text(self, text):
+        # Sends the text of a file, as one compressed blob if the ground station asked for it
+        if (self.compression != protocol.COMPRESS_NONE):
+            packed = protocol.write_blob(self.ser, text.encode('utf-8'), self.compression, self.integrity)
+            print("Sent", len(text), "characters packed into", packed, "bytes")
+        else:
+            self.ser.write(text.encode('utf-8'))
+
     def sendImageData(self):
         # Command 2: Sends imagedata.txt
-        self.ser.write(b'A')
+        self.acknowledge()
         try:
             print("data list request recieved")
             file = open(self.folder + "imagedata.txt", "r")
             print("Sending imagedata.txt")
-            for line in file:
-                self.ser.write(line.encode('utf-8'))
+            if (self.compression != protocol.COMPRESS_NONE):
+                self.send_text(file.read())
+            else:
+                for line in file:
+                    self.ser.write(line.encode('utf-8'))
             file.close()
-            time.sleep(1)
+            if (self.compression == protocol.COMPRESS_NONE):
+                time.sleep(1)
         except:
             print("Error with imagedata.txt read or send")
 
     def requestedImage(self):
         # Command 3: Sends the requested image
-        self.ser.write(b'A')
+        self.acknowledge()
         try:
             print("Specific Photo Request Received")
             image_to_send = b''
             while (image_to_send == b''):
                 image_to_send = self.ser.readline().decode('utf-8')
                 print("Image to send:", image_to_send)
+            # The request may carry the byte ranges of an interrupted download, ex. image0001_a.png@40000-
+            image_to_send, ranges = protocol.parse_request(image_to_send)
             print("Requested image: ", str(image_to_send))
             self.ser.reset_input_buffer()
-            self.send_image(self.folder + str(image_to_send))
+            self.send_image(self.folder + str(image_to_send), ranges)
             self.wordlength = 10000
         except Exception as e:
             print("Error sending requestedImage")
@@ -543,14 +949,11 @@ class main:
 
     def sendCameraSettings(self):
         # Command 4: Sends the camera settings
-        self.ser.write(b'A')
+        self.acknowledge()
         try:
             print("Attempting to send camera settings")
             file = open(folder + "camerasettings.txt", "r")
-            temp = file.read()
-            while (temp != ""):
-                self.ser.write(temp.encode('utf-8'))
-                temp = file.read()
+            self.send_text(file.read())
             file.close()
             print("Camera Settings Sent")
         except Exception as e:
@@ -558,7 +961,7 @@ class main:
 
     def getCameraSettings(self):
         # Command 5: Updates the camera settings
-        self.ser.write(b'A')
+        self.acknowledge()
         temp = b'Y'
         try:
             print("Attempting to update camera settings")
@@ -583,7 +986,7 @@ class main:
 
     def timeSync(self):
         # Command T: Takes the current time from the ground station and applies it to Pi
-        self.ser.write(b'T')
+        self.acknowledge(b'T')
         try:
             print("Time Sync Request Received")
             timeval = self.ser.readline(19)
@@ -599,7 +1002,7 @@ class main:
 
     def pingTest(self):
         # Command P: Connection test, test ping time
-        self.ser.write(b'P')
+        self.acknowledge(b'P')
         print("Ping Request Received")
         try:
             termtime = time.time() + 10
@@ -621,36 +1024,76 @@ class main:
 
     def sendgpslog(self):
         # Command G: Sends the gpslog.txt
-        self.ser.write(b'A')
-        lines = 0
+        self.acknowledge()
         try:
             print("Attempting to send gpslog.txt")
-            # Open the gpslog file
-            file = open(self.folder + "gpslog.txt", "r")
-            for line in file:
-               lines += 1
-            file.close()
-            file = open(self.folder + "gpslog.txt", "r")
-            if (lines < 10):         # If we have less than less than 10 gps data log enteries
-                temp = file.readline()
-                while (temp != ""):  # Send everything in the file until it's empty
-                    self.ser.write(temp.encode('utf-8'))
-                    temp = file.readline()
-            else:                    # Sends the 10 most recent gps data logs to the ground station
-                count = lines - 10   # We do not want to send the whole file because it gets large fast
-                line = file.readlines()
-                while(count < lines):
-                    temp = line[count]
-                    self.ser.write(temp.encode('utf-8'))
-                    count += 1
-            file.close()
+            if (self.gpsLog is not None):
+                self.gpsLog.flush()  # The fixes still waiting for their batch too
+            # Sends the 10 most recent gps data logs to the ground station
+            # We do not want to send the whole file because it gets large fast
+            text = "".join(gpsdata.log_tail(self.folder + "gpslog.txt", 10))
+            self.send_text(text)
             print("gpslog.txt sent")
         except:
             print("error sending gpslog.txt")
 
+    def sendTrack(self, records):
+        # Sends track records delta encoded (see RFD_2020_Protocol), so a whole flight fits
+        # In binary mode they go in windows of frames like an image, so a hit frame is all that has to go again
+        data = protocol.encode_track([(record['time'], record['lat'], record['lon'], record['alt'], record['sats'])
+                                      for record in records])
+        if (self.transferMode == protocol.MODE_BINARY):
+            packed = protocol.pack_text(data, self.compression)
+            self.send_binary_frames(packed, "")
+            packed = len(packed)
+        else:
+            packed = protocol.write_blob(self.ser, data, self.compression, self.integrity)
+        print("Sent", len(records), "fixes in", packed, "bytes")
+
+    def sendTrackLast(self):
+        # Command L: Sends the newest fixes of the track, the ground station sends how many on the next line
+        self.acknowledge()
+        records = []
+        try:
+            count = int(self.ser.readline().decode('utf-8').strip())
+            print("Track request for the last", count, "fixes")
+            records = self.gpsTrack.last(count)
+        except Exception as e:
+            print("Error reading gpstrack.bin")
+            print(str(e))
+        try:
+            self.sendTrack(records)  # Even with nothing to send, so the ground station isn't left waiting
+        except Exception as e:
+            print("Error sending track")
+            print(str(e))
+
+    def sendTrackRange(self):
+        # Command W: Sends the fixes between two times, thinned out to a number of points
+        # The ground station sends "start,end,points" on the next line, times in seconds since 1970 UTC
+        self.acknowledge()
+        records = []
+        try:
+            start, end, points = self.ser.readline().decode('utf-8').strip().split(',')
+            print("Track request from", start, "to", end, "in", points, "points")
+            records = self.gpsTrack.between(float(start), float(end), int(points))
+        except Exception as e:
+            print("Error reading gpstrack.bin")
+            print(str(e))
+        try:
+            self.sendTrack(records)
+        except Exception as e:
+            print("Error sending track")
+            print(str(e))
+
+    def closeGPSFiles(self):
+        # Writes out the fixes still waiting for their batch, before the Pi goes down
+        for store in (self.gpsLog, self.gpsTrack):
+            if (store is not None):
+                store.close()
+
     def horizontalFlip(self):
         # Flips the pictures horizontally (Not currently being used)
-        self.ser.write(b'A')
+        self.acknowledge()
         try:
             self.cameraSettings.toggleHorizontalFlip()
             print("Camera Flipped Horizontally")
@@ -659,7 +1102,7 @@ class main:
 
     def verticalFlip(self):
         # Flips the pictures vertically (Not currently being used)
-        self.ser.write(b'A')
+        self.acknowledge()
         try:
             self.cameraSettings.toggleVerticalFlip()
             print("Camera Flipped Vertically")
@@ -668,7 +1111,7 @@ class main:
 
     def sendDeviceStatus(self):
         # Command D: Returns the status of the serial devices to the ground station
-        self.ser.write(b'A')
+        self.acknowledge()
         try:
             status = 'Camera: ' + \
                      str(self.cameraEnabled) + ', GPS: ' + str(self.gpsEnabled)
@@ -681,29 +1124,36 @@ class main:
 
     def startGPSThread(self):
         self.gpsThread = GPSThread(
-            "gpsThread", self.gps, self.gpsQ, self.gpsExceptionsQ, self.gpsResetQ, loggingGPS)
+            "gpsThread", self.gps, self.gpsFixes, self.gpsExceptionsQ, self.gpsResetQ, self.gpsLog, self.gpsTrack)
         self.gpsThread.daemon = True
         self.gpsThread.start()
 
     def rebootPi(self):
-        # Command R: Reboots the Pi if needed
-        self.ser.write(b'A')
+        # Command R: Reboots the Pi if needed, only when asked twice
+        if (not self.confirmed()):
+            return
+        self.acknowledge()
         try:
+            self.closeGPSFiles()
             os.system('sudo reboot now')
         except:
             print("Something went wrong and we cannot reboot")
 
     def shut_down(self):
         # Command Q: Shutdown the Pi once the payload is recovered before the batteries die to prevent SD Card Corruption
-        self.ser.write(b'A')
+        # Only when asked twice
+        if (not self.confirmed()):
+            return
+        self.acknowledge()
         try:
+            self.closeGPSFiles()
             os.system('sudo shutdown now')
         except:
             print("Something went wrong and we cannot shutdown")
 
     def set_camera_angle(self):
         # Command H: Cahnge the angle of the PiCamera. Can go between 45 and 135 degree is 90 being neutral
-        self.ser.write(b'A')
+        self.acknowledge()
         print("Receoved Command to update camera servo angle")
         temp = b'Y'
         angle = ''
@@ -740,205 +1190,247 @@ class main:
                 except:
                     print("except")
                     self.gpsEnabled = False  # If this fails, disable the gps
-                    if (self.rfdEnabled):
-                        self.ser.write(b'Alert: GPS is disabled')
-                    print("GPS is now Disabled")
-
-    def loop(self):
-        # The main loop for the program
-        try:
-            ### Receive a command from the ground station and process it ###
-            if (self.rfdEnabled):
-                # Print out how long this has been running
-                print("RT: " + str(int(time.time() - self.starttime)) +
-                      " Watching Serial")
-                timeCheck = time.time()
-                command = b''
-                done = False
-                while ((not done) and (time.time() - timeCheck) < 1):  # 3
-                    # Read from the RFD, if you fail to read, disabled the RFD and break the loop
-                    newChar =b''
-                    try:
-                        newChar = self.ser.read()
-                        print("Incoming Char:", newChar)
-                    except Exception as e:
-                        print(str(e))
-                        self.rfdEnabled = False
-                        done = True
-                    # If the Character is !, this is a command EOL character, so end the loop
-                    if (newChar != b"!"):
-                        command += newChar
-                        done = True
-                    # IF the character is anything else (not null(, add it on, and reset the kill timer
-                    elif (newChar != b""):
-                        command += newChar
-                        timeCheck = time.time()
-
-                if (command != ''):
-                    print("Command: ", command)
-
-                # Check to see if the command was one for the raspberry pi and run if it is
-                try:
-                    if (command == b'1'):
-                        self.mostRecentImage()
-                    elif (command == b'2'):
-                        self.sendImageData()
-                    elif (command == b'3'):
-                        self.requestedImage()
-                    elif (command == b'4'):
-                        self.sendCameraSettings()
-                    elif (command == b'5'):
-                        self.getCameraSettings()
-                    elif (command == b'P'):
-                        self.pingTest()
-                    elif (command == b'G'):
-                        self.sendgpslog()
-                    elif (command == b'T'):
-                        self.timeSync()
-                    #elif (command == b'9'):  # Not currently used by Ground Station
-                    #    self.horizontalFlip()
-                    #    self.ser.reset_input_buffer()
-                    #elif (command == b'0'):  # Not currently used by Ground Station
-                    #    self.verticalFlip()
-                    #    self.ser.reset_input_buffer()
-                    elif (command == b'P'):
-                        self.sendPing()
-                    elif (command == b'S'):
-                        self.sync()
-                    elif (command == b'D'):
-                        self.sendDeviceStatus()
-                    elif (command == b'H'):
-                        self.set_camera_angle()
-                    elif (command == b'R'):
-                        command = self.ser.read()
-                        if (command == b'R'):
-                            self.rebootPi()
-                        else:
-                            pass
-                    elif (command == b'Q'):
-                        command == self.ser.read()
-                        if (command == b'Q'):
-                            self.shut_down()
-                        else:
-                            pass
-                except:
-                    self.rfdEnabled = False  # The only thing not exception handled in the command functions is the
-                    # acknowledge send, so if this block is triggered, the RFD write failed
-
-            # Make sure the side threads are still going strong
-            self.checkSideThreads()
-
-            ### Periodically take a picture ###
-            if (self.cameraEnabled):
-                if (self.checkpoint < time.time() and not self.takingPicture):  # Take a picture periodically
-                    try:
-                        camera = picamera.PiCamera()
-                        camera.close()
-                    except:
-                        self.cameraEnabled = False
-                        if (self.rfdEnabled):
-                            self.ser.write(b'Alert: Camera is disabled\n')
-                        print('Camera disabled')
-                    if self.cameraEnabled:
-                        print("Taking Picture")
-                        self.takingPicture = True
-                        self.picThread = TakePicture(
-                            "Picture Thread", self.cameraSettings, self.folder, self.imagenumber, self.picQ)
-                        self.picThread.daemon = True
-                        self.picThread.start()
-
-            ### Check for picture stuff ###
-            if (self.cameraEnabled):
-                if (not self.picQ.empty()):
-                    # Command to reset the recentimg and increment the pic number (pic successfully taken)
-                    if (self.picQ.get() == 'done'):
-                        self.recentimg = "%s%04d%s" % (
-                            "image", self.imagenumber, "_b.jpg")
-                        self.imagenumber += 1
-                        self.takingPicture = False
-                        self.checkpoint = time.time() + self.pic_interval
-                    # Command to reset the camera
-                    elif (self.picQ.get() == 'reset'):
-                        self.takingPicture = False
-                        self.reset_cam()
-                    # Command to reset the checkpoint
-                    elif (self.picQ.get() == 'checkpoint'):
-                        self.takingPicture = False
-                        self.checkpoint = time.time() + self.pic_interval
-                    # Command to disable the camera
-                    elif (self.picQ.get() == 'No Cam'):
-                        self.cameraEnabled = False
-                    else:
-                        # Clear the queue of any unexpected messages
-                        while (not self.picQ.empty()):
-                            print(self.picQ.get())
+                    self.alert('Alert: GPS is disabled')
+
+    def readCommand(self):
+        # Blocks until a command arrives, returns None if the port timed out
+        # Runs in a worker thread so the event loop never waits on the serial port
+        # A framed command is read whole, its length says where it ends. A bare letter is a command from an
+        # older ground station, and is only taken until the first framed command shows up
+        try:
+            first = self.ser.read()
+            if (first == b''):
+                return None
+            if (first[0] == protocol.COMMAND_START):
+                command = protocol.read_command(self.ser)
+            elif (self.legacyCommands):
+                command = protocol.Command(first, None, b'', True)
+            else:
+                print("Skipped stray byte:", first)
+                return None
+        except Exception as e:
+            print(str(e))
+            self.rfdEnabled = False
+            return None
+        if (command is not None):
+            print("Command: ", command.opcode, "// seq:", command.seq, "// check:", command.checkOK)
+        return command
+
+    def acknowledge(self, legacy=b'A'):
+        # Answers the command being run, before any of its data
+        # A framed command gets a reply carrying its seq, an older ground station gets the letter it waits for
+        if ((self.command is None) or (self.command.seq is None)):
+            self.ser.write(legacy)
+        else:
+            self.ser.write(protocol.build_command(protocol.REPLY_ACK, self.command.seq, self.command.opcode))
+
+    def confirmed(self):
+        # Commands R and Q have to be sent twice, a framed one carries the second letter as its payload
+        if (self.command.seq is None):
+            return (self.ser.read() == self.command.opcode)
+        return (self.command.payload == self.command.opcode)
 
-            if (self.rfdEnabled):
+    def runCommand(self, command):
+        # Runs the handler for a command, the handler has the RFD to itself until it returns
+        with self.portLock:
+            try:
+                self.command = command
+                if (not command.checkOK):
+                    # Broken on the way up, have the ground station send it again rather than guess what it was
+                    print("Command failed its check")
+                    self.ser.write(protocol.build_command(protocol.REPLY_NAK, command.seq, command.opcode))
+                elif (command.opcode in self.commands):
+                    if (command.seq is not None):
+                        self.legacyCommands = False
+                    self.commands[command.opcode]()
+                elif (command.seq is not None):
+                    print("Unknown command")
+                    self.ser.write(protocol.build_command(protocol.REPLY_UNKNOWN, command.seq, command.opcode))
                 # Clear the input buffer so we're ready for a new command to be received
                 self.ser.reset_input_buffer()
+            except:
+                self.rfdEnabled = False  # The only thing not exception handled in the command functions is the
+                # acknowledge send, so if this block is triggered, the RFD write failed
+            finally:
+                self.command = None
+        self.sendPendingAlerts()
+
+    def alert(self, text):
+        # Tells the ground station something went wrong (or right) with the hardware
+        # While a command has the RFD the alert waits instead of breaking into its data, for the next telemetry gap
+        # if an image is going out with telemetry on, otherwise until the command is done
+        print(text)
+        if (not self.rfdEnabled):
+            return
+        if (self.portLock.acquire(blocking=False)):
+            try:
+                self.ser.write((text + '\n').encode('utf-8'))
+            finally:
+                self.portLock.release()
+        elif (self.telemetryEnabled and self.sendingFrames):
+            self.telemetry.put(protocol.CHANNEL_ALERT, text.encode('utf-8'))
+        else:
+            self.pendingAlerts.put(text)
 
-            ### Print out any exceptions that the threads have experienced ###
-            if (self.gpsEnabled):
-                while (not self.gpsExceptionsQ.empty()):
-                    print(self.gpsExceptionsQ.get())
+    def sendPendingAlerts(self):
+        # Sends the alerts that came in while a command had the RFD, and any the last image ended before sending
+        for text in self.telemetry.take_alerts():
+            self.pendingAlerts.put(text.decode('utf-8'))
+        if (self.pendingAlerts.empty()):
+            return
+        with self.portLock:
+            try:
+                while (not self.pendingAlerts.empty()):
+                    self.ser.write((self.pendingAlerts.get() + '\n').encode('utf-8'))
+            except:
+                self.rfdEnabled = False
 
-            # Camera Check
-            if (not self.cameraEnabled):
+    def checkPictures(self):
+        # Starts the next periodic picture once it's due, and handles the picture thread's answer
+        ### Periodically take a picture ###
+        if (self.cameraEnabled):
+            if (self.checkpoint < time.time() and not self.takingPicture):  # Take a picture periodically
                 try:
                     camera = picamera.PiCamera()
                     camera.close()
-                    self.cameraEnabled = True
-                    print('Camera is now Enabled')
-                    if (self.rfdEnabled):
-                        self.ser.write(b'Camera is now Enabled')
                 except:
-                    pass
+                    self.cameraEnabled = False
+                    self.alert('Alert: Camera is disabled')
+                if self.cameraEnabled:
+                    print("Taking Picture")
+                    self.takingPicture = True
+                    self.picThread = TakePicture(
+                        "Picture Thread", self.cameraSettings, self.folder, self.imagenumber, self.picQ)
+                    self.picThread.daemon = True
+                    self.picThread.start()
+
+        ### Check for picture stuff ###
+        if (self.cameraEnabled):
+            if (not self.picQ.empty()):
+                message = self.picQ.get()
+                # Command to reset the recentimg and increment the pic number (pic successfully taken)
+                if (message == 'done'):
+                    self.recentimg = "%s%04d%s" % (
+                        "image", self.imagenumber, "_b.jpg")
+                    self.imagenumber += 1
+                    self.takingPicture = False
+                    self.checkpoint = time.time() + self.pic_interval
+                # Command to reset the camera
+                elif (message == 'reset'):
+                    self.takingPicture = False
+                    self.reset_cam()
+                # Command to reset the checkpoint
+                elif (message == 'checkpoint'):
+                    self.takingPicture = False
+                    self.checkpoint = time.time() + self.pic_interval
+                # Command to disable the camera
+                elif (message == 'No Cam'):
+                    self.cameraEnabled = False
+                else:
+                    # Clear the queue of any unexpected messages
+                    print(message)
+                    while (not self.picQ.empty()):
+                        print(self.picQ.get())
 
-            # RFD and GPS Check
-            if (not self.gpsEnabled) or (not self.rfdEnabled):
-                ports = serial.tools.list_ports.comports()
-                for each in ports:
-                    if each.vid == 1659 and each.pid == 8963:
-                        if each.device != self.rfdPort:
-                            gpsTest = serial.Serial(
-                                port=each.device, baudrate=9600, timeout=1)
-                            try:
-                                sample = gpsTest.readline()
-                                sample = gpsTest.readline()  # Get 2 lines to make sure it's a full line
-                                sample = sample.decode('utf-8')
-                                if sample[0:2] == "$G":
-                                    self.gpsPort = each.device
-                                    self.gps = serial.Serial(
-                                        port=self.gpsPort, baudrate=self.gpsBaud, timeout=self.gpsTimeout)
-                                    self.gpsEnabled = True
-                                    # This will cause the thread to be restarted in the the checkSideThreads call next loop
-                                    self.gpsResetQ.put('reset')
-                                    # Close the GPS so it can be opened again later
-                                    self.gps.close()
-                                    print('GPS is now Enabled')
-                                    if (self.rfdEnabled):
-                                        self.ser.write(b'GPS is now Enabled')
-                                else:
-                                    if (not self.rfdEnabled):
-                                        self.rfdPort = each.device
-                                        print('RFD is now Enabled')
-                            except Exception as e:
-                                print(str(e))
-
-        except KeyboardInterrupt:  # For debugging pruposes, close the RFD port and quit if you get a keyboard interrupt
-            self.ser.close()
-            quit()
-
-        except Exception as e:  # Print any exceptions from the main loop
-            print(str(e))
+    def checkHealth(self):
+        # Restarts dead threads and looks for hardware that has come back
+        print("RT: " + str(int(time.time() - self.starttime)) + " Health Check")
+
+        # Make sure the side threads are still going strong
+        self.checkSideThreads()
+
+        ### Print out any exceptions that the threads have experienced ###
+        if (self.gpsEnabled):
+            while (not self.gpsExceptionsQ.empty()):
+                print(self.gpsExceptionsQ.get())
+
+        # Camera Check
+        if (not self.cameraEnabled):
+            try:
+                camera = picamera.PiCamera()
+                camera.close()
+                self.cameraEnabled = True
+                self.alert('Camera is now Enabled')
+            except:
+                pass
+
+        # RFD and GPS Check
+        if (not self.gpsEnabled) or (not self.rfdEnabled):
+            ports = serial.tools.list_ports.comports()
+            for each in ports:
+                if each.vid == 1659 and each.pid == 8963:
+                    if each.device != self.rfdPort:
+                        gpsTest = serial.Serial(
+                            port=each.device, baudrate=9600, timeout=1)
+                        try:
+                            sample = gpsTest.readline()
+                            sample = gpsTest.readline()  # Get 2 lines to make sure it's a full line
+                            sample = sample.decode('utf-8')
+                            if sample[0:2] == "$G":
+                                self.gpsPort = each.device
+                                self.gps = serial.Serial(
+                                    port=self.gpsPort, baudrate=self.gpsBaud, timeout=self.gpsTimeout)
+                                self.gpsEnabled = True
+                                # This will cause the thread to be restarted in the the checkSideThreads call next time
+                                self.gpsResetQ.put('reset')
+                                # Close the GPS so it can be opened again later
+                                self.gps.close()
+                                self.alert('GPS is now Enabled')
+                            else:
+                                if (not self.rfdEnabled):
+                                    self.rfdPort = each.device
+                                    print('RFD is now Enabled')
+                        except Exception as e:
+                            print(str(e))
+
+    async def commandReader(self):
+        # Reads commands as they arrive and hands each one to its handler
+        loop = asyncio.get_event_loop()
+        while True:
+            if (not self.rfdEnabled):
+                await asyncio.sleep(self.healthInterval)  # The health check may find it again
+                continue
+            command = await loop.run_in_executor(None, self.readCommand)
+            if (command is not None):
+                # The handler is its own task, nothing else is read until it's done with the RFD
+                handler = asyncio.ensure_future(loop.run_in_executor(None, self.runCommand, command))
+                await handler
+
+    async def pictureTimer(self):
+        # Wakes up when the next picture is due, and often while one is being taken to pick up the result
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.checkPictures)
+            except Exception as e:
+                print(str(e))
+            if (self.takingPicture or not self.cameraEnabled):
+                await asyncio.sleep(0.5)
+            else:
+                await asyncio.sleep(min(max(self.checkpoint - time.time(), 0.1), self.healthInterval))
+
+    async def healthTimer(self):
+        # Runs the hardware checks every self.healthInterval seconds
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.checkHealth)
+            except Exception as e:
+                print(str(e))
+            await asyncio.sleep(self.healthInterval)
+
+    async def run(self):
+        # The main loop for the program, commands are handled the moment they arrive while pictures
+        # and health checks run on their own timers
+        await asyncio.gather(self.commandReader(), self.pictureTimer(), self.healthTimer())
 
 
 if __name__ == "__main__":
     ### Check for, and create the folder for this flight ###
-    folder = "/home/pi/RFD_Pics_Logs/%s/" % strftime("%m%d%Y_%H%M%S")
+    folder = os.environ.get("RFD_FOLDER", "/home/pi/RFD_Pics_Logs/") + "%s/" % strftime("%m%d%Y_%H%M%S")
     dir = os.path.dirname(folder)
     if (not os.path.exists(dir)):
-        os.mkdir(dir)
+        os.makedirs(dir)
 
     ### Create the logfile ###
     try:
@@ -954,13 +1446,19 @@ if __name__ == "__main__":
     sys.stdout = Unbuffered(sys.stdout)
 
     try:
-        gpsLog = open(folder + "gpslog.txt", "a")
-        gpsLog.close()
-        loggingGPS = True
+        gpsLog = gpsdata.GPSLog(folder + "gpslog.txt")
     except:
-        loggingGPS = False
+        gpsLog = None
         print("Failed to create gpslog.txt")
+    try:
+        gpsTrack = gpsdata.TrackStore(folder + "gpstrack.bin")
+    except:
+        gpsTrack = None
+        print("Failed to create gpstrack.bin")
 
     mainLoop = main()
-    while True:
-        mainLoop.loop()
+    try:
+        asyncio.get_event_loop().run_until_complete(mainLoop.run())
+    except KeyboardInterrupt:  # For debugging pruposes, close the RFD port and quit if you get a keyboard interrupt
+        mainLoop.ser.close()
+        mainLoop.closeGPSFiles()
@@ -0,0 +1,695 @@
+#####################################################################################
+#   Shared link protocol for RFD_2020_PayloadPi and RFD_2020_GroundStation over     #
+#   the RFD900 Modem. Both sides import this file, so keep a copy next to each.     #
+#   Constructed for MSGC Borealis program.                                          #
+#                                                                                   #
+#   Python Version: 3.7.6                                                           #
+#                                                                                   #
+#####################################################################################
+
+import math
+import struct
+import hashlib
+import zlib
+import lzma
+from collections import namedtuple
+try:
+    import xxhash  # Optional, only needed for the xxh64 check
+except ImportError:
+    xxhash = None
+
+# Transfer modes, agreed on with the 'M' command before an image is requested
+MODE_B64 = "b64"  # Original mode, the image is base64 encoded and sent in hex md5 checked words
+MODE_BINARY = "binary"  # Raw image bytes sent in length prefixed, checksummed frames
+MODES = (MODE_B64, MODE_BINARY)
+# The mode line sent with command M is the mode followed by key=value options, ex. "binary fec=4"
+
+# Framed commands
+# The ground station sends every command as
+#   start (1 byte) | opcode (1 byte) | seq (2 bytes) | length (2 bytes) | payload (length) | crc32 (4 bytes)
+# The crc32 covers everything after the start byte. The Pi answers in the same layout before any of the command's
+# data: opcode REPLY_ACK with the seq of the command it took and the command's opcode as the payload, REPLY_NAK
+# if the command arrived broken, or REPLY_UNKNOWN for an opcode it has no handler for. The ground station only
+# counts the reply carrying its own seq, so a late answer to an earlier try is never taken for this one.
+# The start byte is not ASCII, so the Pi can still tell a bare letter from an older ground station apart
+COMMAND_START = 0xA5
+COMMAND_HEADER = struct.Struct(">cHH")
+COMMAND_CHECK = struct.Struct(">I")
+MAX_COMMAND_LENGTH = 1024  # Anything longer than this is a corrupted header
+MAX_COMMAND_SKIP = 1024  # Bytes to look through for a start byte before giving up
+REPLY_ACK = b'A'
+REPLY_NAK = b'N'
+REPLY_UNKNOWN = b'U'
+
+# Resynchronisation
+# When either end loses its place in the stream (a broken word, a lost poll or ack, a header that makes no sense)
+# both meet in sync(). The Pi sends SYNC_MARK every SYNC_INTERVAL seconds until the ground station answers
+# SYNC_REPLY, then sends SYNC_END once. The ground station drops everything up to the end of SYNC_END and the Pi
+# everything up to the end of SYNC_REPLY, so the next byte either end reads is the first one sent after the sync
+# and nothing is flushed on a timer. The marks are random bytes that aren't frame types or the command start,
+# so a frame header or a run of image data matching one is as good as impossible
+SYNC_MARK = b'\xc3\x5a\x96\x0f\xe1\x3c\xb7\x52'
+SYNC_REPLY = b'\x3c\xe5\x69\xf0\x1e\xc3\x58\xad'
+SYNC_END = b'\x96\x0f\xc3\x5a\x52\xb7\x3c\xe1'
+SYNC_INTERVAL = 0.25
+MAX_SYNC_SKIP = 256 * 1024  # Bytes to look through for a mark before giving up, about 45 s at 57600 baud
+
+# Binary mode layout
+# The transfer starts with the total image size, then every frame is
+#   preamble (4 bytes) | type (1 byte) | seq (2 bytes) | offset (4 bytes) | length (4 bytes) | data (length) |
+#   check (CHECK_SIZES bytes, over the header and the data)
+# The Pi sends a window of data frames followed by a poll frame listing their sequence numbers,
+# the ground station answers the poll with an ack frame listing the sequence numbers it wants again.
+# A dropped or added byte only costs the frame it hit (and maybe the next one): the reader skips ahead to the
+# next preamble instead of reading every header after it out of place, so no sync is needed
+SIZE_HEADER = struct.Struct(">I")
+FRAME_PREAMBLE = b'\xb5\x62\xd3\x1e'
+FRAME_HEADER = struct.Struct(">BHII")
+MAX_FRAME_SKIP = 128 * 1024  # Bytes to look through for a preamble before giving up on the stream
+CHECKSUM_SIZE = 16  # md5, still used for the whole image digest check
+MAX_FRAME_LENGTH = 65535  # Anything longer than this is a corrupted header
+MAX_CHUNK = 16000  # Largest piece of image the chunk controller will put in one frame
+SEQ_MODULO = 65536
+
+FRAME_DATA = ord('D')  # A piece of the image starting at offset
+FRAME_POLL = ord('P')  # Ends a window, the data is the list of sequence numbers that were just sent
+FRAME_ACK = ord('K')  # Answer to a poll, the data is the list of sequence numbers to resend
+FRAME_PARITY = ord('F')  # XOR of a group of data frames, lets the ground station rebuild one lost frame
+FRAME_DIGEST = ord('Z')  # Sent once every byte has been acked, the data is the sha256 of the whole image
+FRAME_TELEMETRY = ord('T')  # Telemetry riding along with an image, see below
+FRAME_STOP = ord('X')  # Answer to a poll that ends the transfer there, the operator cancelled the download
+FRAME_NAME = ord('N')  # Starts the next image of a batch, see below
+FRAME_TYPES = (FRAME_DATA, FRAME_POLL, FRAME_ACK, FRAME_PARITY, FRAME_DIGEST, FRAME_TELEMETRY, FRAME_STOP,
+               FRAME_NAME)
+
+# Frame checks (option check=)
+# Every frame ends with a check of its data. md5 is what binary mode started with, crc32 only catches radio
+# errors but is 12 bytes shorter per frame. A broken frame that slips past a short check is still caught by
+# the digest of the whole image at the end of the transfer
+CHECK_MD5 = "md5"
+CHECK_CRC32 = "crc32"
+CHECK_XXH64 = "xxh64"  # Needs the xxhash package on both ends
+CHECK_SIZES = {CHECK_MD5: 16, CHECK_CRC32: 4, CHECK_XXH64: 8}
+if (xxhash is None):
+    CHECKS = (CHECK_MD5, CHECK_CRC32)
+else:
+    CHECKS = (CHECK_MD5, CHECK_CRC32, CHECK_XXH64)
+
+# Resuming an image (binary mode only)
+# Command 3 takes "name@ranges\n", where ranges are the byte ranges still needed, ex. "0-2000,40000-"
+# A range without an end runs to the end of the image, so "name@40000" restarts at byte 40000
+REQUEST_SEPARATOR = '@'
+
+# Batches (command B, binary mode only)
+# After the acknowledge the ground station sends a blob of command 3 requests, one per line. The Pi then sends the
+# images back to back with no command or acknowledge in between. Each one starts with a name frame, its data is the
+# image name and its seq the line of the request, followed by a normal binary transfer (size 0 if the Pi doesn't
+# have the image). A name frame with no data ends the batch. Stopping one image (FRAME_STOP) stops the batch.
+# Batches never send progressive stages
+
+# Progressive images (binary mode only, option progressive=1)
+# Commands 1 and 3 send a ladder of smaller versions of the image before the image itself. Every stage starts with
+#   stage (1 byte) | stages (1 byte)
+# followed by a normal binary transfer. After every stage but the last the ground station answers
+# STAGE_CONTINUE to get the next one or STAGE_STOP to end the request there
+STAGE_HEADER = struct.Struct(">BB")
+STAGE_CONTINUE = b'C'
+STAGE_STOP = b'X'
+
+# Region of interest (command C)
+# The request is "name left top right bottom scale\n". The box is in fractions of the image width and height,
+# so a box dragged on the small _b.jpg picks out the same part of the full resolution _a.png.
+# The crop is shrunk by scale (1 = full resolution) and sent like any other image
+
+# Compressed text (commands 2, 4 and G, option compress=)
+# imagedata.txt, gpslog.txt and camerasettings.txt are sent as one blob instead of line by line
+#   codec (1 byte) | text length (4 bytes) | packed length (4 bytes) | packed text | check (CHECK_SIZES bytes)
+# The codec is the position in COMPRESSIONS, so the receiver never has to guess how it was packed
+COMPRESS_NONE = "none"  # Plain lines, the way these commands have always worked
+COMPRESS_ZLIB = "zlib"
+COMPRESS_ZDICT = "zdict"  # zlib primed with ZDICT, best for the short files we send
+COMPRESS_LZMA = "lzma"
+COMPRESSIONS = (COMPRESS_NONE, COMPRESS_ZLIB, COMPRESS_ZDICT, COMPRESS_LZMA)
+BLOB_HEADER = struct.Struct(">BII")
+MAX_BLOB_LENGTH = 16 * 1024 * 1024
+# Preset dictionary of the line formats we send, the most common text goes last
+ZDICT = (b"650\n450\n0\n50\n0\n0\n400\n"
+         b"image0000_b.jpg, @ time(01/01/2021 00:00:00) settings(w=650,h=450,sh=0,b=50,c=0,sa=0,i=400)\n"
+         b"image0000_a.png @ time(01/01/2021 00:00:00) settings(w=2592,h=1944,sh=0,b=50,c=0,sa=0,i=400)\n"
+         b"12,0,0,44.000000,-103.000000,1000.0,10\n"
+         b"12,0,1,44.000000,-103.000000,1000.0,10\n")
+
+# GPS track (commands L and W)
+# In binary mode the track is sent like an image, as its codec (1 byte, see COMPRESSIONS) and the packed track,
+# otherwise as one blob. Either way the track is
+#   version (1 byte) | fix count (varint) | first fix | every other fix as the change from the one before it
+# A fix is time, lat, lon, alt and sats as whole numbers of TRACK_SCALES, each a zig-zag varint (LEB128, 7 bits a
+# byte, small positive and negative numbers both take one byte). Balloon fixes change little from one to the next,
+# so most fixes take 6 to 9 bytes instead of the ~40 of a gpslog.txt line. Fixes without a position are left out,
+# a missing alt is sent as the alt before it
+TRACK_VERSION = 1
+TRACK_SCALES = (100, 1000000, 1000000, 10, 1)  # Centiseconds, millionths of a degree, decimeters, satellites
+
+# Telemetry (binary mode only, option telemetry=1)
+# An image can tie up the link for many minutes, so while one is being sent the Pi slips small telemetry frames
+# in between its data frames. They are never acked or resent, the next one replaces a lost one. The data is
+#   channel (1 byte) | text
+# Lower channels are more urgent and go out first. Alerts are all sent in order, the other channels only send
+# their newest message and at most once every interval
+CHANNEL_ALERT = 0
+CHANNEL_GPS = 1
+CHANNEL_STATUS = 2
+CHANNEL_NAMES = {CHANNEL_ALERT: "Alert", CHANNEL_GPS: "GPS", CHANNEL_STATUS: "Status"}
+TELEMETRY_HEADER = struct.Struct(">B")
+
+# Forward error correction
+# A parity frame covers the fec data frames before it, its data is
+#   member count (2 bytes) | seq, offset, length of each member (10 bytes each) | XOR of the members
+# The members are padded with zeros to the longest one before they are XORed together
+PARITY_COUNT = struct.Struct(">H")
+PARITY_MEMBER = struct.Struct(">HII")
+
+Frame = namedtuple('Frame', ['frametype', 'seq', 'offset', 'data', 'checkOK'])
+Command = namedtuple('Command', ['opcode', 'seq', 'payload', 'checkOK'])  # seq is None for a bare letter command
+TrackPoint = namedtuple('TrackPoint', ['time', 'lat', 'lon', 'alt', 'sats'])  # time in seconds since 1970 UTC
+
+
+class ChunkController:
+    # Picks the size of the next chunk from how the link has been doing
+    # (additive increase on a clean window, multiplicative decrease on errors)
+    # Binary frames carry their own length, so the ground station just follows the Pi's controller. Base64 words
+    # don't, so both ends run one in lockstep off the same Y/N answers and restart it after every sync
+
+    def __init__(self, start=10000, minimum=1000, maximum=MAX_CHUNK, step=1000, decrease=0.5, restartSize=2000):
+        self.size = start
+        self.minimum = minimum
+        self.maximum = maximum
+        self.step = step
+        self.decrease = decrease  # Never shrink by more than this factor at once
+        self.restartSize = restartSize
+        self.errorRate = 0.0  # Smoothed fraction of frames that had to be resent
+
+    def getSize(self):
+        return self.size
+
+    def update(self, sent, failed):
+        # Call after every window (or base64 word) with how many frames went out and how many failed
+        if (sent <= 0):
+            return self.size
+        self.errorRate = 0.75 * self.errorRate + 0.25 * failed / sent
+        if (failed == 0):
+            self.size = min(self.maximum, self.size + self.step)
+        else:
+            self.size = max(self.minimum, int(self.size * max(self.decrease, 1 - failed / sent)))
+        return self.size
+
+    def restart(self):
+        # Drops to a size both ends know without talking, so lockstep controllers agree again after a sync
+        self.size = max(self.minimum, min(self.maximum, self.restartSize))
+        return self.size
+
+
+def build_command(opcode, seq, payload=b''):
+    # Wraps a command (or a reply to one) into a frame, opcode is a single byte like b'1'
+    body = COMMAND_HEADER.pack(opcode, seq, len(payload)) + bytes(payload)
+    return bytes([COMMAND_START]) + body + COMMAND_CHECK.pack(zlib.crc32(body) & 0xffffffff)
+
+
+def read_command(ser):
+    # Reads the rest of a framed command once its start byte has been read
+    # Returns a Command, or None if the port timed out before a full header arrived
+    # An impossible length means the header is corrupted, the payload is not read and checkOK is False
+    header = ser.read(COMMAND_HEADER.size)
+    if (len(header) < COMMAND_HEADER.size):
+        return None
+    opcode, seq, length = COMMAND_HEADER.unpack(header)
+    if (length > MAX_COMMAND_LENGTH):
+        return Command(opcode, seq, b'', False)
+    payload = ser.read(length)
+    checktheirs = ser.read(COMMAND_CHECK.size)
+    checkOK = (len(payload) == length) and \
+              (COMMAND_CHECK.pack(zlib.crc32(header + payload) & 0xffffffff) == checktheirs)
+    return Command(opcode, seq, payload, checkOK)
+
+
+def find_command(ser, limit=MAX_COMMAND_SKIP):
+    # Skips anything before the next start byte and reads the command or reply after it
+    # Returns None if the port timed out or limit bytes went by without a start byte
+    for x in range(limit):
+        byte = ser.read()
+        if (byte == b''):
+            return None
+        if (byte[0] == COMMAND_START):
+            return read_command(ser)
+    return None
+
+
+def mark_overlap(window, mark):
+    # Length of the longest start of mark that window ends with
+    for size in range(min(len(mark) - 1, len(window)), 0, -1):
+        if (window.endswith(mark[:size])):
+            return size
+    return 0
+
+
+def find_mark(ser, mark, limit=MAX_SYNC_SKIP, exact=False):
+    # Reads from ser until mark has gone by, returns False if the port went quiet or limit bytes went by first
+    # Whatever is waiting is read in one go, unless exact: then it never reads past the end of the mark,
+    # so anything sent after the mark is left for the next read
+    window = bytearray()
+    skipped = 0
+    while (skipped < limit):
+        if (exact):
+            size = len(mark) - mark_overlap(window, mark)
+        else:
+            size = max(ser.in_waiting, len(mark))
+        data = ser.read(size)
+        if (not data):
+            return False
+        window += data
+        if (window.find(mark) >= 0):
+            return True
+        skipped += len(data)
+        del window[:-(len(mark) - 1)]  # Only the end can still be the start of the mark
+    return False
+
+
+def parse_mode(line):
+    # Splits a command M mode line into the mode and a dict of its options
+    tokens = line.split()
+    if (not tokens):
+        return "", {}
+    options = {}
+    for token in tokens[1:]:
+        if ('=' in token):
+            key, value = token.split('=', 1)
+            options[key] = value
+    return tokens[0], options
+
+
+def parse_mode_reply(line):
+    # Checks the Pi's answer to command M, returns its mode and options with the numbers as ints, or None if any of
+    # it is unreadable (ex. bytes lost on the way down ran two options together). Options left out get defaults
+    mode, options = parse_mode(line)
+    try:
+        numbers = dict([(key, int(options.get(key, 0))) for key in ('fec', 'progressive', 'telemetry')])
+    except ValueError:
+        return None
+    reply = {'compress': options.get('compress', COMPRESS_NONE), 'check': options.get('check', CHECK_MD5)}
+    reply.update(numbers)
+    if ((mode not in MODES) or (reply['compress'] not in COMPRESSIONS) or (reply['check'] not in CHECKS) or
+            (reply['fec'] < 0) or (reply['progressive'] not in (0, 1)) or (reply['telemetry'] not in (0, 1))):
+        return None
+    return mode, reply
+
+
+def format_mode(mode, options):
+    # Builds a command M mode line, the opposite of parse_mode
+    return " ".join([mode] + ["%s=%s" % (key, options[key]) for key in options])
+
+
+def format_ranges(ranges):
+    # Builds the ranges part of a command 3 request from a list of (start, end)
+    return ",".join(["%d-%d" % (start, end) for (start, end) in ranges])
+
+
+def parse_ranges(text, size):
+    # Returns the list of (start, end) byte ranges in a command 3 request, clipped to the image size
+    ranges = []
+    for part in text.split(','):
+        if (part.strip() == ""):
+            continue
+        bounds = part.split('-', 1)
+        start = int(bounds[0])
+        if ((len(bounds) == 1) or (bounds[1].strip() == "")):
+            end = size
+        else:
+            end = int(bounds[1])
+        start = max(start, 0)
+        end = min(end, size)
+        if (start < end):
+            ranges.append((start, end))
+    return ranges
+
+
+def parse_request(line):
+    # Splits a command 3 request into the image name and its ranges text ("" for the whole image)
+    line = line.strip()
+    if (REQUEST_SEPARATOR in line):
+        name, ranges = line.split(REQUEST_SEPARATOR, 1)
+        return name, ranges
+    return line, ""
+
+
+def missing_ranges(received, size):
+    # Returns the (start, end) ranges not yet covered by received, a dict of offset: length
+    ranges = []
+    cur = 0
+    for offset in sorted(received):
+        if (offset > cur):
+            ranges.append((cur, offset))
+        cur = max(cur, offset + received[offset])
+    if (cur < size):
+        ranges.append((cur, size))
+    return ranges
+
+
+def format_crop(name, box, scale):
+    # Builds a command C request, box is (left, top, right, bottom) in fractions of the image
+    return "%s %.4f %.4f %.4f %.4f %d" % ((name,) + tuple(box) + (scale,))
+
+
+def parse_crop(line):
+    # Returns the name, box and scale of a command C request, the box is clipped to the image
+    tokens = line.split()
+    name = tokens[0]
+    box = [min(max(float(token), 0.0), 1.0) for token in tokens[1:5]]
+    scale = max(int(tokens[5]), 1) if len(tokens) > 5 else 1
+    left, right = sorted((box[0], box[2]))
+    top, bottom = sorted((box[1], box[3]))
+    return name, (left, top, right, bottom), scale
+
+
+def write_varint(out, value):
+    # Appends a zig-zag varint to the bytearray out
+    value = value * 2 if value >= 0 else -value * 2 - 1
+    while (value >= 0x80):
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, pos):
+    # Returns the zig-zag varint at data[pos] and the position after it
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if (byte < 0x80):
+            break
+    return (value >> 1) if not (value & 1) else -((value + 1) >> 1), pos
+
+
+def encode_track(points):
+    # Packs (time, lat, lon, alt, sats) fixes for commands L and W, see TRACK_SCALES
+    fixes = []
+    alt = 0
+    for point in points:
+        fixtime, lat, lon, fixalt, sats = point
+        if ((fixtime is None) or (lat is None) or (lon is None) or math.isnan(lat) or math.isnan(lon)):
+            continue
+        if ((fixalt is not None) and not math.isnan(fixalt)):
+            alt = fixalt
+        fixes.append([int(round(value * scale)) for value, scale in zip((fixtime, lat, lon, alt, sats or 0),
+                                                                        TRACK_SCALES)])
+    out = bytearray([TRACK_VERSION])
+    write_varint(out, len(fixes))
+    last = [0] * len(TRACK_SCALES)  # The first fix goes out whole
+    for fix in fixes:
+        for x in range(len(fix)):
+            write_varint(out, fix[x] - last[x])
+        last = fix
+    return bytes(out)
+
+
+def decode_track(data):
+    # Unpacks what encode_track made into a list of TrackPoints, None if it is broken
+    try:
+        if (data[0] != TRACK_VERSION):
+            return None
+        count, pos = read_varint(data, 1)
+        points = []
+        fix = [0] * len(TRACK_SCALES)
+        for x in range(count):
+            for field in range(len(fix)):
+                delta, pos = read_varint(data, pos)
+                fix[field] += delta
+            points.append(TrackPoint(*[value / scale for value, scale in zip(fix[:4], TRACK_SCALES)] + [fix[4]]))
+    except IndexError:
+        return None
+    if (pos != len(data)):
+        return None
+    return points
+
+
+def format_track(points):
+    # TrackPoints as "time,lat,lon,alt,sats" lines
+    return "".join(["%.2f,%.6f,%.6f,%.1f,%d\n" % tuple(point) for point in points])
+
+
+def compress_text(data, compression):
+    # Packs text bytes with one of the COMPRESSIONS
+    if (compression == COMPRESS_ZLIB):
+        return zlib.compress(data, 9)
+    if (compression == COMPRESS_ZDICT):
+        packer = zlib.compressobj(9, zlib.DEFLATED, 15, 9, zlib.Z_DEFAULT_STRATEGY, ZDICT)
+        return packer.compress(data) + packer.flush()
+    if (compression == COMPRESS_LZMA):
+        return lzma.compress(data)
+    return bytes(data)
+
+
+def decompress_text(packed, compression):
+    # Unpacks text bytes packed by compress_text
+    if (compression == COMPRESS_ZLIB):
+        return zlib.decompress(packed)
+    if (compression == COMPRESS_ZDICT):
+        unpacker = zlib.decompressobj(15, ZDICT)
+        return unpacker.decompress(packed) + unpacker.flush()
+    if (compression == COMPRESS_LZMA):
+        return lzma.decompress(packed)
+    return bytes(packed)
+
+
+def pack_text(data, compression):
+    # Packs text bytes with their codec in front, for sending some other way than a blob
+    return bytes([COMPRESSIONS.index(compression)]) + compress_text(data, compression)
+
+
+def unpack_text(packed):
+    # Unpacks what pack_text made, None if it is broken
+    try:
+        return decompress_text(packed[1:], COMPRESSIONS[packed[0]])
+    except Exception:
+        return None
+
+
+def write_blob(ser, data, compression, check=CHECK_MD5):
+    # Sends text bytes as a single compressed blob
+    packed = compress_text(data, compression)
+    ser.write(BLOB_HEADER.pack(COMPRESSIONS.index(compression), len(data), len(packed)))
+    ser.write(packed)
+    ser.write(gen_frame_checksum(packed, check))
+    return len(packed)
+
+
+def read_all(ser, length):
+    # Reads length bytes for as long as they keep coming, the port's timeout only ends it once they stop
+    # A big blob takes longer than one timeout at 57600 baud
+    data = ser.read(length)
+    while (len(data) < length):
+        more = ser.read(length - len(data))
+        if (not more):
+            break
+        data += more
+    return data
+
+
+def read_blob(ser, check=CHECK_MD5):
+    # Reads a blob sent by write_blob, returns the unpacked text bytes or None if it timed out or was corrupted
+    if (check not in CHECK_SIZES):
+        return None
+    header = ser.read(BLOB_HEADER.size)
+    if (len(header) < BLOB_HEADER.size):
+        return None
+    codec, length, packedlength = BLOB_HEADER.unpack(header)
+    if ((codec >= len(COMPRESSIONS)) or (packedlength > MAX_BLOB_LENGTH)):
+        return None
+    packed = read_all(ser, packedlength)
+    if (gen_frame_checksum(packed, check) != ser.read(CHECK_SIZES[check])):
+        return None
+    try:
+        data = decompress_text(packed, COMPRESSIONS[codec])
+    except Exception:
+        return None
+    if (len(data) != length):
+        return None
+    return data
+
+
+class TelemetryMux:
+    # Holds telemetry waiting for a gap in an image transfer and decides what goes out next
+
+    def __init__(self, intervals=None):
+        self.intervals = intervals if intervals is not None else {CHANNEL_GPS: 2, CHANNEL_STATUS: 10}
+        self.alerts = []
+        self.latest = {}  # channel: newest message not sent yet
+        self.lastSent = {}  # channel: time its last message went out
+
+    def put(self, channel, data):
+        if (channel == CHANNEL_ALERT):
+            self.alerts.append(data)
+        else:
+            self.latest[channel] = data
+
+    def take_alerts(self):
+        # Returns the waiting alerts and forgets them
+        # The list is swapped out first, so an alert put from another thread meanwhile isn't lost
+        alerts, self.alerts = self.alerts, []
+        return alerts
+
+    def due(self, now):
+        # Returns the (channel, data) to send now, most urgent first, and forgets them
+        out = [(CHANNEL_ALERT, alert) for alert in self.take_alerts()]
+        for channel in sorted(self.latest):
+            if (now - self.lastSent.get(channel, 0) >= self.intervals.get(channel, 0)):
+                out.append((channel, self.latest.pop(channel)))
+                self.lastSent[channel] = now
+        return out
+
+
+def gen_frame_checksum(data, check=CHECK_MD5, header=b''):
+    # Creates the raw (not hex) check that ends each binary frame, covering its header as well as its data
+    # so a frame with a broken offset or seq can't pass
+    if (check == CHECK_CRC32):
+        return struct.pack(">I", zlib.crc32(data, zlib.crc32(header)) & 0xffffffff)
+    if (check == CHECK_XXH64):
+        hasher = xxhash.xxh64(header)
+    else:
+        hasher = hashlib.md5(header)
+    hasher.update(data)
+    return hasher.digest()
+
+
+def gen_file_digest(data):
+    # Digest of a whole image, checked once after the last frame
+    return hashlib.sha256(data).digest()
+
+
+def build_frame(data, offset, seq=0, frametype=FRAME_DATA, check=CHECK_MD5):
+    # Wraps a piece of the image that starts at offset into a binary frame
+    header = FRAME_HEADER.pack(frametype, seq, offset, len(data))
+    return FRAME_PREAMBLE + header + bytes(data) + gen_frame_checksum(data, check, header)
+
+
+def write_frame(ser, data, offset, seq=0, frametype=FRAME_DATA, check=CHECK_MD5):
+    # Same bytes as ser.write(build_frame(...)), but data is written on its own instead of joined to the header,
+    # so a memoryview slice of a mapped image is never copied here
+    header = FRAME_HEADER.pack(frametype, seq, offset, len(data))
+    ser.write(FRAME_PREAMBLE + header)
+    ser.write(data)
+    ser.write(gen_frame_checksum(data, check, header))
+
+
+def read_frame(ser, check=CHECK_MD5):
+    # Reads the next binary frame from the serial port, skipping anything before its preamble
+    # Returns a Frame, or None if the port timed out before a full header arrived or no preamble turned up
+    # A header with an unknown type or impossible length was hit by an error, the rest of the frame is not read
+    # and checkOK is False. The next read_frame picks up at the preamble after it
+    if (not find_mark(ser, FRAME_PREAMBLE, MAX_FRAME_SKIP, exact=True)):
+        return None
+    header = ser.read(FRAME_HEADER.size)
+    if (len(header) < FRAME_HEADER.size):
+        return None
+    frametype, seq, offset, length = FRAME_HEADER.unpack(header)
+    if ((frametype not in FRAME_TYPES) or (length > MAX_FRAME_LENGTH)):
+        return Frame(frametype, seq, offset, b'', False)
+    data = ser.read(length)
+    checktheirs = ser.read(CHECK_SIZES[check])
+    checkOK = (len(data) == length) and (gen_frame_checksum(data, check, header) == checktheirs)
+    return Frame(frametype, seq, offset, data, checkOK)
+
+
+def pack_seqs(seqs):
+    # Packs a list of sequence numbers for a poll or ack frame
+    return struct.pack(">%dH" % len(seqs), *seqs)
+
+
+def unpack_seqs(data):
+    # Unpacks the list of sequence numbers from a poll or ack frame
+    return list(struct.unpack(">%dH" % (len(data) // 2), data[:len(data) // 2 * 2]))
+
+
+def build_poll(seqs, check=CHECK_MD5):
+    # Frame that ends a window of data frames
+    return build_frame(pack_seqs(seqs), 0, 0, FRAME_POLL, check)
+
+
+def build_ack(seqs, check=CHECK_MD5):
+    # Frame that answers a poll with the sequence numbers that need to be resent
+    return build_frame(pack_seqs(seqs), 0, 0, FRAME_ACK, check)
+
+
+def build_stop(check=CHECK_MD5):
+    # Frame that answers a poll by ending the transfer
+    return build_frame(b'', 0, 0, FRAME_STOP, check)
+
+
+def build_name(name, index, check=CHECK_MD5):
+    # Frame that starts image index of a batch, an empty name ends the batch
+    return build_frame(name.encode('utf-8'), 0, index, FRAME_NAME, check)
+
+
+def build_telemetry(channel, data, check=CHECK_MD5):
+    # Frame that carries a telemetry message on its channel
+    return build_frame(TELEMETRY_HEADER.pack(channel) + data, 0, 0, FRAME_TELEMETRY, check)
+
+
+def parse_telemetry(data):
+    # Returns the channel and text bytes of a telemetry frame
+    return TELEMETRY_HEADER.unpack(data[:TELEMETRY_HEADER.size])[0], data[TELEMETRY_HEADER.size:]
+
+
+def build_digest(digest, check=CHECK_MD5):
+    # Frame that ends a binary transfer with the digest of the whole image
+    return build_frame(digest, 0, 0, FRAME_DIGEST, check)
+
+
+def pack_size(size):
+    # The total image size that starts a binary transfer
+    return SIZE_HEADER.pack(size)
+
+
+def read_size(ser):
+    # Reads the total image size, returns None on a timeout
+    header = ser.read(SIZE_HEADER.size)
+    if (len(header) < SIZE_HEADER.size):
+        return None
+    return SIZE_HEADER.unpack(header)[0]
+
+
+def xor_pieces(pieces, length):
+    # XORs byte strings together, each one is treated as padded with zeros to length
+    total = 0
+    for piece in pieces:
+        total ^= int.from_bytes(bytes(piece).ljust(length, b'\0'), 'big')
+    return total.to_bytes(length, 'big')
+
+
+def build_parity(members, pieces, check=CHECK_MD5):
+    # Parity frame for a group of data frames
+    # members is a list of (seq, offset, length), pieces the matching data
+    length = max([len(piece) for piece in pieces])
+    data = PARITY_COUNT.pack(len(members))
+    for member in members:
+        data += PARITY_MEMBER.pack(*member)
+    return build_frame(data + xor_pieces(pieces, length), 0, 0, FRAME_PARITY, check)
+
+
+def parse_parity(data):
+    # Returns the (seq, offset, length) members and the XOR bytes of a parity frame
+    count = PARITY_COUNT.unpack(data[:PARITY_COUNT.size])[0]
+    pos = PARITY_COUNT.size
+    members = []
+    for x in range(count):
+        members.append(PARITY_MEMBER.unpack(data[pos:pos + PARITY_MEMBER.size]))
+        pos += PARITY_MEMBER.size
+    return members, data[pos:]
+
+
+def recover_from_parity(parity, known, length):
+    # Rebuilds the one missing member of a parity group from the data of every other member
+    return xor_pieces(known + [parity], len(parity))[:length]